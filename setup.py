@@ -22,6 +22,10 @@ setup(
     #python setup.py register -r https://testpypi.python.org/pypi
     long_description=read("README.rst") if os.path.isfile("README.rst") else read("README.md"),
     install_requires=[],
+    extras_require={
+                  'ca': ['cryptography'],
+                  },
+    python_requires=">=3.7",
     package_data={
                   'striptls': ['striptls'],
                   },
@@ -1 +1 @@
-import striptls
+from . import striptls
@@ -1,4 +1,18 @@
-import striptls
+import sys
+try:
+    from . import striptls, replay, benchmark, soak, scan, collector, top
+except ImportError:
+    # python striptls (source folder)
+    import striptls, replay, benchmark, soak, scan, collector, top
+
+COMMANDS = {'replay': replay.main,
+            'benchmark': benchmark.main,
+            'soak': soak.main,
+            'scan': scan.main,
+            'collector': collector.main,
+            'top': top.main}
 
 if __name__ == '__main__':
-    striptls.main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+    striptls.main()
@@ -0,0 +1,519 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Benchmarks for the proxy core.
+
+    memory      bytes per live session (Session, TcpSockBuffs, ProtocolDetect,
+                ProtocolState, Result) and per finished session kept for the
+                audit results
+    mangle      ns per call and bytes allocated per call of every vectors
+                mangle_server_data/mangle_client_data and of
+                RewriteDispatcher.get_mangle, replaying generated sessions
+                with 1..n capabilities (or recorded transcripts, see replay)
+                through the vector. --json writes the results, --baseline
+                compares them with an earlier --json file
+    tls relay   throughput of an intercepted tls session (decrypt, encrypt)
+                with user space tls, kernel tls and kernel tls + splice.
+                the peers run in a child process, only the relay is timed
+'''
+import sys
+import os
+import gc
+import ssl
+import time
+import json
+import errno
+import struct
+import socket
+import platform
+import tracemalloc
+import threading
+import multiprocessing
+
+try:
+    from . import striptls, replay
+except ImportError:
+    # python striptls (source folder)
+    import striptls, replay
+
+
+def _new_session(session_class, rewrite, n, port):
+    session = session_class(None, target=("10.0.%d.%d"%(n>>8&0xff, n&0xff), port))
+    session.inbound.peer = ("192.168.%d.%d"%(n>>8&0xff, n&0xff), 40000+n%20000)
+    session.detect_protocol(b"")
+    rewrite.get_mangle(session)
+    return session
+
+
+def measure(f, count):
+    ''' returns (bytes allocated per object, objects) for count calls of f(n) '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        objs = [f(n) for n in range(count)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return size/float(count), objs
+
+
+def bench_memory(count=10000, port=25):
+    ''' returns {name: bytes per session} '''
+    rewrite = striptls.RewriteDispatcher()
+    rewrite.add(port, striptls.Vectors.SMTP.StripFromCapabilities)
+    session_class = striptls.Session.bind_callbacks(mangle_client_data=rewrite.mangle_client_data,
+                                                    mangle_server_data=rewrite.mangle_server_data)
+    results = {}
+    results['live session'], sessions = measure(lambda n: _new_session(session_class, rewrite, n, port), count)
+    results['result record'], _ = measure(lambda n: striptls.Result(sessions[n].inbound.peer[0], sessions[n].outbound.peer,
+                                                                    striptls.Vectors.SMTP.StripFromCapabilities), count)
+    results['tracker'], _ = measure(lambda n: striptls.ProtocolState.create(port), count)
+    results['sockbuff'], _ = measure(lambda n: striptls.TcpSockBuff(None), count)
+    return results
+
+
+def _lines(side, *lines):
+    return (side, b"".join(l + b"\r\n" for l in lines))
+
+
+def _filler(fmt, n):
+    return [(fmt%i).encode("ascii") for i in range(n)]
+
+
+def payload_smtp(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    ehlo = [b"250-mail.example.com"] + [b"250-" + x for x in _filler("X-EXTENSION-%d PARAM", n)] + \
+           [b"250-PIPELINING", b"250-SIZE 10240000", b"250-STARTTLS", b"250 8BITMIME"]
+    return [_lines(S, b"220 mail.example.com ESMTP"), _lines(C, b"EHLO client.example.com"), _lines(S, *ehlo),
+            _lines(C, b"STARTTLS"), _lines(S, b"220 2.0.0 Ready to start TLS"),
+            _lines(C, b"EHLO client.example.com"), _lines(S, *[l for l in ehlo if l != b"250-STARTTLS"]),
+            _lines(C, b"MAIL FROM:<alice@example.com>"), _lines(S, b"250 2.1.0 Ok"),
+            _lines(C, b"QUIT"), _lines(S, b"221 2.0.0 Bye")]
+
+
+def payload_pop3(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    return [_lines(S, b"+OK POP3 ready"), _lines(C, b"CAPA"),
+            _lines(S, *[b"+OK", b"USER", b"UIDL"] + _filler("X-CAPABILITY-%d", n) + [b"STLS", b"."]),
+            _lines(C, b"STLS"), _lines(S, b"+OK Begin TLS"), _lines(C, b"USER alice"), _lines(S, b"+OK"),
+            _lines(C, b"PASS secret"), _lines(S, b"+OK logged in"), _lines(C, b"QUIT"), _lines(S, b"+OK")]
+
+
+def payload_imap(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    caps = b" ".join([b"IMAP4rev1", b"LITERAL+", b"SASL-IR"] + _filler("X-CAPABILITY-%d", n) + [b"STARTTLS", b"LOGINDISABLED"])
+    return [_lines(S, b"* OK [CAPABILITY " + caps + b"] ready"), _lines(C, b"a1 CAPABILITY"),
+            _lines(S, b"* CAPABILITY " + caps, b"a1 OK done"), _lines(C, b"a2 STARTTLS"),
+            _lines(S, b"a2 OK Begin TLS"), _lines(C, b"a3 LOGIN alice secret"), _lines(S, b"a3 OK logged in"),
+            _lines(C, b"a4 LOGOUT"), _lines(S, b"* BYE", b"a4 OK")]
+
+
+def payload_ftp(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    return [_lines(S, b"220 ftp.example.com ready"), _lines(C, b"FEAT"),
+            _lines(S, *[b"211-Features:", b" MDTM", b" SIZE"] + [b" " + x for x in _filler("X-FEATURE-%d", n)] +
+                   [b" AUTH TLS", b" PBSZ", b" PROT", b"211 End"]),
+            _lines(C, b"AUTH TLS"), _lines(S, b"234 Proceed"), _lines(C, b"USER alice"), _lines(S, b"331 Password"),
+            _lines(C, b"PASS secret"), _lines(S, b"230 logged in"), _lines(C, b"QUIT"), _lines(S, b"221 bye")]
+
+
+def payload_nntp(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    return [_lines(S, b"200 news.example.com ready"), _lines(C, b"CAPABILITIES"),
+            _lines(S, *[b"101 Capability list:", b"VERSION 2", b"READER"] + _filler("X-CAPABILITY-%d", n) +
+                   [b"STARTTLS", b"."]),
+            _lines(C, b"STARTTLS"), _lines(S, b"382 Continue with TLS"), _lines(C, b"AUTHINFO USER alice"),
+            _lines(S, b"381 Password"), _lines(C, b"AUTHINFO PASS secret"), _lines(S, b"281 ok"),
+            _lines(C, b"QUIT"), _lines(S, b"205 bye")]
+
+
+def payload_acap(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    sasl = b" ".join([b'"PLAIN"'] + [b'"' + x + b'"' for x in _filler("X-MECH-%d", n)])
+    return [_lines(S, b'* ACAP (IMPLEMENTATION "x") (STARTTLS) (SASL ' + sasl + b")"), _lines(C, b"a1 STARTTLS"),
+            _lines(S, b"a1 OK Begin TLS"), _lines(C, b'a2 AUTHENTICATE "PLAIN"'), _lines(S, b"a2 OK done")]
+
+
+def payload_xmpp(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    stream = b"<stream:stream %s='example.com' xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams' version='1.0'>"
+    mechanisms = b"".join(b"<mechanism>" + x + b"</mechanism>" for x in [b"PLAIN"] + _filler("X-MECH-%d", n))
+    features = b"<stream:features><starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'></starttls>" \
+               b"<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" + mechanisms + b"</mechanisms></stream:features>"
+    return [(C, b"<?xml version='1.0'?>" + stream%b"to"), (S, b"<?xml version='1.0'?>" + stream%b"from" + features),
+            (C, b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"), (S, b"<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"),
+            (C, b"<?xml version='1.0'?>" + stream%b"to"), (S, b"<?xml version='1.0'?>" + stream%b"from" + features),
+            (C, b"<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='PLAIN'>AGFsaWNlAHNlY3JldA==</auth>"),
+            (S, b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")]
+
+
+def payload_irc(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    tokens = [b"CHANTYPES=#", b"PREFIX=(ov)@+", b"NETWORK=Example"] + _filler("X-TOKEN-%d=1", n)
+    isupport = [b":irc.example.net 005 bob " + b" ".join(tokens[i:i+13]) + b" :are supported by this server"
+                for i in range(0, len(tokens), 13)]
+    return [_lines(C, b"CAP LS 302"),
+            _lines(S, b":irc.example.net CAP * LS :" + b" ".join([b"multi-prefix", b"sasl"] + _filler("x-cap-%d", n) + [b"tls"])),
+            _lines(C, b"NICK bob", b"USER bob 0 * :bob"), _lines(C, b"CAP END"),
+            _lines(S, *[b":irc.example.net 001 bob :Welcome"] + isupport), _lines(C, b"PRIVMSG #c :hi")]
+
+
+def payload_ldap(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    BER, LDAPState = striptls.BER, striptls.LDAPState
+    message = lambda mid, op: BER.encode(0x30, BER.encode_int(0x02, mid) + op)
+    done = lambda mid, tag: message(mid, BER.encode(tag, BER.encode_int(0x0a, 0) + BER.encode(0x04, b"") + BER.encode(0x04, b"")))
+    oids = [LDAPState.STARTTLS_OID, b"1.3.6.1.4.1.4203.1.11.1"] + _filler("1.3.6.1.4.1.99999.%d", n)
+    attr = BER.encode(0x30, BER.encode(0x04, b"supportedExtension") + BER.encode(0x31, b"".join(BER.encode(0x04, o) for o in oids)))
+    return [(C, message(1, BER.encode(0x63, BER.encode(0x04, b"") + b"\x0a\x01\x00"))),
+            (S, message(1, BER.encode(0x64, BER.encode(0x04, b"") + BER.encode(0x30, attr))) + done(1, 0x65)),
+            (C, message(2, BER.encode(0x77, BER.encode(0x80, LDAPState.STARTTLS_OID)))),
+            (S, LDAPState.extended_response(2, 0, name=None)),
+            (C, message(3, BER.encode(0x60, BER.encode_int(0x02, 3) + BER.encode(0x04, b"cn=alice") + BER.encode(0x80, b"secret")))),
+            (S, done(3, 0x61))]
+
+
+def payload_pgsql(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    params = b"user\0alice\0database\0db\0" + b"".join(x + b"\0on\0" for x in _filler("x_option_%d", n)) + b"\0"
+    return [(C, struct.pack("!II", 8, striptls.PGSQLState.SSL_REQUEST)), (S, b"S"),
+            (C, struct.pack("!II", 8+len(params), striptls.PGSQLState.PROTOCOL_3) + params),
+            (S, b"R" + struct.pack("!II", 8, 0))]
+
+
+def payload_mysql(n):
+    C, S = replay.Transcript.CLIENT, replay.Transcript.SERVER
+    packet = lambda seq, payload: struct.pack("<I", len(payload))[:3] + bytes((seq,)) + payload
+    greeting = b"\x0a8.0.36\0" + struct.pack("<I", 42) + b"abcdefgh\0" + struct.pack("<HBHH", 0xffff, 0xff, 2, 0xdfff) + \
+               b"\x15" + b"\0"*10 + b"ijklmnopqrst\0caching_sha2_password\0"
+    # CLIENT_CONNECT_ATTRS: n connection attributes
+    flags = struct.pack("<IIB", 0x1fa68d | striptls.MySQLState.CLIENT_SSL, 16777216, 0xff) + b"\0"*23
+    attrs = b"".join(bytes((len(x),)) + x + b"\x01x" for x in _filler("x_attr_%d", n))
+    attrs = (bytes((len(attrs),)) if len(attrs) < 251 else b"\xfc" + struct.pack("<H", len(attrs))) + attrs
+    return [(S, packet(0, greeting)), (C, packet(1, flags)),
+            (C, packet(2, flags + b"alice\0\x00caching_sha2_password\0" + attrs)),
+            (S, packet(3, b"\x00\x00\x00\x02\x00\x00\x00"))]
+
+
+PAYLOADS = {'SMTP': payload_smtp, 'POP3': payload_pop3, 'IMAP': payload_imap, 'FTP': payload_ftp,
+            'NNTP': payload_nntp, 'ACAP': payload_acap, 'XMPP': payload_xmpp, 'IRC': payload_irc,
+            'LDAP': payload_ldap, 'PGSQL': payload_pgsql, 'MYSQL': payload_mysql}   # protocol: f(n capabilities) -> messages
+
+
+class Probe(object):
+    ''' timing (or allocation) wrappers for the vector under test and get_mangle '''
+    
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.samples = []   # (function, value, payload bytes); ns or (allocated, retained) bytes
+        self.clock = time.perf_counter_ns
+    
+    def wrap(self, f, name):
+        ''' f(session[, data, rewrite]) recording its cost and len(data) '''
+        samples, clock = self.samples, self.clock
+        if not self.allocations:
+            def probe(*args):
+                started = clock()
+                r = f(*args)
+                samples.append((name, clock()-started, len(args[1]) if len(args) > 1 else 0))
+                return r
+            return probe
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)    # python 3.9+
+        def probe(*args):
+            before = tracemalloc.get_traced_memory()[0]
+            if reset_peak:
+                reset_peak()
+            r = f(*args)
+            current, peak = tracemalloc.get_traced_memory()
+            samples.append((name, (peak-before if reset_peak else None, current-before), len(args[1]) if len(args) > 1 else 0))
+            return r
+        return probe
+    
+    def vector(self, cls_vector):
+        ''' subclass of cls_vector with probed mangle functions '''
+        methods = dict((name, staticmethod(self.wrap(getattr(cls_vector, name), name)))
+                       for name in ("mangle_server_data", "mangle_client_data") if hasattr(cls_vector, name))
+        return type(cls_vector.__name__, (cls_vector,), methods)
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values)//2] if values else 0
+
+
+def _overhead(count=20000):
+    ''' ns a timing probe adds to a call '''
+    probe = Probe()
+    f = probe.wrap(lambda session, data, rewrite: data, "noop")
+    for _ in range(count):
+        f(None, b"", None)
+    return _median(ns for _, ns, _ in probe.samples)
+
+
+def _replay(transcript, port, cls_vector, probe):
+    rewrite = striptls.RewriteDispatcher()
+    rewrite.add(port, probe.vector(cls_vector))
+    rewrite.get_mangle = probe.wrap(rewrite.get_mangle, "get_mangle")
+    return replay.Replay(transcript, rewrite, port).run()
+
+
+BATCHES = 10
+
+
+def bench_mangle(registry, selection="ALL", sizes=(1, 32, 512), transcripts=(), repeat=200):
+    ''' returns ([{vector, function, payload, calls, bytes, ns_per_op, alloc_bytes_per_op,
+        retained_bytes_per_op},..], [error lines]). calls and bytes are per replayed session
+    '''
+    if not (striptls.Vectors._CA or striptls.Vectors._TLS_CONTEXT):
+        # handshakes are simulated, no certificate needed
+        striptls.Vectors._TLS_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    overhead = _overhead()
+    records, errors = [], []
+    jobs = []   # (vector, payload, transcript, port, cls_vector, warm up probe, allocation probe)
+    for name in registry.expand(s.strip() for s in selection.split(",")):
+        cls_proto, cls_vector = registry.resolve(name)
+        proto = name.split(".")[0]
+        payloads = [("%s-%d"%(proto, n), replay.Transcript(PAYLOADS[proto](n), proto=proto))
+                    for n in (sizes if proto in PAYLOADS else ())]
+        payloads += [(os.path.basename(t.name), t) for t in transcripts if t.proto == proto]
+        if not payloads:
+            errors.append("%s: no payload, add a transcript with P: %s"%(name, proto))
+        for label, transcript in payloads:
+            warmup = Probe()
+            r = _replay(transcript, cls_proto._PROTO_ID, cls_vector, warmup)
+            # peers are not reactive: a client sending STARTTLS after it was stripped ends the session
+            if r.error and not isinstance(r.error, striptls.ProtocolViolationException):
+                errors.append("%s %s: %r"%(name, label, r.error))
+            allocations = Probe(allocations=True)
+            gc.collect()
+            tracemalloc.start()
+            try:
+                for _ in range(max(repeat//10, 1)):
+                    _replay(transcript, cls_proto._PROTO_ID, cls_vector, allocations)
+            finally:
+                tracemalloc.stop()
+            jobs.append((name, label, transcript, cls_proto._PROTO_ID, cls_vector, warmup, allocations))
+    # ns per call of one replay, median per batch, best batch. batches take turns across all
+    # jobs so a burst of load on the machine spoils one batch of many jobs, not all of one
+    batches = [{} for _ in jobs]
+    gc.collect()
+    gc.disable()    # a collection would be charged to whatever call triggers it
+    try:
+        for _ in range(BATCHES):
+            for (name, label, transcript, port, cls_vector, _, _), best in zip(jobs, batches):
+                per_replay = {}
+                for _ in range(max(repeat//BATCHES, 1)):
+                    timing = Probe()
+                    _replay(transcript, port, cls_vector, timing)
+                    totals = {}
+                    for f, ns, _ in timing.samples:
+                        totals.setdefault(f, []).append(ns)
+                    for f, ns in totals.items():
+                        per_replay.setdefault(f, []).append(sum(ns)/float(len(ns)))
+                for f, ns in per_replay.items():
+                    best[f] = min(best.get(f, ns[0]), _median(ns))
+    finally:
+        gc.enable()
+    for (name, label, _, _, _, warmup, allocations), best in zip(jobs, batches):
+        for function in ("mangle_server_data", "mangle_client_data", "get_mangle"):
+            calls = [b for f, _, b in warmup.samples if f == function]
+            if not calls or function not in best:
+                continue
+            allocated = [v for f, v, _ in allocations.samples if f == function]
+            records.append({'vector': name, 'function': function, 'payload': label,
+                            'calls': len(calls),
+                            'bytes': sum(calls)//len(calls),
+                            'ns_per_op': max(int(best[function]) - overhead, 0),
+                            'alloc_bytes_per_op': None if allocated[0][0] is None else
+                                                  sum(a for a, _ in allocated)//len(allocated),
+                            'retained_bytes_per_op': sum(r for _, r in allocated)//len(allocated)})
+    return records, errors
+
+
+def compare(records, baseline, threshold=20.0):
+    ''' [(record, metric, baseline value, value),..] that got more than threshold percent worse '''
+    known = dict(((r['vector'], r['function'], r['payload']), r) for r in baseline)
+    regressions = []
+    for r in records:
+        old = known.get((r['vector'], r['function'], r['payload']))
+        if not old:
+            continue
+        for metric, floor in (('ns_per_op', 500), ('alloc_bytes_per_op', 64)):
+            # below floor the difference is noise (clock resolution, allocator)
+            if old.get(metric) is None or r[metric] is None or r[metric] < floor:
+                continue
+            if r[metric] > old[metric]*(1+threshold/100.0):
+                regressions.append((r, metric, old[metric], r[metric]))
+    return regressions
+
+
+def _tls_peers(certfile, source, sink, size, chunk):
+    ''' child process: tls client sending size bytes to source, tls server on sink '''
+    def serve():
+        context = striptls.Vectors.load_server_context(certfile, certfile)
+        conn = context.wrap_socket(sink.accept()[0], server_side=True)
+        while conn.recv(chunk):
+            pass
+        conn.close()
+    t = threading.Thread(target=serve)
+    t.start()
+    conn = ssl._create_unverified_context().wrap_socket(socket.create_connection(source.getsockname()))
+    block = b"x"*chunk
+    for _ in range(size//chunk):
+        conn.sendall(block)
+    conn.close()
+    t.join()
+
+
+def bench_tls(certfile, size=64*1024*1024, ktls=False, splice=False, chunk=64*1024):
+    ''' relays size bytes from one tls connection to another, returns (MB/s,
+        (send, recv) kernel tls of the relay sockets) or (None, ..) if the
+        sockets cannot be spliced
+    '''
+    source, sink = socket.socket(), socket.socket()
+    for s in (source, sink):
+        s.bind(("127.0.0.1", 0))
+        s.listen(1)
+    child = multiprocessing.get_context("fork").Process(target=_tls_peers, args=(certfile, source, sink, size, chunk))
+    child.start()
+    striptls.TcpSockBuff.KTLS = ktls
+    try:
+        inbound = striptls.TcpSockBuff(source.accept()[0])
+        inbound.ssl_wrap_socket_with_context(striptls.Vectors.load_server_context(certfile, certfile), server_side=True)
+        outbound = striptls.TcpSockBuff(None)
+        outbound.connect(sink.getsockname())
+        outbound.ssl_wrap_socket()
+    finally:
+        striptls.TcpSockBuff.KTLS = False
+    offloaded = (outbound.ktls[0], inbound.ktls[1])
+    # ciphertext must not be spliced; still relay so the peers finish
+    spliced = splice and all(offloaded)
+    pipe = os.pipe()
+    total = 0
+    try:
+        started = time.time()
+        while True:
+            nbytes = None
+            if spliced and not inbound.pending():
+                try:
+                    nbytes = inbound.splice_to(outbound, pipe, chunk)
+                except OSError as e:
+                    # not application data, ssl handles it
+                    if e.errno != errno.EINVAL:
+                        raise
+            if nbytes is None:
+                data = inbound.recv(chunk)
+                nbytes = len(data)
+                outbound.write(data)
+                outbound.flush()
+            if not nbytes:
+                break
+            total += nbytes
+        elapsed = time.time() - started
+    finally:
+        outbound.socket.close()
+        inbound.socket.close()
+        for fd in pipe:
+            os.close(fd)
+        child.join()
+        source.close()
+        sink.close()
+    if splice and not spliced:
+        return None, offloaded
+    return total/1024.0/1024/elapsed, offloaded
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog benchmark [options]
+
+       example: %prog benchmark --json baseline.json
+                %prog benchmark -x SMTP.*,IRC.* --baseline baseline.json --threshold 15
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-n", "--count", dest="count", default=10000, type="int",
+                  help="objects per measurement [default: %default]")
+    parser.add_option("-k", "--key", dest="key",
+                  help="certificate and key (PEM), enables the tls relay benchmark")
+    parser.add_option("--tls-size", dest="tls_size", default=256, type="int",
+                  help="MB relayed per tls mode [default: %default]")
+    parser.add_option("-x", "--vectors", dest="vectors", default="ALL",
+                  help="vectors (PROTO.Vector, PROTO.*) for the mangle benchmark [default: %default]")
+    parser.add_option("-p", "--plugin-dir", dest="plugin_dirs", action="append", default=[],
+                  help="load additional vector protocols from <PROTO>.py files in this directory (may be repeated)")
+    parser.add_option("-t", "--transcript", dest="transcripts", action="append", default=[],
+                  help="recorded session (replay format, P: line required) to run the vectors of its protocol against, may be repeated")
+    parser.add_option("--sizes", dest="sizes", default="1,32,512",
+                  help="capabilities (parameters, attributes) in the generated sessions [default: %default]")
+    parser.add_option("--repeat", dest="repeat", default=200, type="int",
+                  help="replays per vector and payload for the mangle benchmark, 0 skips it [default: %default]")
+    parser.add_option("--json", dest="json",
+                  help="write the results to this file (usable as --baseline)")
+    parser.add_option("--baseline", dest="baseline",
+                  help="compare the mangle results with an earlier --json file, exit status 1 on regressions")
+    parser.add_option("--threshold", dest="threshold", default=20, type="float",
+                  help="percent ns/op or allocated bytes/op may grow before it is a regression [default: %default]")
+    (options, args) = parser.parse_args(argv)
+    striptls.logger.setLevel(striptls.logging.WARNING)
+    striptls.logging.getLogger().setLevel(striptls.logging.WARNING)
+    output = {'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time()}
+    print("[*] memory (%d sessions)"%options.count)
+    output['memory'] = bench_memory(options.count)
+    for name, size in output['memory'].items():
+        print("    %-15s %8.0f bytes"%(name, size))
+    ret = 0
+    if options.repeat:
+        registry = striptls.VectorRegistry(builtin=striptls.Vectors, plugin_dirs=options.plugin_dirs)
+        transcripts = [replay.Transcript.load(path) for path in options.transcripts]
+        print("[*] mangle (%d replays per vector and payload)"%options.repeat)
+        output['mangle'], errors = bench_mangle(registry, options.vectors, [int(n) for n in options.sizes.split(",")],
+                                                transcripts, options.repeat)
+        for r in output['mangle']:
+            print("    %-45s %-18s %-14s %3d calls %6d B %9d ns/op %7s B/op"%(r['vector'], r['function'], r['payload'],
+                                                                                r['calls'], r['bytes'], r['ns_per_op'],
+                                                                                r['alloc_bytes_per_op']))
+        for line in errors:
+            print("    ! %s"%line)
+        if options.baseline:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(output['mangle'], baseline.get('mangle', []), options.threshold)
+            print("[*] baseline %s (python %s): %d regressions over %.0f%%"%(options.baseline, baseline.get('python'),
+                                                                            len(regressions), options.threshold))
+            for r, metric, old, new in regressions:
+                print("    REGRESSION %s %s %s %s: %s -> %s (%+.0f%%)"%(r['vector'], r['function'], r['payload'], metric,
+                                                                     old, new, (new-old)*100.0/old if old else 0))
+            ret = 1 if regressions else 0
+    if not options.key:
+        print("[*] tls relay: skipped, needs --key")
+    else:
+        output['tls'] = bench_tls_modes(options.key, options.tls_size)
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(output, f, indent=1)
+    return ret
+
+
+def bench_tls_modes(certfile, size):
+    ''' runs bench_tls for every mode, returns {mode: MB/s or None} '''
+    print("[*] tls relay (%d MB)"%size)
+    results = {}
+    reason = striptls.TcpSockBuff.ktls_unavailable()
+    for name, ktls, splice in (("user space", False, False), ("kernel tls", True, False), ("kernel splice", True, True)):
+        results[name] = None
+        if ktls and reason:
+            print("    %-15s n/a: %s"%(name, reason))
+            continue
+        rate, offloaded = bench_tls(certfile, size=size*1024*1024, ktls=ktls, splice=splice)
+        if rate is None:
+            print("    %-15s n/a: kernel tls send=%s recv=%s"%(name, offloaded[0], offloaded[1]))
+            continue
+        results[name] = rate
+        print("    %-15s %8.0f MB/s (kernel tls send=%s recv=%s)"%(name, rate, offloaded[0], offloaded[1]))
+    return results
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Central collector for the audit results of several proxies.
+
+Proxies started with --collector stream their results (ResultReporter) as
+JSON lines, one batch per empty line, every batch is acknowledged with
+"ok <records>". Only the latest record per node, client, target and
+vector is kept. The report merges them per client and vector: vulnerable
+if any node saw the vector succeed.
+
+A connection sending REPORT instead of records gets the merged report as
+one JSON document:
+
+    #> python -m striptls collector -l 0.0.0.0:9999 -l /run/striptls-collector.sock
+    #> python -m striptls collector --report /run/striptls-collector.sock
+'''
+import os
+import sys
+import json
+import socket
+import signal
+import logging
+import threading
+import socketserver
+
+try:
+    from . import striptls
+except ImportError:
+    # python striptls (source folder)
+    import striptls
+
+logger = logging.getLogger(__name__)
+
+
+class Collector(object):
+    ''' latest record per (node, client, target, vector) '''
+
+    def __init__(self):
+        self.records = {}
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Collector records=%d batches=%d>"%(len(self.records), self.batches)
+
+    def add(self, records):
+        with self.lock:
+            for r in records:
+                key = (r['node'], r['client'], r['target'], r['vector'])
+                known = self.records.get(key)
+                # batches of one node may arrive out of order (spool, reconnects)
+                if not known or known['time'] <= r['time']:
+                    self.records[key] = r
+            self.batches += 1
+
+    def report(self):
+        ''' [{client, vector, result, sessions, targets, nodes},..] sorted by client, vector '''
+        merged = {}
+        with self.lock:
+            records = list(self.records.values())
+        for r in records:
+            m = merged.get((r['client'], r['vector']))
+            if not m:
+                m = merged[(r['client'], r['vector'])] = {'client': r['client'], 'vector': r['vector'], 'result': None,
+                                                          'sessions': 0, 'targets': set(), 'nodes': set()}
+            if r['result']:
+                m['result'] = True
+            elif m['result'] is None:
+                m['result'] = r['result']
+            m['sessions'] += r['sessions']
+            m['targets'].add(r['target'])
+            m['nodes'].add(r['node'])
+        report = []
+        for key in sorted(merged):
+            m = merged[key]
+            m['targets'] = sorted(t for t in m['targets'] if t)
+            m['nodes'] = sorted(m['nodes'])
+            report.append(m)
+        return report
+
+
+def format_report(report):
+    ''' audit results like the proxy prints them at shutdown '''
+    lines = []
+    client = None
+    for m in report:
+        if m['client'] != client:
+            client = m['client']
+            lines.append("[*] client: %s"%client)
+        lines.append("    [%-11s] %s sessions: %d nodes: %s targets: %s"%("Vulnerable!" if m['result'] else " ", m['vector'],
+                                                                          m['sessions'], ",".join(m['nodes']),
+                                                                          ",".join(m['targets'])))
+    return lines
+
+
+class CollectorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        collector = self.server.collector
+        batch = []
+        for line in self.rfile:
+            line = line.strip()
+            if line == b"REPORT":
+                self.wfile.write(json.dumps(collector.report()).encode("utf-8") + b"\n")
+                return
+            if line:
+                try:
+                    batch.append(json.loads(line.decode("utf-8")))
+                except ValueError as e:
+                    logger.warning("%s - invalid record %r: %s"%(self.client_address, line[:200], e))
+                continue
+            collector.add(batch)
+            self.wfile.write(b"ok %d\n"%len(batch))
+            logger.debug("%s - %d records"%(self.client_address, len(batch)))
+            batch = []
+
+
+class TCPCollectorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixCollectorServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def query(address, timeout=10):
+    ''' merged report of the collector at address ((host, port) or unix path) '''
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address, timeout=timeout)
+    try:
+        sock.sendall(b"REPORT\n")
+        return json.loads(sock.makefile('rb').readline().decode("utf-8"))
+    finally:
+        sock.close()
+
+
+def parse_address(address):
+    ''' unix socket path or host:port, [ipv6]:port '''
+    if "/" in address:
+        return address
+    host, port = address.strip().rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog collector [options]
+
+       example: %prog collector -l 0.0.0.0:9999
+                %prog --listen 0.0.0.0:25 --remote mail.server.tld:25 --collector collector.local:9999
+                %prog collector --report collector.local:9999
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-l", "--listen", dest="listen", action="append", default=[],
+                  help="host:port or unix socket path to accept proxies on (may be repeated)")
+    parser.add_option("--report", dest="report",
+                  help="print the merged report of the collector at host:port or unix socket path and exit")
+    parser.add_option("--json", action="store_true", dest="json", default=False,
+                  help="print the report as JSON")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                  help="log every batch")
+    (options, args) = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)-15s - %(levelname)-8s - %(message)s')
+    logging.getLogger().setLevel(logging.WARNING)
+    striptls.logger.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG if options.verbose else logging.INFO)
+
+    def show(report):
+        print(json.dumps(report, indent=2) if options.json else "\n".join(format_report(report)))
+
+    if options.report:
+        show(query(parse_address(options.report)))
+        return 0
+    if not options.listen:
+        parser.error("mandatory option: listen")
+
+    collector = Collector()
+    servers = []
+    for address in map(parse_address, options.listen):
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = UnixCollectorServer(address, CollectorHandler)
+        else:
+            server = TCPCollectorServer(address, CollectorHandler)
+        server.collector = collector
+        servers.append(server)
+        t = threading.Thread(target=server.serve_forever, name="striptls-collector")
+        t.daemon = True
+        t.start()
+        logger.info("listening on %s"%(address,))
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    logger.info("%r -- merged audit results --"%collector)
+    show(collector.report())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Offline replay of recorded sessions through Session, ProtocolDetect and
+RewriteDispatcher - no sockets, no certificates, no peers.
+
+Transcript format:
+
+    # comment
+    P: SMTP                    protocol, selects its vectors (optional)
+    S: 220 mail.example.com ESMTP
+    C: EHLO client.local
+    S: 250-mail.example.com
+    S: 250 STARTTLS
+    --
+    C: STARTTLS
+
+    C: / S:   one line sent by the client/server, CRLF is appended
+    C= / S=   raw data, nothing is appended (e.g. XMPP stanzas)
+    --        message boundary
+
+Consecutive lines of the same peer form one message (= one recv()).
+Python escapes (\\r \\n \\xNN) are decoded. Peers are not reactive, the
+transcript is replayed as recorded whatever the vector sends them.
+'''
+import sys
+import ssl
+import time
+import codecs
+import logging
+
+try:
+    from . import striptls
+except ImportError:
+    # python striptls (source folder)
+    import striptls
+
+logger = logging.getLogger(__name__)
+
+
+class Transcript(object):
+    CLIENT = 'C'
+    SERVER = 'S'
+
+    def __init__(self, messages, proto=None, name=None):
+        self.messages = messages    # [(CLIENT|SERVER, bytes),..]
+        self.proto = proto
+        self.name = name
+
+    def __repr__(self):
+        return "<Transcript %s proto=%s messages=%d>"%(self.name, self.proto, len(self.messages))
+
+    @classmethod
+    def parse(cls, text, name=None):
+        messages = []
+        proto = None
+        boundary = True
+        for lineno, line in enumerate(text.splitlines(), 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line.strip() == "--":
+                boundary = True
+                continue
+            side, kind, data = line[:1], line[1:2], line[2:]
+            if side == "P" and kind == ":":
+                proto = data.strip()
+                continue
+            if side not in (cls.CLIENT, cls.SERVER) or kind not in (":", "="):
+                raise ValueError("%s:%d: invalid transcript line %r"%(name, lineno, line))
+            if kind == ":" and data.startswith(" "):
+                data = data[1:]
+            data = codecs.escape_decode(data.encode("utf-8"))[0]
+            if kind == ":":
+                data += b"\r\n"
+            if not boundary and messages and messages[-1][0] == side:
+                messages[-1] = (side, messages[-1][1] + data)
+            else:
+                messages.append((side, data))
+            boundary = False
+        return cls(messages, proto=proto, name=name)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.parse(f.read(), name=path)
+
+
+class MemorySockBuff(striptls.TcpSockBuff):
+    ''' TcpSockBuff reading from a transcript instead of a socket.
+        recv() consumes the next transcript message if it was sent by
+        this peer, otherwise the peer looks closed.
+    '''
+    __slots__ = ('replay', 'side', 'closed')
+    
+    def __init__(self, replay, side, peer=None):
+        striptls.TcpSockBuff.__init__(self, None, peer=peer, bufsize=0)
+        self.replay = replay
+        self.side = side
+        self.socket = self      # close() goes to self
+        self.closed = False
+
+    def recv(self, buflen=8*1024, blocking=True):
+        self.recvbuf = memoryview(self.replay.next_message(self.side))
+        return self.recvbuf
+
+    def send(self, data):
+        self.replay.output.append((self.side, bytes(data)))
+        self._set_sndbuf(data)
+
+    sendall = send
+
+    def write(self, data, source=None):
+        self.send(data)
+
+    def ssl_wrap_socket(self, *args, **kwargs):
+        self.ssl_wrap_socket_with_context(None, *args, **kwargs)
+
+    def ssl_wrap_socket_with_context(self, ctx, *args, **kwargs):
+        self.socket_ssl = True
+        self.replay.output.append((self.side, None))
+
+    def pending(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+class Replay(object):
+    ''' One session: transcript -> Session -> RewriteDispatcher '''
+    TARGET = "replay"
+
+    def __init__(self, transcript, rewrite, port):
+        self.transcript = transcript
+        self.rewrite = rewrite
+        self.index = 0
+        self.output = []        # [(CLIENT|SERVER, bytes or None for tls),..] as sent to that peer
+        self.terminated = False
+        self.error = None
+        self.result = None
+        session_class = striptls.Session.bind_callbacks(mangle_client_data=rewrite.mangle_client_data,
+                                                        mangle_server_data=rewrite.mangle_server_data)
+        session_class.FTP_DATA_CHANNELS = False     # no sockets to relay data connections with
+        session = self.session = session_class(None, target=(self.TARGET, port))
+        session.inbound = MemorySockBuff(self, Transcript.CLIENT, peer=(self.TARGET, 0))
+        session.outbound = MemorySockBuff(self, Transcript.SERVER, peer=(self.TARGET, port))
+
+    def next_message(self, side):
+        if self.index < len(self.transcript.messages):
+            msg_side, data = self.transcript.messages[self.index]
+            if msg_side == side:
+                self.index += 1
+                return data
+        return b""
+
+    def run(self):
+        session = self.session
+        messages = self.transcript.messages
+        try:
+            while self.index < len(messages):
+                if messages[self.index][0] == Transcript.CLIENT:
+                    session.notify_read(session.inbound)
+                else:
+                    session.notify_read(session.outbound)
+        except striptls.SessionTerminatedException:
+            self.terminated = True
+        except Exception as e:
+            self.error = e
+        r = self.rewrite.get_result(session)
+        self.result = r.result if r else None
+        return self
+
+    def report(self):
+        lines = []
+        for side, data in self.output:
+            arrow = "=>" if side == Transcript.SERVER else "<="
+            lines.append("    %s %s"%(arrow, "[tls handshake]" if data is None else repr(data)))
+        if self.terminated:
+            lines.append("    -- terminated")
+        if self.error:
+            lines.append("    !! %r"%self.error)
+        return lines
+
+
+def replay(transcript, cls_proto, cls_vector):
+    ''' replay transcript against a single vector, returns the finished Replay '''
+    if not (striptls.Vectors._CA or striptls.Vectors._TLS_CONTEXT):
+        # handshakes are simulated, no certificate needed
+        striptls.Vectors._TLS_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    rewrite = striptls.RewriteDispatcher()
+    rewrite.add(cls_proto._PROTO_ID, cls_vector)
+    return Replay(transcript, rewrite, cls_proto._PROTO_ID).run()
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog replay [options] transcript [transcript ...]
+
+       example: %prog replay -x SMTP.StripFromCapabilities smtp_starttls.txt
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                  help="log proxy internals")
+    parser.add_option("-x", "--vectors", dest="vectors", default=None,
+                  help="Comma separated list of vectors (PROTO.Vector, PROTO.*) [default: all vectors of the transcripts P: protocol]")
+    parser.add_option("-p", "--plugin-dir", dest="plugin_dirs", action="append", default=[],
+                  help="load additional vector protocols from <PROTO>.py files in this directory (may be repeated)")
+    parser.add_option("-n", "--repeat", dest="repeat", default=1, type="int",
+                  help="replay every transcript/vector pair N times and report sessions per second [default: %default]")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False,
+                  help="only print results, not the mangled data")
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error("no transcript given")
+    level = logging.DEBUG if options.verbose else logging.WARNING
+    logging.getLogger().setLevel(level)
+    striptls.logger.setLevel(level)
+
+    registry = striptls.VectorRegistry(builtin=striptls.Vectors, plugin_dirs=options.plugin_dirs)
+    selected = options.vectors.split(",") if options.vectors else None
+    for path in args:
+        transcript = Transcript.load(path)
+        if selected:
+            names = registry.expand(s.strip() for s in selected)
+        elif transcript.proto:
+            names = registry.expand([transcript.proto])
+        else:
+            parser.error("%s: no P: line, select vectors with --vectors"%path)
+        for name in names:
+            cls_proto, cls_vector = registry.resolve(name)
+            if transcript.proto and transcript.proto != name.split(".")[0]:
+                continue
+            started = time.time()
+            for _ in range(options.repeat):
+                r = replay(transcript, cls_proto, cls_vector)
+            elapsed = time.time() - started
+            print("[%-11s] %s %s"%("Vulnerable!" if r.result else " ", path, name))
+            if not options.quiet:
+                print("\n".join(r.report()))
+            if options.repeat > 1:
+                print("    %d sessions in %.3fs (%.0f sessions/s)"%(options.repeat, elapsed, options.repeat/elapsed if elapsed else 0))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
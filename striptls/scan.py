@@ -0,0 +1,270 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Active STARTTLS scanner: probes servers instead of waiting for clients.
+
+For every host:port the protocol dialogue of Vectors.<PROTO>._SCAN is
+run (greeting, capability query, STARTTLS verb, tls handshake) and, on a
+second connection, the commands up to one that should need TLS. Targets are probed
+concurrently on asyncio, results are written as one JSON object per line
+in completion order:
+
+    {"target": "mx1.example.org:25", "protocol": "SMTP",
+     "advertised": true, "required": false, "plaintext_accepted": true,
+     "starttls": true, "tls": {"version": "TLSv1.3", ...}, "error": null, ...}
+'''
+import sys
+import re
+import ssl
+import time
+import json
+import socket
+import hashlib
+import asyncio
+import logging
+
+try:
+    from . import striptls
+except ImportError:
+    # python striptls (source folder)
+    import striptls
+
+logger = logging.getLogger(__name__)
+
+
+class ScanError(Exception):pass
+
+
+def get_protocol(port, name=None):
+    ''' Vectors protocol class by name or by well known port '''
+    if name:
+        cls_proto = getattr(striptls.Vectors, name.upper(), None)
+    else:
+        proto_id = striptls.ProtocolDetect.PORTMAP.get(port)
+        cls_proto = next((getattr(striptls.Vectors, n) for n in dir(striptls.Vectors)
+                          if getattr(getattr(striptls.Vectors, n), '_PROTO_ID', None) == proto_id), None) if proto_id else None
+    if not cls_proto or not hasattr(cls_proto, '_SCAN'):
+        return None
+    return cls_proto
+
+
+def parse_target(target, default_protocol=None):
+    ''' host:port[/PROTO], [ipv6]:port[/PROTO] -> (host, port, protocol name) '''
+    target, _, protocol = target.strip().partition("/")
+    host, port = target.rsplit(":", 1)
+    return host.strip("[]"), int(port), protocol or default_protocol
+
+
+class Probe(object):
+    ''' one target, one protocol dialogue per connection '''
+    MAX_REPLY = 64*1024
+
+    def __init__(self, host, port, cls_proto, timeout=10, context=None):
+        self.host = host
+        self.port = port
+        self.cls_proto = cls_proto
+        self.dialogue = cls_proto._SCAN
+        self.timeout = timeout
+        self.context = context
+        self.result = {'target': "%s:%d"%(host, port) if ":" not in host else "[%s]:%d"%(host, port),
+                       'protocol': cls_proto.__name__,
+                       'greeting': None,
+                       'advertised': None,          # STARTTLS announced in the capabilities
+                       'required': None,            # server insists on TLS
+                       'plaintext_accepted': None,  # a command that should need TLS worked without
+                       'starttls': None,            # STARTTLS verb accepted
+                       'tls': None,                 # handshake details
+                       'error': None,
+                       'elapsed': None}
+
+    def __repr__(self):
+        return "<Probe %s %s>"%(self.result['target'], self.result['protocol'])
+
+    def command(self, data):
+        return data.replace(b"%(host)s", self.host.encode("idna"))
+
+    async def read_until(self, reader, regex):
+        ''' reads until regex matches the data received so far '''
+        rex = re.compile(regex)
+        data = b""
+        while not rex.search(data):
+            chunk = await reader.read(4096)
+            if not chunk:
+                raise ScanError("connection closed, received %r"%data[-200:])
+            data += chunk
+            if len(data) > self.MAX_REPLY:
+                raise ScanError("reply too long")
+        return data
+
+    async def converse(self, reader, writer, step):
+        command, reply_end = step[:2]
+        writer.write(self.command(command))
+        await writer.drain()
+        return await self.read_until(reader, reply_end)
+
+    async def open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        greeting = b""
+        if self.dialogue['greeting']:
+            greeting = await self.read_until(reader, self.dialogue['greeting'])
+        return reader, writer, greeting
+
+    async def probe_starttls(self):
+        ''' greeting, capabilities, STARTTLS and the tls handshake '''
+        dialogue = self.dialogue
+        reader, writer, greeting = await self.open()
+        try:
+            self.result['greeting'] = greeting.decode("utf-8", "replace").strip()[:200] or None
+            capabilities = greeting
+            if dialogue['capabilities']:
+                capabilities += await self.converse(reader, writer, dialogue['capabilities'])
+            self.result['advertised'] = bool(re.search(dialogue['advertised'], capabilities))
+            if dialogue['required'] and re.search(dialogue['required'], capabilities):
+                self.result['required'] = True
+            reply = await self.converse(reader, writer, dialogue['starttls'])
+            self.result['starttls'] = bool(re.search(dialogue['starttls'][2], reply))
+            if self.result['starttls']:
+                await self.handshake(writer)
+        finally:
+            writer.close()
+
+    async def probe_plaintext(self):
+        ''' steps up to a command that should need tls (the last one), on its own connection '''
+        reader, writer, greeting = await self.open()
+        try:
+            for step in self.dialogue['plaintext']:
+                reply = await self.converse(reader, writer, step)
+                if self.dialogue['required'] and re.search(self.dialogue['required'], reply):
+                    self.result['required'] = True
+            self.result['plaintext_accepted'] = bool(re.search(step[2], reply))
+        finally:
+            writer.close()
+
+    async def handshake(self, writer):
+        loop = asyncio.get_event_loop()
+        transport = writer.transport
+        try:
+            transport = await loop.start_tls(transport, transport.get_protocol(), self.context,
+                                             server_hostname=self.host)
+        except (ssl.SSLError, ConnectionError) as e:
+            self.result['tls'] = {'error': repr(e)}
+            return
+        sslobj = transport.get_extra_info('ssl_object')
+        der = sslobj.getpeercert(binary_form=True)
+        self.result['tls'] = {'version': sslobj.version(),
+                              'cipher': sslobj.cipher()[0],
+                              'certificate_sha256': hashlib.sha256(der).hexdigest() if der else None}
+        transport.close()
+
+    async def run(self):
+        started = time.time()
+        probes = [asyncio.ensure_future(self.probe_starttls())]
+        if self.dialogue['plaintext']:
+            probes.append(asyncio.ensure_future(self.probe_plaintext()))
+        try:
+            done, pending = await asyncio.wait(probes, timeout=self.timeout, return_when=asyncio.FIRST_EXCEPTION)
+            for probe in probes:
+                if probe in done:
+                    probe.result()      # raises the probe's error
+            if pending:
+                raise asyncio.TimeoutError()
+        except asyncio.TimeoutError:
+            self.result['error'] = "timeout after %ss"%self.timeout
+        except (ScanError, socket.error, ssl.SSLError, UnicodeError) as e:
+            self.result['error'] = repr(e)
+        finally:
+            # a failed or timed out probe must not leave its sibling running on self.result
+            for probe in probes:
+                probe.cancel()
+            await asyncio.gather(*probes, return_exceptions=True)
+        if self.result['required'] is None and self.result['error'] is None:
+            self.result['required'] = False
+        self.result['elapsed'] = round(time.time()-started, 3)
+        return self.result
+
+
+async def scan(targets, out, concurrency=64, timeout=10, protocol=None):
+    ''' probes targets ((host, port, protocol name),..) with at most concurrency
+        targets in flight, writes JSONL to out. returns the number of results
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    targets = iter(targets)
+    written = [0]
+
+    def emit(result):
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        written[0] += 1
+
+    async def worker():
+        for host, port, name in targets:
+            cls_proto = get_protocol(port, name or protocol)
+            if not cls_proto:
+                emit({'target': "%s:%d"%(host, port), 'protocol': name or protocol,
+                      'error': "unknown protocol, use host:port/PROTO or --protocol"})
+                continue
+            result = await Probe(host, port, cls_proto, timeout=timeout, context=context).run()
+            logger.info("%s %s advertised=%s starttls=%s error=%s"%(result['target'], result['protocol'],
+                                                                  result['advertised'], result['starttls'],
+                                                                  result['error']))
+            emit(result)
+
+    # workers share the target iterator, targets are read as they are needed
+    await asyncio.gather(*[worker() for _ in range(max(concurrency, 1))])
+    return written[0]
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog scan [options] host:port[/PROTO] ...
+
+       example: %prog scan -c 200 -o results.jsonl mx1.example.org:25 imap.example.org:143 chat.example.org:5222
+                %prog scan -i targets.txt -P SMTP
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-i", "--input", dest="input",
+                  help="file with one host:port[/PROTO] per line, - for stdin")
+    parser.add_option("-o", "--output", dest="output", default="-",
+                  help="JSONL output file [default: stdout]")
+    parser.add_option("-c", "--concurrency", dest="concurrency", default=64, type="int",
+                  help="targets probed in parallel [default: %default]")
+    parser.add_option("-t", "--timeout", dest="timeout", default=10, type="float",
+                  help="seconds per target [default: %default]")
+    parser.add_option("-P", "--protocol", dest="protocol",
+                  help="protocol for targets without /PROTO, instead of the port default (SMTP, POP3, IMAP, FTP, NNTP, XMPP, ACAP, IRC)")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                  help="log every result to stderr")
+    (options, args) = parser.parse_args(argv)
+    if not hasattr(asyncio, 'run'):
+        parser.error("scan needs python 3.7+ (asyncio start_tls)")
+    lines = list(args)
+    if options.input:
+        f = sys.stdin if options.input == "-" else open(options.input)
+        lines.extend(l for l in f.read().splitlines() if l.strip() and not l.startswith("#"))
+    if not lines:
+        parser.error("no targets given")
+    try:
+        targets = [parse_target(l) for l in lines]
+    except ValueError as e:
+        parser.error("invalid target: %s"%e)
+    logging.basicConfig(format='%(asctime)-15s - %(levelname)-8s - %(message)s')
+    logging.getLogger().setLevel(logging.WARNING)
+    striptls.logger.setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO if options.verbose else logging.WARNING)
+
+    out = sys.stdout if options.output == "-" else open(options.output, "w")
+    started = time.time()
+    try:
+        count = asyncio.run(scan(targets, out, concurrency=options.concurrency, timeout=options.timeout,
+                                 protocol=options.protocol))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("[*] %d targets in %.1fs\n"%(count, time.time()-started))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
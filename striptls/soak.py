@@ -0,0 +1,296 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Soak test: runs the proxy against locally generated SMTP traffic and
+samples memory allocated by striptls (tracemalloc), open file descriptors
+and live sessions at intervals.
+
+Traffic (an SMTP server and clients) runs in a child process, only the
+proxy is measured. After the warmup, memory and fds are fitted against
+live sessions and completed sessions:
+
+    usage = base + per_live * live + per_session * completed
+
+per_session is the growth that live connections do not explain, it is
+reported per 1000 sessions and fails the run if it exceeds the limits.
+'''
+import sys
+import os
+import ssl
+import time
+import socket
+import smtplib
+import logging
+import threading
+import tracemalloc
+import multiprocessing
+
+try:
+    from . import striptls
+except ImportError:
+    # python striptls (source folder)
+    import striptls
+
+logger = logging.getLogger(__name__)
+
+
+def serve_smtp(listener, context=None):
+    ''' minimal SMTP server, one thread per connection, STARTTLS if context '''
+    def handle(sock):
+        f = sock.makefile('rb')
+        def reply(line):
+            sock.sendall(line + b"\r\n")
+        try:
+            reply(b"220 soak.local ESMTP")
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                cmd = line[:4].upper()
+                if cmd in (b"EHLO", b"HELO"):
+                    reply(b"250-soak.local\r\n250-STARTTLS\r\n250 8BITMIME" if context else b"250 soak.local")
+                elif cmd == b"STAR" and context:
+                    reply(b"220 go ahead")
+                    sock = context.wrap_socket(sock, server_side=True)
+                    f = sock.makefile('rb')
+                elif cmd == b"DATA":
+                    reply(b"354 end with .")
+                    while f.readline() not in (b".\r\n", b""):
+                        pass
+                    reply(b"250 queued")
+                elif cmd == b"QUIT":
+                    reply(b"221 bye")
+                    break
+                else:
+                    reply(b"250 ok")
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+    while True:
+        sock, _ = listener.accept()
+        t = threading.Thread(target=handle, args=(sock,))
+        t.daemon = True
+        t.start()
+
+
+def generate(proxy, listener, certfile, clients, duration, size):
+    ''' child process: upstream server plus clients sending mail through the proxy '''
+    context = None
+    if certfile:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile)
+    t = threading.Thread(target=serve_smtp, args=(listener, context))
+    t.daemon = True
+    t.start()
+    stop = time.time() + duration
+    body = b"Subject: soak\r\n\r\n" + b"x"*size
+    def client(n):
+        ctx = ssl._create_unverified_context()
+        while time.time() < stop:
+            try:
+                s = smtplib.SMTP(proxy[0], proxy[1], timeout=10)
+                s.ehlo("soak%d.local"%n)
+                if s.has_extn("starttls"):
+                    s.starttls(context=ctx)
+                    s.ehlo("soak%d.local"%n)
+                s.sendmail("a@soak.local", ["b@soak.local"], body)
+                s.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            # vary the number of live sessions, see fit()
+            time.sleep((n % 4) * 0.01)
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def count_fds():
+    ''' open file descriptors of this process, None if not available '''
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def fit(samples, key):
+    ''' least squares fit of key ~ base + per_live*live + per_session*sessions,
+        returns (per_live, per_session). per_live is dropped if live did not vary.
+    '''
+    rows = [(1.0, float(s['live']), float(s['sessions']), float(s[key])) for s in samples]
+    live = [r[1] for r in rows]
+    if max(live) == min(live):
+        rows = [(r[0], r[2], r[3]) for r in rows]
+    n = len(rows[0]) - 1
+    # normal equations, gaussian elimination
+    a = [[sum(r[i]*r[j] for r in rows) for j in range(n)] + [sum(r[i]*r[n] for r in rows)] for i in range(n)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda k: abs(a[k][i]))
+        a[i], a[pivot] = a[pivot], a[i]
+        if not a[i][i]:
+            return 0.0, 0.0
+        for k in range(n):
+            if k != i:
+                factor = a[k][i]/a[i][i]
+                a[k] = [x - factor*y for x, y in zip(a[k], a[i])]
+    coef = [a[i][n]/a[i][i] for i in range(n)]
+    if n == 2:
+        return 0.0, coef[1]
+    return coef[1], coef[2]
+
+
+class Soak(object):
+    ''' proxy under generated load, sampled every interval seconds '''
+
+    def __init__(self, vectors, duration=60, interval=2, warmup=10, clients=8, size=1024,
+                 certfile=None, tls_workers=0):
+        self.duration = duration
+        self.interval = interval
+        self.warmup = warmup
+        self.clients = clients
+        self.size = size
+        self.certfile = certfile
+        self.sessions = 0       # terminated sessions
+        self.samples = []       # {elapsed, sessions, live, memory, fds}
+        self.rewrite = striptls.RewriteDispatcher()
+        self.rewrite.set_vectors(vectors)
+        self.upstream = socket.socket()
+        self.upstream.bind(("127.0.0.1", 0))
+        self.upstream.listen(128)
+        # random port, the proxy has to know it is SMTP
+        striptls.ProtocolDetect.PORTMAP[self.upstream.getsockname()[1]] = striptls.ProtocolDetect.PROTO_SMTP
+        self.proxy = striptls.ProxyServer(listen=("127.0.0.1", 0), target=self.upstream.getsockname(),
+                                          buffer_size=4096, delay=0.00001, tls_workers=tls_workers)
+        self.proxy.set_callback("mangle_server_data", self.rewrite.mangle_server_data)
+        self.proxy.set_callback("mangle_client_data", self.rewrite.mangle_client_data)
+        self.proxy.set_callback("on_terminated", self.on_terminated)
+        self.filters = [tracemalloc.Filter(True, os.path.join(os.path.dirname(os.path.abspath(striptls.__file__)), "*"))]
+
+    def on_terminated(self, session):
+        self.rewrite.release(session)
+        self.sessions += 1
+
+    def sample(self, started):
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        s = {'elapsed': time.time()-started,
+             'sessions': self.sessions,
+             'live': self.proxy.admission.active,
+             'memory': sum(stat.size for stat in snapshot.statistics('filename')),
+             'fds': count_fds()}
+        self.samples.append(s)
+        logger.info("%(elapsed)6.1fs sessions=%(sessions)d live=%(live)d memory=%(memory)d fds=%(fds)s"%s)
+        return s
+
+    def _sampler(self, started, child):
+        while child.is_alive():
+            time.sleep(self.interval)
+            self.sample(started)
+        self.proxy.stop()
+
+    def run(self):
+        ctx = multiprocessing.get_context("fork")
+        child = ctx.Process(target=generate, args=(self.proxy.inbound.getsockname(), self.upstream, self.certfile,
+                                                   self.clients, self.duration, self.size))
+        child.start()
+        self.upstream.close()
+        tracemalloc.start()
+        try:
+            started = time.time()
+            sampler = threading.Thread(target=self._sampler, args=(started, child))
+            sampler.daemon = True
+            sampler.start()
+            self.proxy.main_loop()
+            sampler.join()
+            # drained, nothing is live anymore
+            self.sample(started)
+        finally:
+            tracemalloc.stop()
+            child.join()
+            self.proxy.inbound.close()
+        return self
+
+    def analyze(self):
+        ''' {memory|fds: (per live session, per 1000 sessions)} over the samples after the warmup '''
+        samples = [s for s in self.samples if s['elapsed'] >= self.warmup]
+        growth = {}
+        if len(samples) < 3:
+            return growth
+        for key in ('memory', 'fds'):
+            if samples[0][key] is None:
+                continue
+            per_live, per_session = fit(samples, key)
+            growth[key] = (per_live, per_session*1000)
+        return growth
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog soak [options]
+
+       example: %prog soak -d 300 -c 16 -x SMTP.StripFromCapabilities
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-d", "--duration", dest="duration", default=60, type="float",
+                  help="seconds of generated traffic [default: %default]")
+    parser.add_option("-i", "--interval", dest="interval", default=2, type="float",
+                  help="seconds between samples [default: %default]")
+    parser.add_option("-w", "--warmup", dest="warmup", default=10, type="float",
+                  help="seconds before samples are analyzed (caches, pools) [default: %default]")
+    parser.add_option("-c", "--clients", dest="clients", default=8, type="int",
+                  help="concurrent clients [default: %default]")
+    parser.add_option("-s", "--size", dest="size", default=1024, type="int",
+                  help="mail body size [default: %default]")
+    parser.add_option("-x", "--vectors", dest="vectors", default="SMTP.StripFromCapabilities,SMTP.StripWithError",
+                  help="Comma separated list of SMTP vectors [default: %default]")
+    parser.add_option("-k", "--key", dest="key",
+                  help="certificate and key (PEM), enables STARTTLS upstream and tls vectors (UntrustedIntercept)")
+    parser.add_option("--tls-workers", dest="tls_workers", default=0, type="int",
+                  help="process tls sessions on N worker threads [default: %default]")
+    parser.add_option("--max-memory", dest="max_memory", default=32*1024, type="int",
+                  help="fail if memory grows more than this many bytes per 1000 sessions [default: %default]")
+    parser.add_option("--max-fds", dest="max_fds", default=1, type="float",
+                  help="fail if open fds grow more than this per 1000 sessions [default: %default]")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                  help="log proxy internals")
+    (options, args) = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)-15s - %(levelname)-8s - %(message)s')
+    logger.setLevel(logging.INFO)
+    level = logging.DEBUG if options.verbose else logging.ERROR
+    logging.getLogger().setLevel(level)
+    striptls.logger.setLevel(level)
+
+    if options.key:
+        striptls.Vectors._TLS_CERTFILE = striptls.Vectors._TLS_KEYFILE = options.key
+    registry = striptls.VectorRegistry(builtin=striptls.Vectors)
+    vectors = {}
+    for name in registry.expand(v.strip() for v in options.vectors.split(",")):
+        cls_proto, cls_vector = registry.resolve(name)
+        vectors.setdefault(cls_proto._PROTO_ID, set()).add(cls_vector)
+        if getattr(cls_vector, '_TLS', False) and not options.key:
+            parser.error("%s needs --key"%name)
+    soak = Soak(vectors, duration=options.duration, interval=options.interval, warmup=options.warmup,
+                clients=options.clients, size=options.size, certfile=options.key, tls_workers=options.tls_workers)
+    soak.run()
+    growth = soak.analyze()
+    print("[*] %d sessions in %.0fs"%(soak.sessions, soak.samples[-1]['elapsed'] if soak.samples else 0))
+    if not growth:
+        print("[!] not enough samples after the warmup, increase --duration")
+        return 2
+    ret = 0
+    for key, limit, unit in (('memory', options.max_memory, "bytes"), ('fds', options.max_fds, "fds")):
+        if key not in growth:
+            print("    %-7s not available"%key)
+            continue
+        per_live, per_1k = growth[key]
+        failed = per_1k > limit
+        ret |= failed
+        print("    %-7s %10.1f %s per live session, %10.1f %s per 1000 sessions (limit %s) %s"%(key, per_live, unit, per_1k,
+                                                                                           unit, limit,
+                                                                                           "FAIL" if failed else "ok"))
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
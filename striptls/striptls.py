@@ -12,71 +12,499 @@ import select
 import ssl
 import time
 import re
+import threading
+import collections
+import itertools
+import queue
+import os
+import signal
+import array
+import struct
+import json
+import errno
+import hashlib
+import mmap
+import tempfile
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)-8s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class SessionTerminatedException(Exception):pass
 class ProtocolViolationException(Exception):pass
+class FramingError(ProtocolViolationException):pass
+
+class MemoryBudget(object):
+    ''' Bytes of relayed data held in memory by SpillBuffers. reserve()
+        fails once this budget or its parent is used up (a session budget
+        and the budget shared by all sessions), the data is spilled to disk.
+        
+        @param limit: bytes, 0 = unlimited
+        @param parent: MemoryBudget charged as well
+    '''
+    __slots__ = ('limit', 'parent', 'used', 'spilled', 'files', 'lock')
+    
+    def __init__(self, limit=0, parent=None):
+        self.limit = limit
+        self.parent = parent
+        self.used = 0
+        self.spilled = 0        # bytes written to spill files
+        self.files = 0          # spill files open
+        self.lock = threading.Lock()    # sessions run on tls workers too
+    
+    def __repr__(self):
+        return "<MemoryBudget used=%d limit=%d spilled=%d files=%d>"%(self.used, self.limit, self.spilled, self.files)
+    
+    def reserve(self, nbytes):
+        with self.lock:
+            if self.limit and self.used + nbytes > self.limit:
+                return False
+            if self.parent and not self.parent.reserve(nbytes):
+                return False
+            self.used += nbytes
+            return True
+    
+    def release(self, nbytes):
+        with self.lock:
+            self.used -= nbytes
+        if self.parent:
+            self.parent.release(nbytes)
+    
+    def count(self, spilled=0, files=0):
+        with self.lock:
+            self.spilled += spilled
+            self.files += files
+        if self.parent:
+            self.parent.count(spilled, files)
+
+class SpillBuffer(object):
+    ''' FIFO byte queue, kept in memory as long as the budget allows and
+        appended to a memory mapped temporary file beyond that. Data in the
+        file is always newer than data in memory: once something is spilled
+        everything goes to the file until it was read back, so peek() and
+        consume() see the bytes in the order they were appended.
+    '''
+    __slots__ = ('budget', 'chunks', 'buffered', 'file', 'map', 'rpos', 'wpos')
+    CHUNK = 64*1024             # max bytes peek() returns from the file
+    MIN_FILE_SIZE = 1024*1024
+    DIR = None                  # spill file directory, see --spill-dir
+    
+    def __init__(self, budget):
+        self.budget = budget
+        self.chunks = collections.deque()   # memoryviews
+        self.buffered = 0       # bytes in chunks
+        self.file = None
+        self.map = None
+        self.rpos = 0           # file data is map[rpos:wpos]
+        self.wpos = 0
+    
+    def __len__(self):
+        return self.buffered + self.wpos - self.rpos
+    
+    def __repr__(self):
+        return "<SpillBuffer memory=%d file=%d>"%(self.buffered, self.wpos - self.rpos)
+    
+    def append(self, data):
+        nbytes = len(data)
+        if self.wpos == self.rpos and self.budget.reserve(nbytes):
+            self.chunks.append(memoryview(bytes(data)))
+            self.buffered += nbytes
+            return
+        self._spill(data)
+    
+    def _spill(self, data):
+        nbytes = len(data)
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="striptls-spill-", dir=self.DIR)
+            self.budget.count(files=1)
+        size = len(self.map) if self.map else 0
+        if self.wpos + nbytes > size and self.rpos:
+            # move what is left to the front before growing
+            self.map.move(0, self.rpos, self.wpos - self.rpos)
+            self.wpos -= self.rpos
+            self.rpos = 0
+        if self.wpos + nbytes > size:
+            size = max(size*2, self.wpos + nbytes, self.MIN_FILE_SIZE)
+            if self.map:
+                self.map.close()
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+        self.map[self.wpos:self.wpos + nbytes] = data
+        self.wpos += nbytes
+        self.budget.count(spilled=nbytes)
+    
+    def peek(self, nbytes):
+        ''' up to nbytes from the head of the queue '''
+        if self.chunks:
+            return self.chunks[0][:nbytes]
+        return self.map[self.rpos:min(self.wpos, self.rpos + nbytes)]
+    
+    def consume(self, nbytes):
+        ''' drops nbytes from the head of the queue '''
+        released = 0
+        while nbytes and self.chunks:
+            head = self.chunks[0]
+            if nbytes < len(head):
+                self.chunks[0] = head[nbytes:]
+                released += nbytes
+                nbytes = 0
+                break
+            self.chunks.popleft()
+            released += len(head)
+            nbytes -= len(head)
+        if released:
+            self.buffered -= released
+            self.budget.release(released)
+        self.rpos += nbytes
+        if self.map and self.rpos == self.wpos:
+            # drained, new data goes to memory again, give the disk space back
+            self.rpos = self.wpos = 0
+            self.map.close()
+            self.map = None
+            self.file.truncate(0)
+    
+    def close(self):
+        if self.buffered:
+            self.budget.release(self.buffered)
+        self.chunks.clear()
+        self.buffered = 0
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.budget.count(files=-1)
+        self.rpos = self.wpos = 0
 
 class TcpSockBuff(object):
-    ''' Wrapped Tcp Socket with access to last sent/received data '''
-    def __init__(self, sock, peer=None):
+    ''' Wrapped Tcp Socket with access to last sent/received data
+
+        reads go to a per-socket bytearray via recv_into(), allocated on
+        first use (bufsize preallocates), recvbuf/sndbuf are memoryviews of
+        the last received/sent message.
+        reads alternate between two buffers, a recvbuf stays valid across
+        one further recv() (e.g. a vector waiting for a reply while the
+        current message is still being processed).
+        write() queues data until flush() sends all fragments with one
+        sendmsg() (one tls record), sendall() flushes the queue first.
+        relayed views of the source's receive buffers are queued without a
+        copy; the source copies them out only if it reads into that buffer
+        again before they were flushed (see lent).
+        with a memory budget (see Session.MEMORY) flush(blocking=False)
+        only sends what the peer takes without blocking and keeps the rest
+        in backlog, a SpillBuffer, which the proxy sends once the socket is
+        writable again.
+        with KTLS the kernel takes over tls after the handshake (linux tls
+        module, python 3.12+): ssl reads/writes are plain syscalls and the
+        socket can be spliced, see splice_to(). Otherwise tls stays in user
+        space.
+    '''
+    __slots__ = ('socket', 'socket_ssl', 'fd', '_rbuf', '_rbuf_next', '_sbuf', 'recvbuf', 'sndbuf', 'peer', 'trace',
+                 '_wq', 'rsize', 'ktls', 'hello', 'memory', 'backlog', 'received', 'lent', 'tls_error')
+    _EMPTY = memoryview(bytearray(0))
+    IOV_MAX = 1024
+    TLS_RECORD = 16*1024        # bytes per non blocking tls send, retries send the same bytes
+    KTLS = False                # request kernel tls for wrapped sockets, see --ktls
+    OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 0)
+    SOL_TLS = getattr(socket, "SOL_TLS", 282)
+    TLS_TX = 1
+    TLS_RX = 2
+    TCP_ULP = getattr(socket, "TCP_ULP", 31)
+    CLIENTHELLO = False         # keep the JA3 of intercepted clients in hello, see --fingerprint
+    
+    def __init__(self, sock, peer=None, bufsize=0, memory=None):
         self.socket = None
         self.socket_ssl = None
-        self.recvbuf = ''
-        self.sndbuf = ''
+        self.fd = -1
+        self._rbuf = memoryview(bytearray(bufsize)) if bufsize else self._EMPTY
+        self._rbuf_next = memoryview(bytearray(bufsize)) if bufsize else self._EMPTY
+        self._sbuf = memoryview(bytearray(bufsize)) if bufsize else self._EMPTY
+        self.recvbuf = self._rbuf[:0] if bufsize else self._EMPTY
+        self.sndbuf = self._sbuf[:0] if bufsize else self._EMPTY
         self.peer = peer
+        self.trace = None       # Session.trace of a traced session
+        self._wq = None         # fragments queued by write()
+        self.rsize = 0          # adaptive recv size, see Session.on_recv
+        self.ktls = (False, False)  # (send, recv) done by the kernel
+        self.hello = None       # JA3 of the tls ClientHello, server side
+        self.memory = memory    # MemoryBudget of the session, None = blocking flush()
+        self.backlog = None     # SpillBuffer, data the peer did not take yet
+        self.received = 0       # bytes read, see Session.process()
+        self.lent = None        # TcpSockBuff that queued views of our receive buffers, see write()
+        self.tls_error = None   # ssl.SSLError of a failed handshake with this peer
         self._init(sock)
         
     def _init(self, sock):
         self.socket = sock
+        self.fd = sock.fileno() if sock else -1
+    
+    def fileno(self):
+        # stays valid for select() and as a dict key even after tls wrapping/close
+        return self.fd
+    
+    def pending(self):
+        ''' decrypted bytes buffered by the tls layer, invisible to select() '''
+        return self.socket_ssl.pending() if self.socket_ssl else 0
         
     def connect(self, target):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        return self.socket.connect(target)
+        family, socktype, proto, _, addr = socket.getaddrinfo(target[0], target[1], 0, socket.SOCK_STREAM)[0]
+        self._init(socket.socket(family, socktype, proto))
+        return self.socket.connect(addr)
     
     def accept(self):
         return self.socket.accept()
                 
-    def recv(self, buflen=8*1024):
+    def recv(self, buflen=8*1024, blocking=True):
+        ''' returns a view of the received data, None if a non blocking tls
+            read found no application data (e.g. tls 1.3 session tickets)
+        '''
+        if (self._wq or self.backlog) and blocking:
+            # the peer may be waiting for what is queued
+            self.flush()
+        if blocking and self.trace:
+            # vectors waiting for a peer
+            with self.trace("recv", peer=str(self.peer)):
+                return self._recv(buflen, blocking)
+        return self._recv(buflen, blocking)
+    
+    def _recv(self, buflen, blocking):
+        self._rbuf, self._rbuf_next = self._rbuf_next, self._rbuf
+        if buflen > len(self._rbuf):
+            self._rbuf = memoryview(bytearray(buflen))
+        elif self.lent is not None:
+            # read two messages since it was queued, not flushed yet
+            self.lent.own(self._rbuf.obj)
         if self.socket_ssl:
-            self.recvbuf = self.socket_ssl.read(buflen)
+            if not blocking:
+                self.socket_ssl.setblocking(False)
+            try:
+                nbytes = self.socket_ssl.recv_into(self._rbuf, buflen)
+            except ssl.SSLWantReadError:
+                return None
+            finally:
+                if not blocking:
+                    self.socket_ssl.setblocking(True)
         else:
-            self.recvbuf = self.socket.recv(buflen)
+            nbytes = self.socket.recv_into(self._rbuf, buflen)
+        self.received += nbytes
+        self.recvbuf = self._rbuf[:nbytes]
         return self.recvbuf
     
+    def _set_sndbuf(self, data):
+        if isinstance(data, bytes):
+            # immutable, keeping a reference is enough
+            self.sndbuf = memoryview(data)
+            return
+        # views into a peers recv buffer are overwritten by its next recv(); keep a copy
+        nbytes = len(data)
+        if nbytes > len(self._sbuf):
+            self._sbuf = memoryview(bytearray(nbytes))
+        self._sbuf[:nbytes] = data
+        self.sndbuf = self._sbuf[:nbytes]
+    
     def send(self, data):
+        if self.backlog:
+            self.flush()
         if self.socket_ssl:
-            self.socket_ssl.write(data)
+            self.socket_ssl.sendall(data)
         else:
             self.socket.send(data)
-        self.sndbuf = data
+        self._set_sndbuf(data)
         
     def sendall(self, data):
+        if self._wq or self.backlog:
+            self.flush()
         if self.socket_ssl:
             self.send(data)
         else:
             self.socket.sendall(data)
-        self.sndbuf = data
+            self._set_sndbuf(data)
+    
+    def write(self, data, source=None):
+        ''' queue data for the next flush(). a view into the receive buffers of
+            source is queued as is, source copies it before it reuses the buffer
+        '''
+        if isinstance(data, memoryview) and source is not None:
+            source.lent = self
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        if self._wq is None:
+            self._wq = [data]
+        else:
+            self._wq.append(data)
+        self.sndbuf = data if isinstance(data, memoryview) else memoryview(data)
+    
+    def own(self, buf):
+        ''' copies queued views of buf, its owner is about to read into it '''
+        wq = self._wq
+        if wq:
+            for i, f in enumerate(wq):
+                if isinstance(f, memoryview) and f.obj is buf:
+                    wq[i] = bytes(f)
+    
+    def flush(self, blocking=True):
+        ''' send all queued fragments, one syscall (and segment) for small messages.
+            blocking=False with a memory budget leaves what the peer does not
+            take now in backlog
+        '''
+        wq = self._wq
+        if self.backlog:
+            # behind what is already waiting
+            self._wq = None
+            for f in wq or ():
+                self.backlog.append(f)
+            return self.flush_backlog(blocking)
+        if not wq:
+            return
+        self._wq = None
+        if not blocking and self.memory:
+            return self._flush_nowait(wq)
+        if self.socket_ssl:
+            # one tls record instead of one per fragment
+            self.socket_ssl.sendall(wq[0] if len(wq)==1 else b"".join(wq))
+            return
+        if len(wq)==1:
+            self.socket.sendall(wq[0])
+            return
+        wq = [memoryview(f) for f in wq]
+        while wq:
+            nbytes = self.socket.sendmsg(wq[:self.IOV_MAX])
+            # drop what was sent, partial sends continue with the rest
+            while wq and nbytes >= len(wq[0]):
+                nbytes -= len(wq.pop(0))
+            if nbytes:
+                wq[0] = wq[0][nbytes:]
+    
+    def _flush_nowait(self, wq):
+        if self.socket_ssl:
+            wq = [memoryview(wq[0] if len(wq)==1 else b"".join(wq))]
+        else:
+            wq = [memoryview(f) for f in wq]
+        while wq:
+            nbytes = self._send_nowait(wq)
+            if not nbytes:
+                break
+            while wq and nbytes >= len(wq[0]):
+                nbytes -= len(wq.pop(0))
+            if nbytes:
+                wq[0] = wq[0][nbytes:]
+        if wq:
+            self.backlog = SpillBuffer(self.memory)
+            for f in wq:
+                self.backlog.append(f)
+    
+    def _send_nowait(self, buffers):
+        ''' bytes the peer took without blocking, 0 if it takes nothing now '''
+        try:
+            if not self.socket_ssl:
+                return self.socket.sendmsg(buffers[:self.IOV_MAX], (), socket.MSG_DONTWAIT)
+            # a tls write that would block has to be retried with the same bytes,
+            # they stay at the head of backlog
+            self.socket_ssl.setblocking(False)
+            try:
+                return self.socket_ssl.send(buffers[0][:self.TLS_RECORD])
+            finally:
+                self.socket_ssl.setblocking(True)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            return 0
+    
+    def flush_backlog(self, blocking=False):
+        ''' sends backlog, without blocking only what the peer takes now '''
+        backlog = self.backlog
+        while backlog:
+            data = backlog.peek(self.TLS_RECORD if self.socket_ssl else SpillBuffer.CHUNK)
+            if blocking:
+                self.socket.sendall(data)
+                nbytes = len(data)
+            else:
+                nbytes = self._send_nowait([data])
+                if not nbytes:
+                    return
+            backlog.consume(nbytes)
+        self.drop_backlog()
+    
+    def drop_backlog(self):
+        if self.backlog is not None:
+            self.backlog.close()
+        self.backlog = None
         
     def ssl_wrap_socket(self, *args, **kwargs):
-        if len(args)>=1:
-            args[1] = self.socket
-        if 'sock' in kwargs:
-            kwargs['sock'] = self.socket
-        if not args and not kwargs.get('sock'):
-            kwargs['sock'] = self.socket
-        self.socket_ssl = ssl.wrap_socket(*args, **kwargs)
+        ''' outbound tls, server certificate is not verified '''
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        self.ssl_wrap_socket_with_context(ctx, *args, **kwargs)
     
     def ssl_wrap_socket_with_context(self, ctx, *args, **kwargs):
-        if len(args)>=1:
-            args[1] = self.socket
-        if 'sock' in kwargs:
-            kwargs['sock'] = self.socket
-        if not args and not kwargs.get('sock'):
-            kwargs['sock'] = self.socket
-        self.socket_ssl = ctx.wrap_socket(*args, **kwargs)
+        # wrap_socket() detaches the plain socket, the fd stays the same
+        if self._wq or self.backlog:
+            self.flush()
+        if self.KTLS and not ctx.options & self.OP_ENABLE_KTLS:
+            ctx.options |= self.OP_ENABLE_KTLS
+        if self.CLIENTHELLO and kwargs.get('server_side'):
+            self.hello = ClientFingerprint.ja3(self.peek_clienthello())
+        with self.trace("tls handshake", peer=str(self.peer), server_side=kwargs.get('server_side', False)) if self.trace else Tracer.NULL:
+            try:
+                self.socket_ssl = ctx.wrap_socket(self.socket, *args, **kwargs)
+            except ssl.SSLError as e:
+                self.tls_error = e
+                raise
+        self.socket = self.socket_ssl
+        if self.KTLS:
+            # openssl falls back to user space silently (kernel, cipher, openssl build)
+            self.ktls = (self._has_ktls(self.TLS_TX), self._has_ktls(self.TLS_RX))
+            logger.debug("%s kernel tls send=%s recv=%s"%(self.peer, self.ktls[0], self.ktls[1]))
+    
+    def peek_clienthello(self):
+        ''' the first tls record sent by the client, left in the socket for the handshake.
+            empty if the record did not arrive in one piece (no fingerprint then).
+        '''
+        # the handshake blocks on the same bytes, so waiting for the first ones costs nothing
+        data = self.socket.recv(16*1024, socket.MSG_PEEK)
+        if len(data) < 5 or len(data) < 5 + struct.unpack("!H", data[3:5])[0]:
+            return b""
+        return data
+    
+    def _has_ktls(self, direction):
+        try:
+            self.socket_ssl.getsockopt(self.SOL_TLS, direction, 64)
+            return True
+        except OSError:
+            return False
+    
+    def splice_to(self, dst, pipe, nbytes):
+        ''' moves up to nbytes to dst without copying them to user space,
+            returns the number of bytes moved, 0 on eof. with tls both
+            sockets have to be kernel tls (recv on self, send on dst).
+        '''
+        pipe_r, pipe_w = pipe
+        nbytes = os.splice(self.fd, pipe_w, nbytes, flags=os.SPLICE_F_MOVE)
+        pending = nbytes
+        while pending:
+            pending -= os.splice(pipe_r, dst.fd, pending, flags=os.SPLICE_F_MOVE)
+        return nbytes
+    
+    @classmethod
+    def ktls_unavailable(cls):
+        ''' reason why kernel tls cannot be used here, None if it can '''
+        if not cls.OP_ENABLE_KTLS:
+            return "python %d.%d has no ssl.OP_ENABLE_KTLS (3.12+)"%sys.version_info[:2]
+        if not hasattr(os, "splice"):
+            return "no os.splice (linux, python 3.10+)"
+        listener = socket.socket()
+        try:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            s = socket.create_connection(listener.getsockname())
+            try:
+                s.setsockopt(socket.IPPROTO_TCP, cls.TCP_ULP, b"tls")
+            except OSError as e:
+                return "kernel tls module not available (%s)"%e.strerror
+            finally:
+                s.close()
+        finally:
+            listener.close()
+        return None
         
 class ProtocolDetect(object):
     PROTO_SMTP = 25
@@ -87,6 +515,9 @@ class ProtocolDetect(object):
     PROTO_NNTP = 119
     PROTO_IRC = 6667
     PROTO_ACAP = 675
+    PROTO_LDAP = 389
+    PROTO_PGSQL = 5432
+    PROTO_MYSQL = 3306
     
     PORTMAP = {25:  PROTO_SMTP,
                5222:PROTO_XMPP,
@@ -95,18 +526,26 @@ class ProtocolDetect(object):
                21: PROTO_FTP,
                119: PROTO_NNTP,
                6667: PROTO_IRC,
-               675: PROTO_ACAP
+               675: PROTO_ACAP,
+               389: PROTO_LDAP,
+               5432: PROTO_PGSQL,
+               3306: PROTO_MYSQL
                }
     
-    KEYWORDS = ((['ehlo', 'helo','starttls','rcpt to:','mail from:'], PROTO_SMTP),
-                (['xmpp'], PROTO_XMPP),
-                (['. capability'], PROTO_IMAP),
-                (['auth tls'], PROTO_FTP)
+    KEYWORDS = (([b'ehlo', b'helo',b'starttls',b'rcpt to:',b'mail from:'], PROTO_SMTP),
+                ([b'xmpp'], PROTO_XMPP),
+                ([b'. capability'], PROTO_IMAP),
+                ([b'auth tls'], PROTO_FTP),
+                ([b'1.3.6.1.4.1.1466.20037'], PROTO_LDAP),                      # StartTLS extended request
+                ([b'\x00\x00\x00\x08\x04\xd2\x16\x2f'], PROTO_PGSQL),        # SSLRequest
+                ([b'mysql_native_password', b'caching_sha2_password'], PROTO_MYSQL)  # server greeting
                 )
     
+    __slots__ = ('protocol_id', 'history')
+    
     def __init__(self, target=None):
         self.protocol_id = None
-        self.history = []
+        self.history = ()       # data seen before the protocol was detected
         if target:
             self.protocol_id = self.PORTMAP.get(target[1])
             if self.protocol_id:
@@ -128,27 +567,926 @@ class ProtocolDetect(object):
     def detect(self, data):
         if self.protocol_id:
             return self.protocol_id
-        self.history.append(data)
+        data = bytes(data)
+        self.history += (data,)
+        data = data.lower()
         for keywordlist,proto in self.KEYWORDS:
-            if any(k in data.lower() for k in keywordlist):
+            if any(k in data for k in keywordlist):
                 self.protocol_id = proto
                 logging.debug("%s - protocol detected (protocol messages)"%repr(self))
                 return
         
+class Framing(object):
+    ''' Message boundaries of a binary protocol. header() reads the header
+        at pos of a buffer (bytes, bytearray, memoryview) and returns
+        (header length, payload length, kind) or None while it is
+        incomplete, payloads are never touched. kind is the type byte,
+        tag or sequence number, whatever the protocol puts in its header.
+    '''
+    __slots__ = ()
+    MAX_HEADER = 0
+    
+    def header(self, buf, pos=0):
+        raise NotImplementedError("Implement this in framing class")
+    
+    def split(self, buf, pos=0):
+        ''' ([(pos, header length, payload length, kind),..], end of the last complete message) '''
+        frames = []
+        end = len(buf)
+        while pos < end:
+            header = self.header(buf, pos)
+            if header is None or pos + header[0] + header[1] > end:
+                break
+            frames.append((pos,) + header)
+            pos += header[0] + header[1]
+        return frames, pos
+
+class LengthPrefixed(Framing):
+    ''' fixed size header with a length field and an optional kind field
+        
+        @param length_offset, length_size: length field in the header
+        @param header_size: bytes before the payload
+        @param kind_offset, kind_size: kind field in the header, None = no kind
+        @param include: header bytes counted by the length field
+    '''
+    __slots__ = ('length_offset', 'length_size', 'header_size', 'kind_offset', 'kind_size', 'byteorder', 'include')
+    
+    def __init__(self, length_offset, length_size, header_size, kind_offset=None, kind_size=1, byteorder="big", include=0):
+        self.length_offset = length_offset
+        self.length_size = length_size
+        self.header_size = header_size
+        self.kind_offset = kind_offset
+        self.kind_size = kind_size
+        self.byteorder = byteorder
+        self.include = include
+    
+    @property
+    def MAX_HEADER(self):
+        return self.header_size
+    
+    def header(self, buf, pos=0):
+        if len(buf) - pos < self.header_size:
+            return None
+        start = pos + self.length_offset
+        length = int.from_bytes(buf[start:start+self.length_size], self.byteorder) - self.include
+        if length < 0:
+            raise FramingError("invalid message length %d at %d"%(length + self.include, pos))
+        kind = None
+        if self.kind_offset is not None:
+            start = pos + self.kind_offset
+            kind = int.from_bytes(buf[start:start+self.kind_size], self.byteorder)
+        return self.header_size, length, kind
+
+class Fixed(Framing):
+    ''' unframed messages of a known size (postgres SSLRequest answer), kind is the first byte '''
+    __slots__ = ('size',)
+    
+    def __init__(self, size):
+        self.size = size
+    
+    @property
+    def MAX_HEADER(self):
+        return 1
+    
+    def header(self, buf, pos=0):
+        if len(buf) <= pos:
+            return None
+        return 0, self.size, buf[pos]
+
+class BER(Framing):
+    ''' ASN.1 BER tag-length-value with definite lengths (LDAP), kind is the tag '''
+    __slots__ = ()
+    MAX_HEADER = 6
+    
+    def header(self, buf, pos=0):
+        end = len(buf)
+        if end - pos < 2:
+            return None
+        tag, length = buf[pos], buf[pos+1]
+        if tag & 0x1f == 0x1f:
+            raise FramingError("multi byte ber tag at %d"%pos)
+        if length < 0x80:
+            return 2, length, tag
+        nbytes = length & 0x7f
+        if not nbytes or nbytes > 4:
+            raise FramingError("unsupported ber length at %d"%pos)
+        if end - pos < 2 + nbytes:
+            return None
+        return 2 + nbytes, int.from_bytes(buf[pos+2:pos+2+nbytes], "big"), tag
+    
+    def children(self, buf, start, end):
+        ''' (tag, value start, value end) of the elements in buf[start:end] '''
+        while start < end:
+            header = self.header(buf, start)
+            if header is None or start + header[0] + header[1] > end:
+                raise FramingError("truncated ber element at %d"%start)
+            yield header[2], start + header[0], start + header[0] + header[1]
+            start += header[0] + header[1]
+    
+    @staticmethod
+    def encode(tag, value):
+        nbytes = len(value)
+        if nbytes < 0x80:
+            return bytes((tag, nbytes)) + value
+        length = nbytes.to_bytes((nbytes.bit_length()+7)//8, "big")
+        return bytes((tag, 0x80|len(length))) + length + value
+    
+    @staticmethod
+    def encode_int(tag, value):
+        return BER.encode(tag, value.to_bytes(max(1, (value.bit_length()+8)//8), "big", signed=True))
+
+class ProtocolState(object):
+    ''' Incremental per session protocol state tracker
+
+        Fed with the data relayed in both directions (client data as sent to
+        the server, server data as received). Lines split across reads are
+        reassembled, so vectors can check the session phase in O(1) instead
+        of rescanning sndbuf/recvbuf.
+    '''
+    GREETING = 1        # waiting for the server greeting
+    COMMAND = 2         # idle, waiting for the next client command
+    CAPABILITY = 3      # capability request sent, reply pending
+    STARTTLS = 4        # starttls requested, waiting for go-ahead/handshake
+    TLS = 5             # tls negotiated, no command since
+    AUTHENTICATED = 6   # client authenticated/registered
+    BULK = 7            # message body/literal transfer
+    NAMES = {GREETING: "greeting", COMMAND: "command", CAPABILITY: "capability", STARTTLS: "starttls",
+             TLS: "tls", AUTHENTICATED: "authenticated", BULK: "bulk"}
+    
+    CLIENT = 0
+    SERVER = 1
+    MAX_LINE = 8*1024
+    PROTOCOLS = {}      # protocol_id: tracker class
+    __slots__ = ('state', 'tls', 'authenticated', 'capabilities', 'pending', '_partial', '_raw')
+    
+    def __init__(self, state=GREETING):
+        self.state = state
+        self.tls = False
+        self.authenticated = False
+        self.capabilities = []
+        self.pending = None         # last client command waiting for a reply
+        self._partial = [b'', b'']  # incomplete trailing line per direction
+        self._raw = [0, 0]          # raw (non-line) bytes expected per direction
+    
+    @classmethod
+    def register(cls, protocol_id):
+        def decorator(tracker):
+            cls.PROTOCOLS[protocol_id] = tracker
+            return tracker
+        return decorator
+    
+    @classmethod
+    def create(cls, protocol_id, state=GREETING):
+        return cls.PROTOCOLS.get(protocol_id, ProtocolState)(state)
+    
+    @classmethod
+    def state_to_name(cls, state):
+        for name in ("GREETING", "COMMAND", "CAPABILITY", "STARTTLS", "TLS", "AUTHENTICATED", "BULK"):
+            if getattr(cls, name)==state:
+                return name
+    
+    def __repr__(self):
+        return "<%s %s state=%s tls=%s>"%(self.__class__.__name__, hex(id(self)), self.state_to_name(self.state), self.tls)
+    
+    def set_state(self, state):
+        if state!=self.state:
+            logger.debug("%r -> %s"%(self, self.state_to_name(state)))
+            self.state = state
+    
+    def on_tls(self):
+        self.tls = True
+        self.pending = None
+        self._partial = [b'', b'']
+        self.set_state(self.TLS)
+    
+    def on_authenticated(self):
+        self.authenticated = True
+        self.set_state(self.AUTHENTICATED)
+    
+    def on_client_data(self, data):
+        self._feed(self.CLIENT, data, self.on_client_line)
+    
+    def on_server_data(self, data):
+        self._feed(self.SERVER, data, self.on_server_line)
+    
+    def bulk(self, direction, data):
+        ''' fast path for opaque data (message bodies, literals): returns the
+            number of leading bytes of data that are opaque, they are consumed
+            here and must be relayed without inspection.
+        '''
+        if not self._raw[direction]:
+            return 0
+        nbytes = min(self._raw[direction], len(data))
+        self._raw[direction] -= nbytes
+        if not self._raw[direction]:
+            self.on_raw_done(direction)
+        return nbytes
+    
+    def expect_raw(self, direction, nbytes):
+        ''' the next nbytes in direction are opaque (literal, chunk) '''
+        self._raw[direction] = nbytes
+        if nbytes:
+            self.set_state(self.BULK)
+    
+    def _feed(self, direction, data, on_line):
+        buf = self._partial[direction] + data if self._partial[direction] else bytes(data)
+        pos, end = 0, len(buf)
+        while pos < end:
+            if self._raw[direction]:
+                nbytes = min(self._raw[direction], end-pos)
+                self._raw[direction] -= nbytes
+                pos += nbytes
+                if not self._raw[direction]:
+                    self.on_raw_done(direction)
+                continue
+            eol = buf.find(b"\n", pos)
+            if eol < 0:
+                break
+            on_line(buf[pos:eol].rstrip(b"\r"))
+            pos = eol+1
+        self._partial[direction] = buf[pos:][-self.MAX_LINE:]
+    
+    def on_raw_done(self, direction):
+        self.set_state(self.COMMAND)
+    
+    def on_client_line(self, line): pass
+    def on_server_line(self, line): pass
+
+@ProtocolState.register(ProtocolDetect.PROTO_SMTP)
+class SMTPState(ProtocolState):
+    __slots__ = ('client_name',)
+    _REX_DATA_END = re.compile(rb"\r\n\.\r\n")
+    def __init__(self, *args, **kwargs):
+        ProtocolState.__init__(self, *args, **kwargs)
+        self.client_name = None
+    
+    def on_client_line(self, line):
+        if self.state==self.BULK:
+            if line==b".":
+                self.pending = None
+                self.set_state(self.COMMAND)
+            return
+        cmd = line.split(b" ")
+        verb = cmd[0].upper()
+        if verb in (b"EHLO", b"HELO"):
+            self.client_name = cmd[1] if len(cmd)>1 else b''
+            self.capabilities = []
+            self.set_state(self.CAPABILITY)
+        elif verb==b"STARTTLS":
+            self.set_state(self.STARTTLS)
+        elif verb==b"BDAT" and len(cmd)>1 and cmd[1].isdigit():
+            # chunk follows the command line right away
+            self.pending = b"BDAT"
+            self.expect_raw(self.CLIENT, int(cmd[1]))
+        elif verb:
+            self.pending = verb
+            if self.state!=self.AUTHENTICATED:
+                self.set_state(self.COMMAND)
+    
+    def on_server_line(self, line):
+        code, final = line[:3], line[3:4]!=b"-"
+        if self.state==self.CAPABILITY and code==b"250":
+            self.capabilities.append(line[4:])
+        if not final:
+            return
+        if self.state in (self.GREETING, self.CAPABILITY):
+            self.set_state(self.COMMAND)
+        elif self.state==self.STARTTLS:
+            if code!=b"220":
+                self.set_state(self.COMMAND)
+        elif self.pending==b"AUTH" and code==b"235":
+            self.on_authenticated()
+        elif self.pending==b"DATA" and code==b"354":
+            self.set_state(self.BULK)
+            return      # pending DATA marks a dot terminated body, see bulk()
+        self.pending = None
+    
+    def on_raw_done(self, direction):
+        self.set_state(self.AUTHENTICATED if self.authenticated else self.COMMAND)
+    
+    def bulk(self, direction, data):
+        nbytes = ProtocolState.bulk(self, direction, data)
+        if nbytes or direction!=self.CLIENT or self.pending!=b"DATA":
+            return nbytes
+        # DATA: the body ends with <CRLF>.<CRLF>, the last bytes of the body
+        # so far are carried in _partial (empty: right after the DATA line)
+        tail = self._partial[direction] or b"\r\n"
+        end = (tail + bytes(data[:4])).find(b"\r\n.\r\n")
+        if end >= 0:
+            # terminator spans the previous read
+            nbytes = end+5-len(tail)
+        else:
+            match = self._REX_DATA_END.search(data)
+            if not match:
+                self._partial[direction] = (tail + bytes(data[-4:]))[-4:]
+                return len(data)
+            nbytes = match.end()
+        self._partial[direction] = b''
+        self.pending = None
+        self.on_raw_done(direction)
+        return nbytes
+
+@ProtocolState.register(ProtocolDetect.PROTO_POP3)
+class POP3State(ProtocolState):
+    __slots__ = ()
+    def on_client_line(self, line):
+        verb = line.split(b" ",1)[0].upper()
+        if verb==b"CAPA":
+            self.capabilities = []
+            self.set_state(self.CAPABILITY)
+        elif verb==b"STLS":
+            self.set_state(self.STARTTLS)
+        self.pending = verb
+    
+    def on_server_line(self, line):
+        if self.state in (self.CAPABILITY, self.BULK):
+            # multi-line response, dot terminated
+            if line==b".":
+                self.set_state(self.AUTHENTICATED if self.authenticated else self.COMMAND)
+            elif self.state==self.CAPABILITY and not line.startswith(b"+OK"):
+                self.capabilities.append(line)
+            return
+        ok = line.startswith(b"+OK")
+        if self.state==self.GREETING:
+            self.set_state(self.COMMAND)
+        elif self.state==self.STARTTLS:
+            if not ok:
+                self.set_state(self.COMMAND)
+        elif ok and self.pending in (b"PASS", b"APOP", b"AUTH"):
+            self.on_authenticated()
+        elif ok and self.pending in (b"RETR", b"TOP"):
+            self.set_state(self.BULK)
+        self.pending = None
+
+@ProtocolState.register(ProtocolDetect.PROTO_FTP)
+class FTPState(ProtocolState):
+    __slots__ = ('_multiline',)
+    def __init__(self, *args, **kwargs):
+        ProtocolState.__init__(self, *args, **kwargs)
+        self._multiline = None  # code of the open multi-line reply
+    
+    def on_client_line(self, line):
+        cmd = line.split(b" ")
+        verb = cmd[0].upper()
+        if verb==b"FEAT":
+            self.capabilities = []
+            self.set_state(self.CAPABILITY)
+        elif verb==b"AUTH" and len(cmd)>1 and cmd[1].upper() in (b"TLS", b"SSL", b"TLS-C"):
+            self.set_state(self.STARTTLS)
+        self.pending = verb
+    
+    def on_server_line(self, line):
+        code = line[:3]
+        if self._multiline:
+            if not line.startswith(self._multiline+b" "):
+                if self.state==self.CAPABILITY:
+                    self.capabilities.append(line.strip())
+                return
+            self._multiline = None
+        elif line[3:4]==b"-":
+            self._multiline = code
+            return
+        if self.state in (self.GREETING, self.CAPABILITY):
+            self.set_state(self.COMMAND)
+        elif self.state==self.STARTTLS:
+            if code!=b"234":
+                self.set_state(self.COMMAND)
+        elif code==b"230":
+            self.on_authenticated()
+        self.pending = None
+
+@ProtocolState.register(ProtocolDetect.PROTO_NNTP)
+class NNTPState(ProtocolState):
+    __slots__ = ()
+    def on_client_line(self, line):
+        verb = line.split(b" ",1)[0].upper()
+        if verb==b"CAPABILITIES":
+            self.capabilities = []
+            self.set_state(self.CAPABILITY)
+        elif verb==b"STARTTLS":
+            self.set_state(self.STARTTLS)
+        self.pending = verb
+    
+    def on_server_line(self, line):
+        code = line[:3]
+        if self.state in (self.CAPABILITY, self.BULK):
+            if line==b".":
+                self.set_state(self.AUTHENTICATED if self.authenticated else self.COMMAND)
+            elif self.state==self.CAPABILITY and code!=b"101":
+                self.capabilities.append(line)
+            return
+        if self.state==self.GREETING:
+            self.set_state(self.COMMAND)
+        elif self.state==self.STARTTLS:
+            if code!=b"382":
+                self.set_state(self.COMMAND)
+        elif code==b"281":
+            self.on_authenticated()
+        elif code in (b"220", b"221", b"222"):
+            # article/head/body follow
+            self.set_state(self.BULK)
+        self.pending = None
+
+class TaggedProtocolState(ProtocolState):
+    ''' IMAP style '<tag> <command>' requests with tagged completion responses '''
+    __slots__ = ('_resume', '_continued')
+    AUTH_COMMANDS = (b"LOGIN", b"AUTHENTICATE")
+    
+    def __init__(self, *args, **kwargs):
+        ProtocolState.__init__(self, *args, **kwargs)
+        self._resume = self.COMMAND             # state to return to after a literal
+        self._continued = [False, False]        # next line continues a command/response
+    
+    def on_client_line(self, line):
+        if self._continued[self.CLIENT]:
+            self._continued[self.CLIENT] = False
+            self.on_literal(self.CLIENT, line)
+            return
+        cmd = line.split(b" ")
+        if len(cmd)<2:
+            return
+        verb = cmd[1].upper()
+        if verb==b"CAPABILITY":
+            self.set_state(self.CAPABILITY)
+        elif verb==b"STARTTLS":
+            self.set_state(self.STARTTLS)
+        self.pending = (cmd[0], verb)
+        self.on_literal(self.CLIENT, line)
+    
+    def on_server_line(self, line):
+        if self._continued[self.SERVER]:
+            self._continued[self.SERVER] = False
+            self.on_literal(self.SERVER, line)
+            return
+        if line.startswith(b"* "):
+            self.on_untagged(line)
+            self.on_literal(self.SERVER, line)
+            return
+        if not self.pending or not line.startswith(self.pending[0]+b" "):
+            return
+        ok = line[len(self.pending[0])+1:].upper().startswith(b"OK")
+        verb = self.pending[1]
+        if self.state==self.STARTTLS:
+            if not ok:
+                self.set_state(self.COMMAND)
+        elif ok and verb in self.AUTH_COMMANDS:
+            self.on_authenticated()
+        elif self.state==self.CAPABILITY:
+            self.set_state(self.COMMAND)
+        self.pending = None
+    
+    def on_untagged(self, line):
+        if self.state==self.GREETING:
+            self.set_state(self.COMMAND)
+    
+    def on_literal(self, direction, line):
+        pass
+    
+    def on_raw_done(self, direction):
+        self._continued[direction] = True
+        self.set_state(self._resume)
+
+@ProtocolState.register(ProtocolDetect.PROTO_IMAP)
+class IMAPState(TaggedProtocolState):
+    __slots__ = ()
+    _REX_LITERAL = re.compile(rb"\{(\d+)\+?\}$")
+    
+    def on_untagged(self, line):
+        upper = line.upper()
+        if b"CAPABILITY " in upper:
+            self.capabilities = upper.split(b"CAPABILITY ",1)[1].split(b"]",1)[0].split(b" ")
+        if self.state==self.GREETING:
+            if upper.startswith(b"* PREAUTH"):
+                self.on_authenticated()
+            else:
+                self.set_state(self.COMMAND)
+    
+    def on_literal(self, direction, line):
+        # '{n}' at the end of a line announces n bytes of opaque data
+        match = self._REX_LITERAL.search(line)
+        if match:
+            if self.state!=self.BULK:
+                self._resume = self.state
+            self.expect_raw(direction, int(match.group(1)))
+
+@ProtocolState.register(ProtocolDetect.PROTO_ACAP)
+class ACAPState(TaggedProtocolState):
+    __slots__ = ()
+    AUTH_COMMANDS = (b"AUTHENTICATE",)
+    _REX_CAP = re.compile(rb"\(([^\)]+)\)")
+    
+    def on_untagged(self, line):
+        if line.upper().startswith(b"* ACAP"):
+            self.capabilities = self._REX_CAP.findall(line)
+        TaggedProtocolState.on_untagged(self, line)
+
+@ProtocolState.register(ProtocolDetect.PROTO_IRC)
+class IRCState(ProtocolState):
+    __slots__ = ('nickname', 'server_name', 'cap_ls')
+    def __init__(self, *args, **kwargs):
+        ProtocolState.__init__(self, *args, **kwargs)
+        self.nickname = None
+        self.server_name = None
+        self.cap_ls = False     # client negotiated capabilities
+    
+    def on_client_line(self, line):
+        cmd = line.split(b" ")
+        verb = cmd[0].upper()
+        if verb==b"CAP" and len(cmd)>1:
+            sub = cmd[1].upper()
+            if sub==b"LS":
+                self.cap_ls = True
+                self.capabilities = []
+                self.set_state(self.CAPABILITY)
+            elif sub==b"END" and self.state==self.CAPABILITY:
+                self.set_state(self.COMMAND)
+        elif verb==b"STARTTLS":
+            self.set_state(self.STARTTLS)
+        elif verb==b"NICK" and len(cmd)>1 and not self.nickname:
+            self.nickname = cmd[1].lstrip(b":")
+        self.pending = verb
+    
+    def on_server_line(self, line):
+        fields = line.split(b" ")
+        if len(fields)<2:
+            return
+        if fields[0].startswith(b":"):
+            if not self.server_name:
+                self.server_name = fields[0][1:]
+            fields = fields[1:]
+        verb = fields[0].upper()
+        if verb.isdigit() and len(fields)>1 and fields[1]!=b"*":
+            self.nickname = fields[1]
+        if self.state==self.GREETING:
+            self.set_state(self.COMMAND)
+        if verb==b"CAP" and self.state==self.CAPABILITY:
+            self.capabilities.extend(f.lstrip(b":") for f in fields[3:])
+        elif verb==b"001":
+            self.on_authenticated()
+        elif self.state==self.STARTTLS and verb!=b"670":
+            self.set_state(self.COMMAND)
+
+@ProtocolState.register(ProtocolDetect.PROTO_XMPP)
+class XMPPState(ProtocolState):
+    ''' xmpp is not line based, track tags instead (tail carried over reads) '''
+    __slots__ = ()
+    _TAIL = len(b"</stream:features>")-1    # never carries a complete tag
+    
+    def on_client_data(self, data):
+        data = self._carry(self.CLIENT, data)
+        if b"<starttls" in data:
+            self.set_state(self.STARTTLS)
+        elif b"<auth" in data:
+            self.pending = b"auth"
+    
+    def on_server_data(self, data):
+        data = self._carry(self.SERVER, data)
+        if b"<stream:features" in data:
+            self.capabilities = []
+            self.set_state(self.CAPABILITY)
+        if self.state==self.CAPABILITY:
+            if b"<starttls" in data:
+                self.capabilities.append(b"starttls")
+            if b"</stream:features>" in data:
+                self.set_state(self.COMMAND)
+        if self.state==self.STARTTLS and b"<failure" in data:
+            self.set_state(self.COMMAND)
+        elif b"<success" in data:
+            self.on_authenticated()
+    
+    def _carry(self, direction, data):
+        buf = self._partial[direction] + data
+        self._partial[direction] = buf[-self._TAIL:]
+        return buf
+
+class FramedProtocolState(ProtocolState):
+    ''' Tracker for binary protocols, follows message boundaries with a
+        Framing per direction (None = opaque, e.g. relayed tls).
+        
+        on_message() gets the kind and a view of the payload bytes in the
+        current read, complete=False if the message continues in the next
+        reads. The rest of such a message is relayed as raw data (BULK).
+        Only a header split across reads is kept, payloads are not copied.
+    '''
+    __slots__ = ('framing', '_resume')
+    FRAMING = (None, None)      # (client, server)
+    
+    def __init__(self, *args, **kwargs):
+        ProtocolState.__init__(self, *args, **kwargs)
+        self.framing = list(self.FRAMING)
+        self._resume = self.state
+    
+    def on_tls(self):
+        ProtocolState.on_tls(self)
+        self._raw = [0, 0]
+        self.framing = list(self.FRAMING)
+    
+    def on_client_data(self, data):
+        self._feed_messages(self.CLIENT, data)
+    
+    def on_server_data(self, data):
+        self._feed_messages(self.SERVER, data)
+    
+    def expect_raw(self, direction, nbytes):
+        if nbytes and self.state!=self.BULK:
+            self._resume = self.state
+        ProtocolState.expect_raw(self, direction, nbytes)
+    
+    def on_raw_done(self, direction):
+        if self.state==self.BULK:
+            self.set_state(self._resume)
+    
+    def _feed_messages(self, direction, data):
+        data = memoryview(data)
+        pos, end = 0, len(data)
+        if self._raw[direction]:
+            # rest of a message that started in an earlier read
+            pos = min(self._raw[direction], end)
+            self._raw[direction] -= pos
+            if not self._raw[direction]:
+                self.on_raw_done(direction)
+        try:
+            partial = self._partial[direction]
+            if partial and pos < end and self.framing[direction]:
+                self._partial[direction] = b''
+                head = partial + data[pos:pos+self.framing[direction].MAX_HEADER].tobytes()
+                header = self.framing[direction].header(head)
+                if header is None:
+                    self._partial[direction] = head
+                    return
+                pos = self._message(direction, data, pos + header[0] - len(partial), header[1], header[2])
+            while pos < end and self.framing[direction]:
+                header = self.framing[direction].header(data, pos)
+                if header is None:
+                    self._partial[direction] = data[pos:].tobytes()
+                    return
+                pos = self._message(direction, data, pos + header[0], header[1], header[2])
+        except FramingError as e:
+            logger.debug("%r - stopped tracking %s messages: %r"%(self, "client" if direction==self.CLIENT else "server", e))
+            self.framing[direction] = None
+    
+    def _message(self, direction, data, start, nbytes, kind):
+        available = min(nbytes, len(data) - start)
+        self.on_message(direction, kind, data[start:start+available], available==nbytes)
+        if available < nbytes:
+            self.expect_raw(direction, nbytes - available)
+        return start + available
+    
+    def on_message(self, direction, kind, payload, complete): pass
+
+@ProtocolState.register(ProtocolDetect.PROTO_PGSQL)
+class PGSQLState(FramedProtocolState):
+    ''' postgres: untyped startup packets (SSLRequest, StartupMessage) from
+        the client, a single byte answer to SSLRequest, typed messages after
+    '''
+    __slots__ = ()
+    STARTUP = LengthPrefixed(0, 4, 8, kind_offset=4, kind_size=4, include=8)   # length, code
+    TYPED = LengthPrefixed(1, 4, 5, kind_offset=0, include=4)                   # type, length
+    SSL_ANSWER = Fixed(1)
+    FRAMING = (STARTUP, TYPED)
+    SSL_REQUEST = 80877103
+    GSSENC_REQUEST = 80877104
+    PROTOCOL_3 = 196608
+    
+    def on_message(self, direction, kind, payload, complete):
+        if direction==self.CLIENT:
+            if self.framing[self.CLIENT] is not self.STARTUP:
+                return
+            if kind in (self.SSL_REQUEST, self.GSSENC_REQUEST):
+                self.pending = kind
+                self.framing[self.SERVER] = self.SSL_ANSWER
+                self.set_state(self.STARTTLS)
+            elif kind==self.PROTOCOL_3:
+                self.framing[self.CLIENT] = self.TYPED
+                self.pending = b"startup"
+                self.set_state(self.COMMAND)
+            return
+        if self.framing[self.SERVER] is self.SSL_ANSWER:
+            self.framing[self.SERVER] = self.TYPED
+            if kind in (ord("S"), ord("G")):
+                # tls (or gss) relayed as is from here
+                self.framing = [None, None]
+            else:
+                self.set_state(self.COMMAND)
+            self.pending = None
+        elif kind==ord("R") and complete and payload[:4]==b"\0\0\0\0":
+            self.on_authenticated()             # AuthenticationOk
+            self.pending = None
+
+@ProtocolState.register(ProtocolDetect.PROTO_MYSQL)
+class MySQLState(FramedProtocolState):
+    ''' mysql: 3 byte length, sequence id, the server speaks first
+        (HandshakeV10), the client answers with SSLRequest (CLIENT_SSL, no
+        credentials) or the HandshakeResponse
+    '''
+    __slots__ = ('server_flags',)
+    PACKET = LengthPrefixed(0, 3, 4, kind_offset=3, byteorder="little")
+    FRAMING = (PACKET, PACKET)
+    CLIENT_SSL = 0x0800
+    SSL_REQUEST_SIZE = 32
+    
+    def __init__(self, *args, **kwargs):
+        FramedProtocolState.__init__(self, *args, **kwargs)
+        self.server_flags = None
+    
+    @staticmethod
+    def greeting_flags_offset(payload):
+        ''' offset of the (lower) capability flags in a HandshakeV10 payload, None if it is none '''
+        if not len(payload) or payload[0]!=10:
+            return None
+        nul = bytes(payload[:256]).find(b"\0", 1)
+        if nul < 0:
+            return None
+        offset = nul + 1 + 4 + 8 + 1    # connection id, auth plugin data part 1, filler
+        return offset if offset + 2 <= len(payload) else None
+    
+    @staticmethod
+    def client_flags(payload):
+        return int.from_bytes(payload[:4], "little") if len(payload) >= 4 else 0
+    
+    @classmethod
+    def is_ssl_request(cls, payload):
+        return len(payload)==cls.SSL_REQUEST_SIZE and cls.client_flags(payload) & cls.CLIENT_SSL
+    
+    def on_message(self, direction, kind, payload, complete):
+        if direction==self.SERVER:
+            if self.state==self.GREETING and kind==0:
+                offset = self.greeting_flags_offset(payload)
+                if offset is not None:
+                    self.server_flags = int.from_bytes(payload[offset:offset+2], "little")
+                    self.capabilities = [b"SSL"] if self.server_flags & self.CLIENT_SSL else []
+                self.set_state(self.COMMAND)
+            elif self.pending==b"auth" and len(payload):
+                if payload[0]==0x00:
+                    self.on_authenticated()     # OK
+                    self.pending = None
+                elif payload[0]==0xff:
+                    self.pending = None         # ERR
+            return
+        if self.state in (self.GREETING, self.COMMAND, self.TLS) and not self.authenticated and self.pending is None:
+            if self.is_ssl_request(payload):
+                self.set_state(self.STARTTLS)
+                self.pending = b"ssl"
+                if not self.tls:
+                    # tls (relayed as is) follows right away, there is no answer
+                    self.framing = [None, None]
+            else:
+                self.pending = b"auth"
+
+@ProtocolState.register(ProtocolDetect.PROTO_LDAP)
+class LDAPState(FramedProtocolState):
+    ''' ldap: BER encoded LDAPMessage SEQUENCE {messageID, protocolOp, ..} '''
+    __slots__ = ()
+    MESSAGE = BER()
+    FRAMING = (MESSAGE, MESSAGE)
+    STARTTLS_OID = b"1.3.6.1.4.1.1466.20037"
+    # protocolOp tags, [APPLICATION n]
+    BIND_REQUEST = 0x60
+    BIND_RESPONSE = 0x61
+    SEARCH_REQUEST = 0x63
+    SEARCH_RESULT_ENTRY = 0x64
+    SEARCH_RESULT_DONE = 0x65
+    EXTENDED_REQUEST = 0x77
+    EXTENDED_RESPONSE = 0x78
+    
+    @classmethod
+    def messages(cls, buf):
+        ''' (message id, protocolOp tag, op value start, op value end) of the complete messages in buf '''
+        frames, _ = cls.MESSAGE.split(buf)
+        for pos, hlen, nbytes, tag in frames:
+            if tag!=0x30:
+                raise FramingError("not an LDAPMessage: tag 0x%02x"%tag)
+            yield cls.parse(buf, pos + hlen, pos + hlen + nbytes)
+    
+    def split_header(self, direction):
+        ''' the first message of the next read started in the read before (its header is at the peer already) '''
+        return bool(self.framing[direction] and self._partial[direction])
+    
+    def read_messages(self, direction, buf):
+        ''' messages() of a read the tracker did not see yet (vectors run
+            first): the rest of a message from an earlier read is skipped, a
+            header split across reads is completed with the bytes kept from
+            the earlier read. nothing once tracking stopped, never raises.
+        '''
+        framing = self.framing[direction]
+        if not framing:
+            return
+        pos, end = min(self._raw[direction], len(buf)), len(buf)
+        try:
+            partial = self._partial[direction]
+            if partial and pos < end:
+                header = framing.header(partial + bytes(buf[pos:pos+framing.MAX_HEADER]))
+                if header is None:
+                    return
+                hlen, nbytes, tag = header
+                pos += hlen - len(partial)
+                if tag!=0x30 or pos + nbytes > end:
+                    return
+                yield self.parse(buf, pos, pos + nbytes)
+                pos += nbytes
+            for pos, hlen, nbytes, tag in framing.split(buf, pos)[0]:
+                if tag!=0x30:
+                    return
+                yield self.parse(buf, pos + hlen, pos + hlen + nbytes)
+        except FramingError as e:
+            logger.debug("%r - not an LDAPMessage: %r"%(self, e))
+    
+    @classmethod
+    def parse(cls, buf, start, end):
+        ''' LDAPMessage value buf[start:end] -> (message id, protocolOp tag, op value start, op value end) '''
+        elements = cls.MESSAGE.children(buf, start, end)
+        for tag, id_start, id_end in elements:
+            for op, op_start, op_end in elements:
+                return int.from_bytes(buf[id_start:id_end], "big"), op, op_start, op_end
+        raise FramingError("LDAPMessage without protocolOp")
+    
+    @classmethod
+    def first_value(cls, buf, start, end, tag):
+        ''' value of the first element with tag in buf[start:end], None if there is none '''
+        for t, value_start, value_end in cls.MESSAGE.children(buf, start, end):
+            if t==tag:
+                return buf[value_start:value_end]
+        return None
+    
+    @classmethod
+    def is_starttls(cls, buf, op, start, end):
+        return op==cls.EXTENDED_REQUEST and cls.first_value(buf, start, end, 0x80)==cls.STARTTLS_OID
+    
+    @classmethod
+    def result_code(cls, buf, start, end):
+        ''' resultCode of an LDAPResult (BindResponse, ExtendedResponse, ..) '''
+        value = cls.first_value(buf, start, end, 0x0a)
+        return int.from_bytes(value, "big") if value is not None else None
+    
+    @classmethod
+    def extended_response(cls, message_id, result_code, message=b"", name=STARTTLS_OID):
+        op = BER.encode_int(0x0a, result_code) + BER.encode(0x04, b"") + BER.encode(0x04, message)
+        if name:
+            op += BER.encode(0x8a, name)
+        return BER.encode(0x30, BER.encode_int(0x02, message_id) + BER.encode(cls.EXTENDED_RESPONSE, op))
+    
+    def on_message(self, direction, kind, payload, complete):
+        if not complete:
+            return
+        message_id, op, start, end = self.parse(payload, 0, len(payload))
+        if direction==self.CLIENT:
+            if self.is_starttls(payload, op, start, end):
+                self.pending = (message_id, op)
+                self.set_state(self.STARTTLS)
+            elif op==self.BIND_REQUEST:
+                self.pending = (message_id, op)
+            elif self.state==self.GREETING:
+                self.set_state(self.COMMAND)
+            return
+        if not self.pending or self.pending[0]!=message_id:
+            return
+        code = self.result_code(payload, start, end)
+        if self.pending[1]==self.EXTENDED_REQUEST and op==self.EXTENDED_RESPONSE:
+            if code==0:
+                # tls (relayed as is) follows
+                self.framing = [None, None]
+            else:
+                self.set_state(self.COMMAND)
+        elif self.pending[1]==self.BIND_REQUEST and op==self.BIND_RESPONSE and code==0:
+            self.on_authenticated()
+        self.pending = None
+
 class Session(object):
     ''' Proxy session from client <-> proxy <-> server 
         @param inbound: inbound socket
         @param outbound: outbound socket
         @param target: target tuple ('ip',port) 
-        @param buffer_size: socket buff size'''
+        @param buffer_size: socket buff size
+        
+        callbacks (mangle_client_data, mangle_server_data) are bound to a
+        Session subclass, see bind_callbacks()'''
+    __slots__ = ('proxy', 'bind', 'inbound', 'outbound', 'buffer_size', 'protocol', 'state', 'tls_vector', 'channels',
+                 'trace_id', 'upstream', 'fingerprint', 'tampered', 'memory', 'queue', 'quota', 'started')
+    BULK_BUFFER_SIZE = 64*1024  # recv size while relaying message bodies/literals
+    FTP_DATA_CHANNELS = True    # relay ftp data connections through the proxy
+    tracer = None               # Tracer, see --trace
+    MEMORY = None               # MemoryBudget shared by all sessions, None = blocking writes, see --memory-budget
+    SESSION_MEMORY = 0          # bytes a session keeps in memory before spilling to disk, see --session-memory
     
     def __init__(self, proxy, inbound=None, outbound=None, target=None, buffer_size=4096):
         self.proxy = proxy
-        self.bind = proxy.getsockname()
-        self.inbound = TcpSockBuff(inbound)
-        self.outbound = TcpSockBuff(outbound, peer=target)
+        self.bind = proxy.getsockname() if proxy else None
+        # data a slow peer did not take yet, see TcpSockBuff.flush()
+        self.memory = MemoryBudget(self.SESSION_MEMORY, parent=self.MEMORY) if self.MEMORY else None
+        self.inbound = TcpSockBuff(inbound, memory=self.memory)
+        self.outbound = TcpSockBuff(outbound, peer=target, memory=self.memory)
         self.buffer_size = buffer_size
         self.protocol = ProtocolDetect(target=target)
+        self.state = None       # ProtocolState, once the protocol is known
+        self.tls_vector = False # selected vector performs tls handshakes
+        self.channels = None    # FTPDataChannels
+        self.trace_id = 0       # Tracer track, 0 = not traced
+        self.upstream = None    # Upstream of an UpstreamPool
+        self.fingerprint = None # ClientFingerprint, see RewriteDispatcher.verdicts
+        self.tampered = False   # the vector changed the traffic, see RewriteDispatcher.release
+        self.queue = QueueDelay()   # queueing delay and credit, see FairScheduler
+        self.quota = 0          # bytes left to read this round, 0 = unlimited
+        self.started = time.time()
     
     def __repr__(self):
         return "<Session %s [client: %s] --> [prxy: %s] --> [target: %s]>"%(hex(id(self)),
@@ -157,143 +1495,1686 @@ class Session(object):
                                                                             self.outbound.peer)
     def __str__(self):
         return "<Session %s>"%hex(id(self))
+    
+    @classmethod
+    def bind_callbacks(cls, **callbacks):
+        ''' Session class calling callbacks, shared by all its sessions '''
+        callbacks['__slots__'] = ()
+        return type(cls.__name__, (cls,), callbacks)
         
     def connect(self, target):
         self.outbound.peer = target
         logger.info("%s connecting to target %s"%(self, repr(target)))
-        return self.outbound.connect(target)
+        with self.trace("connect", target=str(target)):
+            return self.outbound.connect(target)
     
-    def accept(self):
-        sock, addr = self.proxy.accept()
-        self.inbound = TcpSockBuff(sock)
+    def accept(self, sock=None, addr=None):
+        if sock is None:
+            sock, addr = self.proxy.accept()
+        self.inbound = TcpSockBuff(sock, memory=self.memory)
         self.inbound.peer = addr
         logger.info("%s client %s has connected"%(self,repr(self.inbound.peer)))
+        if self.tracer:
+            self.tracer.start(self)
         return sock,
     
+    def trace(self, name, **args):
+        ''' span context manager, no-op unless the session is traced '''
+        return self.tracer.span(self.trace_id, name, args) if self.trace_id else Tracer.NULL
+    
     def get_peer_sockets(self):
-        return [self.inbound.socket, self.outbound.socket]
+        if self.channels:
+            return [self.inbound, self.outbound] + self.channels.get_sockets()
+        return [self.inbound, self.outbound]
     
     def notify_read(self, sock):
         if sock == self.proxy:
             self.accept()
             self.connect(self.outbound.peer)
-        elif sock == self.inbound.socket:
+        elif sock is self.inbound:
             # new client -> prxy - data
             self.on_recv(self.inbound, self.outbound, self)
-        elif sock == self.outbound.socket:
+        elif sock is self.outbound:
             # new sprxy <- target - data
             self.on_recv(self.outbound, self.inbound, self)
+        elif self.channels:
+            self.channels.notify_read(sock)
         return 
     
+    def process(self, sock, budget=0):
+        ''' notify_read() and drain data buffered by the tls layer, then send
+            everything relayed meanwhile (one write per peer).
+            with a budget, reads stop after budget bytes (see FairScheduler).
+            returns (bytes read, tls buffered data left)
+        '''
+        received = self.inbound.received + self.outbound.received
+        used = 0
+        while True:
+            if budget:
+                self.quota = budget - used
+            self.notify_read(sock)
+            used = self.inbound.received + self.outbound.received - received
+            buffered = [s for s in self.get_peer_sockets() if s.pending()]
+            if not buffered or (budget and used >= budget):
+                break
+            sock = buffered[0]
+        self.quota = 0
+        self.flush(blocking=False)
+        return used, bool(buffered)
+    
+    def flush(self, blocking=True):
+        self.inbound.flush(blocking)
+        self.outbound.flush(blocking)
+    
+    def get_backlogged_sockets(self):
+        ''' peers with data waiting for the socket to become writable '''
+        return [s for s in (self.inbound, self.outbound) if s.backlog]
+    
+    def uses_tls(self):
+        return bool(self.tls_vector or self.inbound.socket_ssl or self.outbound.socket_ssl)
+    
     def close(self):
+        if self.channels:
+            self.channels.close()
+        try:
+            # what was relayed before the peer closed
+            self.flush()
+        except socket.error:
+            pass
         self.outbound.socket.close()
         self.inbound.socket.close()
         raise SessionTerminatedException()
     
     def on_recv(self, s_in, s_out, session):
-        data = s_in.recv(session.buffer_size)
-        self.protocol.detect(data)
+        bulk = self.state and self.state.state==ProtocolState.BULK
+        size = self.BULK_BUFFER_SIZE if bulk else (s_in.rsize or session.buffer_size)
+        if session.quota and size > session.quota:
+            size = max(session.quota, session.buffer_size)
+        data = s_in.recv(size, blocking=False)
+        if data is None:
+            return None
         if not len(data):
             return session.close()
-        if s_in == session.inbound:
-            data = self.mangle_client_data(session, data)
-        elif s_in == session.outbound:
-            data = self.mangle_server_data(session, data)
+        if not bulk:
+            # a full buffer means more is waiting: grow up to the bulk size, shrink back once messages are small
+            if len(data)==size and size < self.BULK_BUFFER_SIZE:
+                s_in.rsize = size*2
+            elif s_in.rsize and len(data) < size//8:
+                s_in.rsize = size//2 if size//2 > session.buffer_size else 0
+        if bulk:
+            # message body/literal: relay as-is, no detection, mangling or logging
+            nbytes = self.state.bulk(ProtocolState.CLIENT if s_in is session.inbound else ProtocolState.SERVER, data)
+            if nbytes:
+                s_out.write(data[:nbytes], s_in)
+                if nbytes==len(data):
+                    return data
+                data = data[nbytes:]
+        if self.state is None:
+            self.detect_protocol(data)
+        if self.tls_vector:
+            # the vector may block on a peer that waits for queued data
+            self.flush()
+        if s_in is session.inbound:
+            with self.trace("mangle client", bytes=len(data)):
+                data = self.mangle_client_data(session, data)
+            if data and self.state:
+                self.state.on_client_data(data)
+            if data and self.channels:
+                data = self.channels.rewrite_client_data(data)
+        elif s_in is session.outbound:
+            raw = data
+            with self.trace("mangle server", bytes=len(data)):
+                data = self.mangle_server_data(session, data)
+            if self.state:
+                self.state.on_server_data(raw)
+            if data and self.channels:
+                data = self.channels.rewrite_server_data(data)
+        if self.state and not self.state.tls and (session.inbound.socket_ssl or session.outbound.socket_ssl):
+            self.state.on_tls()
         if data:
-            s_out.sendall(data)
+            s_out.write(data, s_in)
         return data
     
+    def detect_protocol(self, data):
+        seen_data = bool(self.protocol.history)
+        protocol_id = self.protocol.detect(data) or self.protocol.protocol_id
+        if protocol_id:
+            # late detection (keywords): the greeting is gone already
+            self.state = ProtocolState.create(protocol_id,
+                                              ProtocolState.COMMAND if seen_data else ProtocolState.GREETING)
+            if protocol_id==ProtocolDetect.PROTO_FTP and self.FTP_DATA_CHANNELS:
+                self.channels = FTPDataChannels(self)
+    
     def inbound_starttls(self, session, sslctx=None): 
         raise NotImplementedError("Implement this in proto class")
     def outbound_starttls(self, session, sslctx=None): 
         raise NotImplementedError("Implement this in proto class")
     
-    def mangle_client_data(self, session, data, rewrite): return data
-    def mangle_server_data(self, session, data, rewrite): return data
+    def mangle_client_data(self, session, data): return data
+    def mangle_server_data(self, session, data): return data
+    def on_terminated(self, session): pass
+    
+class FTPDataChannel(object):
+    ''' One ftp data connection, relayed through a proxy owned listener.
+        
+        passive (PASV/EPSV): the client connects to the listener, the proxy
+        connects to the address the server announced. active (PORT/EPRT):
+        the server connects to the listener, the proxy connects to the
+        client. plaintext data is moved with os.splice() (kernel only) where
+        available. with PROT P both legs are tls, the ftp client is always
+        the tls client: the handshakes are done once it starts one. tls
+        legs are spliced too if both are kernel tls (--ktls).
+        the proxy side connect and the close_notify exchange do not block,
+        the proxy waits for them with the other sockets.
+    '''
+    __slots__ = ('session', 'listener', 'target', 'passive', 'tls', 'client', 'server',
+                 'pipes', 'eof', 'nbytes', 'connecting', 'closing')
+    CHUNK = 64*1024
+    SPLICE = hasattr(os, "splice")
+    
+    def __init__(self, session, listener, target, passive, tls=False):
+        self.session = session
+        self.listener = listener    # TcpSockBuff, until the data connection is made
+        self.target = target        # address the proxy connects to
+        self.passive = passive
+        self.tls = tls
+        self.client = None          # TcpSockBuff, client leg
+        self.server = None          # TcpSockBuff, server leg
+        self.pipes = {}             # TcpSockBuff: (pipe_r, pipe_w) for splice
+        self.eof = set()            # legs that reached eof
+        self.nbytes = [0, 0]        # client->server, server->client
+        self.connecting = None      # TcpSockBuff, leg the proxy connects until it is writable
+        self.closing = None         # (src, dst) while dst's close_notify is awaited
+    
+    def __repr__(self):
+        return "<FTPDataChannel %s %s target=%s tls=%s>"%(hex(id(self)), "passive" if self.passive else "active",
+                                                          self.target, self.tls)
+    
+    def get_sockets(self):
+        if self.listener:
+            return [self.listener]
+        if self.connecting:
+            return []
+        return [s for s in (self.client, self.server) if s and s not in self.eof]
+    
+    def notify_read(self, sock):
+        if sock is self.listener:
+            return self.on_accept()
+        if self.closing:
+            return self.on_close_notify()
+        if self.tls and not sock.socket_ssl:
+            return self.on_handshake()
+        src, dst = (self.client, self.server) if sock is self.client else (self.server, self.client)
+        nbytes = None
+        if self.SPLICE and (not self.tls or (src.ktls[1] and dst.ktls[0] and not src.pending())):
+            try:
+                nbytes = self.splice(src, dst)
+            except OSError as e:
+                # kernel tls: the next record is not application data (alert, session ticket), ssl handles it
+                if not self.tls or e.errno != errno.EINVAL:
+                    raise
+        if nbytes is None:
+            data = src.recv(self.CHUNK, blocking=False)
+            if data is None:
+                return
+            nbytes = len(data)
+            if nbytes:
+                dst.socket.sendall(data)
+        if not nbytes and src.socket_ssl:
+            # relay the close_notify: send ours to dst, answer src once dst replied
+            self.eof.add(src)
+            self.closing = (src, dst)
+            dst.socket.setblocking(False)
+            self.on_close_notify()
+        elif not nbytes:
+            self.eof.add(src)
+            dst.socket.shutdown(socket.SHUT_WR)
+        self.nbytes[src is self.server] += nbytes
+    
+    def on_accept(self):
+        sock, addr = self.listener.accept()
+        self.listener.socket.close()
+        self.listener = None
+        peer = TcpSockBuff(sock, peer=addr)
+        # targets are addresses, no name resolution
+        family, socktype, proto, _, address = socket.getaddrinfo(self.target[0], self.target[1], 0, socket.SOCK_STREAM,
+                                                                 0, socket.AI_NUMERICHOST)[0]
+        other = TcpSockBuff(socket.socket(family, socktype, proto), peer=self.target)
+        other.socket.setblocking(False)
+        err = other.socket.connect_ex(address)
+        self.client, self.server = (peer, other) if self.passive else (other, peer)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.connecting = other
+    
+    def on_connect(self):
+        ''' the proxy side leg became writable: connected or failed '''
+        sock, self.connecting = self.connecting, None
+        err = sock.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        sock.socket.setblocking(True)
+        logger.info("%s connected client %s server %s"%(self, self.client.peer, self.server.peer))
+    
+    def on_close_notify(self):
+        src, dst = self.closing
+        try:
+            dst.socket.unwrap()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # dst becomes readable with its close_notify
+            return
+        # src sent its close_notify already, ours completes the exchange
+        src.socket.setblocking(False)
+        try:
+            src.socket.unwrap()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            pass
+        self.closing = None
+        self.eof.add(dst)
+    
+    def on_handshake(self):
+        ''' client sent its ClientHello: intercept, then handshake with the server '''
+        control = self.session
+        context = control.inbound.socket_ssl.context if control.inbound.socket_ssl else Vectors.get_server_context(control)
+        self.client.ssl_wrap_socket_with_context(context, server_side=True)
+        if control.outbound.socket_ssl:
+            # servers may require the control connection tls session to be reused
+            self.server.ssl_wrap_socket_with_context(control.outbound.socket_ssl.context,
+                                                     session=control.outbound.socket_ssl.session)
+        else:
+            self.server.ssl_wrap_socket()
+        logger.info("%s tls intercepted"%self)
+    
+    def splice(self, src, dst):
+        if src not in self.pipes:
+            self.pipes[src] = os.pipe()
+        return src.splice_to(dst, self.pipes[src], self.CHUNK)
+    
+    def is_done(self):
+        return self.listener is None and self.client and len(self.eof)==2
+    
+    def close(self):
+        for s in (self.listener, self.client, self.server):
+            if s and s.socket:
+                s.socket.close()
+        for pipe in self.pipes.values():
+            for fd in pipe:
+                os.close(fd)
+        self.pipes = {}
+        self.listener = None
+
+class FTPDataChannels(object):
+    ''' Rewrites the data connection endpoints an ftp control session
+        negotiates (227/229 replies, PORT/EPRT commands) to proxy owned
+        listeners and keeps the resulting FTPDataChannels.
+    '''
+    __slots__ = ('session', 'channels', 'tls', 'closed')
+    _REX_PASV = re.compile(rb"^227 ([^\r\n]*?)(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)", re.M)
+    _REX_EPSV = re.compile(rb"^229 ([^\r\n]*?)\((.)\2\2(\d+)\2\)", re.M)
+    _REX_PORT = re.compile(rb"^PORT (\d+),(\d+),(\d+),(\d+),(\d+),(\d+)", re.M|re.I)
+    _REX_EPRT = re.compile(rb"^EPRT (.)([12])\1([^\r\n]+?)\1(\d+)\1", re.M|re.I)
+    _REX_PROT = re.compile(rb"^PROT (\w?)", re.I)
+    
+    def __init__(self, session):
+        self.session = session
+        self.channels = []
+        self.tls = False        # PROT P
+        self.closed = []        # sockets closed since the proxy last looked
+    
+    def get_sockets(self):
+        return [s for c in self.channels for s in c.get_sockets()]
+    
+    def get_connecting_sockets(self):
+        return [c.connecting for c in self.channels if c.connecting]
+    
+    def notify_read(self, sock):
+        for channel in self.channels:
+            sockets = channel.get_sockets()
+            if sock in sockets:
+                self._call(channel, sockets, channel.notify_read, sock)
+                return
+    
+    def notify_write(self, sock):
+        ''' completes the connect of a data connection, False if sock is not connecting '''
+        for channel in self.channels:
+            if sock is channel.connecting:
+                self._call(channel, [], channel.on_connect)
+                return True
+        return False
+    
+    def _call(self, channel, sockets, f, *args):
+        try:
+            f(*args)
+        except (socket.error, ValueError) as e:
+            logger.warning("%s %s"%(channel, repr(e)))
+            channel.connecting = channel.closing = None
+            channel.eof.update((channel.client, channel.server))
+        if channel.listener is None and (channel.is_done() or not channel.client):
+            self.remove(channel)
+        else:
+            # accepted listener, half closed legs
+            self.closed.extend(s for s in sockets if s not in channel.get_sockets())
+    
+    def remove(self, channel):
+        logger.info("%s closed: %d bytes client->server, %d bytes server->client"%(channel, channel.nbytes[0], channel.nbytes[1]))
+        self.closed.extend(channel.get_sockets())
+        self.closed.extend(s for s in (channel.client, channel.server) if s)
+        channel.close()
+        self.channels.remove(channel)
+    
+    def listen(self, local, target, passive):
+        ''' new channel listening on the proxy address of the local socket '''
+        # a new PASV/PORT supersedes data connections that were never made
+        for channel in [c for c in self.channels if c.listener]:
+            self.remove(channel)
+        sock = socket.socket(local.family, socket.SOCK_STREAM)
+        sock.bind((local.getsockname()[0], 0))
+        sock.listen(1)
+        channel = FTPDataChannel(self.session, TcpSockBuff(sock, peer=sock.getsockname()), target, passive, self.tls)
+        self.channels.append(channel)
+        logger.info("%s %s"%(self.session, channel))
+        return sock.getsockname()
+    
+    @staticmethod
+    def _ipv4(address):
+        return address[7:] if address.startswith("::ffff:") else address
+    
+    def rewrite_server_data(self, data):
+        data = bytes(data)
+        if not (b"227 " in data or b"229 " in data):
+            return data
+        data = self._REX_PASV.sub(self._on_pasv, data)
+        return self._REX_EPSV.sub(self._on_epsv, data)
+    
+    def rewrite_client_data(self, data):
+        data = bytes(data)
+        upper = data.upper()
+        if not (b"PROT " in upper or b"PORT " in upper or b"EPRT " in upper):
+            return data
+        # pipelined commands: in order, a PROT applies to the PORT that follows it
+        lines = data.splitlines(True)
+        for i, line in enumerate(lines):
+            verb = line[:5].upper()
+            if verb==b"PROT ":
+                self.tls = self._REX_PROT.match(line).group(1).upper()==b"P"
+            elif verb==b"PORT ":
+                lines[i] = self._REX_PORT.sub(self._on_port, line)
+            elif verb==b"EPRT ":
+                lines[i] = self._REX_EPRT.sub(self._on_eprt, line)
+        return b"".join(lines)
+    
+    def _on_pasv(self, match):
+        target = (".".join(g.decode() for g in match.groups()[1:5]), int(match.group(6))*256+int(match.group(7)))
+        ip, port = self.listen(self.session.inbound.socket, target, passive=True)[:2]
+        ip = self._ipv4(ip)
+        if ":" in ip:
+            logger.warning("%s cannot announce ipv6 listener in 227 reply, data connection not relayed"%self.session)
+            return match.group(0)
+        return b"227 %s%s,%d,%d"%(match.group(1), ip.replace(".",",").encode(), port>>8, port&0xff)
+    
+    def _on_epsv(self, match):
+        # the address the control connection reached, no name resolution
+        target = (self.session.outbound.socket.getpeername()[0], int(match.group(3)))
+        port = self.listen(self.session.inbound.socket, target, passive=True)[1]
+        delim = match.group(2)
+        return b"229 %s(%s%s%s%d%s)"%(match.group(1), delim, delim, delim, port, delim)
+    
+    def _on_port(self, match):
+        target = (".".join(g.decode() for g in match.groups()[:4]), int(match.group(5))*256+int(match.group(6)))
+        ip, port = self.listen(self.session.outbound.socket, target, passive=False)[:2]
+        return b"PORT %s,%d,%d"%(self._ipv4(ip).replace(".",",").encode(), port>>8, port&0xff)
+    
+    def _on_eprt(self, match):
+        delim = match.group(1)
+        target = (match.group(3).decode(), int(match.group(4)))
+        ip, port = self.listen(self.session.outbound.socket, target, passive=False)[:2]
+        ip = self._ipv4(ip)
+        return b"EPRT %s%s%s%s%s%d%s"%(delim, b"2" if ":" in ip else b"1", delim, ip.encode(), delim, port, delim)
+    
+    def close(self):
+        for channel in list(self.channels):
+            self.remove(channel)
+
+class ProxyServer(object):
+    '''Proxy Class
+    
+        transparent=REDIRECT|TPROXY forwards each connection to its original
+        destination (iptables REDIRECT / TPROXY), target is only used for
+        connections that were not redirected.
+    '''
+    REDIRECT = "redirect"
+    TPROXY = "tproxy"
+    # linux/netfilter_ipv4.h, linux/netfilter_ipv6/ip6_tables.h, linux/in.h, linux/in6.h
+    SO_ORIGINAL_DST = 80
+    IP6T_SO_ORIGINAL_DST = 80
+    IP_TRANSPARENT = getattr(socket, "IP_TRANSPARENT", 19)
+    IPV6_TRANSPARENT = 75
+    
+    def __init__(self, listen, target, buffer_size=4096, delay=0.0001, tls_workers=0,
+                 backlog=200, admission=None, listen_sock=None, transparent=None, scheduler=None,
+                 connect_workers=8):
+        self.input_list = set([])
+        self.output_list = set([])  # sockets with a backlog, see Session.MEMORY
+        self.sessions = {}  # TcpSockBuff:Session()
+        self.live = {}      # Session: None in accept order (dicts keep insertion order), see StatsSegment
+        self.callbacks = {} # name: f
+        self.session_class = Session
+        self.tls_executor = TlsExecutor(tls_workers) if tls_workers else None
+        self.connector = ConnectExecutor(max(connect_workers, 1))
+        self.admission = admission or AdmissionControl()
+        self.scheduler = scheduler or FairScheduler()
+        self.control = None     # AdminChannel
+        self.draining = False
+        self.stopping = False   # stop() was called
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        #
+        self.listen = listen
+        self.target = target    # (host, port) or UpstreamPool
+        self.pool = target if isinstance(target, UpstreamPool) else None
+        self.transparent = transparent
+        #
+        self.buffer_size = buffer_size
+        self.delay = delay
+        if listen_sock:
+            # taken over from a previous process, already bound and listening
+            self.inbound = listen_sock
+        else:
+            family, socktype, proto, _, addr = socket.getaddrinfo(listen[0], listen[1], 0, socket.SOCK_STREAM,
+                                                                  0, socket.AI_PASSIVE)[0]
+            self.inbound = socket.socket(family, socktype, proto)
+            self.inbound.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                # dual stack, redirected ipv4 connections show up v4-mapped
+                self.inbound.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            if transparent == self.TPROXY:
+                # accept connections addressed to foreign ips, needs CAP_NET_ADMIN
+                self.inbound.setsockopt(socket.IPPROTO_IP, self.IP_TRANSPARENT, 1)
+                if family == socket.AF_INET6:
+                    self.inbound.setsockopt(socket.IPPROTO_IPV6, self.IPV6_TRANSPARENT, 1)
+            self.inbound.bind(addr)
+            self.inbound.listen(backlog)
+        self.inbound.setblocking(False)
+        
+    def __str__(self):
+        return "<Proxy %s listen=%s target=%s%s>"%(hex(id(self)),self.listen, self.target,
+                                                   " transparent=%s"%self.transparent if self.transparent else "")
+    
+    @staticmethod
+    def get_original_dst(sock):
+        ''' destination of a connection before iptables REDIRECT (conntrack) '''
+        if sock.family == socket.AF_INET6 and not sock.getpeername()[0].startswith("::ffff:"):
+            raw = sock.getsockopt(socket.IPPROTO_IPV6, ProxyServer.IP6T_SO_ORIGINAL_DST, 28)    # sockaddr_in6
+            return socket.inet_ntop(socket.AF_INET6, raw[8:24]), struct.unpack("!H", raw[2:4])[0]
+        raw = sock.getsockopt(socket.IPPROTO_IP, ProxyServer.SO_ORIGINAL_DST, 16)                # sockaddr_in
+        return socket.inet_ntoa(raw[4:8]), struct.unpack("!H", raw[2:4])[0]
+    
+    def get_default_target(self):
+        return self.pool.select() if self.pool else self.target
+    
+    def get_target(self, sock):
+        ''' upstream (address or pool Upstream) for an accepted client socket, None if there is none '''
+        if not self.transparent:
+            return self.get_default_target()
+        local = sock.getsockname()[:2]
+        if self.transparent == self.TPROXY:
+            # tproxy keeps the original destination as local address
+            dst = local
+            redirected = dst[1] != self.inbound.getsockname()[1]
+        else:
+            try:
+                dst = self.get_original_dst(sock)
+            except socket.error:
+                dst = local     # no conntrack entry
+            redirected = dst != local
+        if not redirected:
+            # connected to the proxy itself, forwarding would loop
+            return self.get_default_target()
+        if dst[0].startswith("::ffff:"):
+            dst = (dst[0][7:], dst[1])
+        return dst
+
+    def get_session_by_client_sock(self, sock):
+        return self.sessions.get(sock)
+
+    def set_callback(self, name, f):
+        self.callbacks[name] = f
+        self.session_class = Session.bind_callbacks(**self.callbacks)
+
+    def main_loop(self):
+        self.input_list.add(self.inbound)
+        self.input_list.add(self._wakeup_r)
+        self.input_list.add(self.connector)
+        if self.tls_executor:
+            self.input_list.add(self.tls_executor)
+        if self.control:
+            self.input_list.update(self.control.get_sockets())
+        while not (self.draining and not self.admission.active):
+            time.sleep(self.delay)
+            # tls buffered data of carried over sessions is invisible to select()
+            inputready, outputready, _ =  select.select(self.input_list, self.output_list, [],
+                                                        0 if self.scheduler.carried else None)
+            
+            for sock in outputready:
+                if sock in self.output_list:
+                    self.on_writable(sock)
+            ready = []
+            for sock in inputready:
+                if sock not in self.input_list:
+                    # session was terminated earlier in this round
+                    continue
+                try:
+                    if sock is self.tls_executor:
+                        self.on_tls_completed()
+                    elif sock is self.connector:
+                        self.on_connected()
+                    elif sock is self._wakeup_r:
+                        self.on_wakeup()
+                    elif self.control and sock in self.control.get_sockets():
+                        self.control.on_read(sock)
+                    elif sock == self.inbound:
+                        self.on_accept()
+                    else:
+                        ready.append((self.get_session_by_client_sock(sock), sock))
+                except Exception as e:
+                    logger.warning("main: %s"%repr(e))
+                    self.input_list.discard(sock)
+                    raise
+            for session, sock, since in self.scheduler.schedule(ready, time.monotonic()):
+                if sock not in self.input_list:
+                    # terminated or parked earlier in this round
+                    continue
+                try:
+                    self.on_recv(session, sock, since)
+                except SessionTerminatedException:
+                    self.on_terminated(session)
+                except Exception as e:
+                    logger.warning("main: %s"%repr(e))
+                    self.on_terminated(session, log=False)
+                    raise        
+        self.input_list.discard(self._wakeup_r)
+    
+    def on_recv(self, session, sock, since):
+        budget = self.scheduler.serve(session, since, time.monotonic())
+        if budget is None:
+            # overdrew its credit, the next round pays it back
+            self.scheduler.defer(session, sock, since)
+            return
+        if self.tls_executor and session.uses_tls():
+            # park the session until the worker is done with it
+            self.input_list.difference_update(session.get_peer_sockets())
+            self.output_list.difference_update(session.get_peer_sockets())
+            if session.channels:
+                self.output_list.difference_update(session.channels.get_connecting_sockets())
+            self.tls_executor.submit(session, sock)
+            return
+        used, buffered = session.process(sock, budget)
+        self.scheduler.done(session, sock, budget, used, buffered, time.monotonic())
+        if session.channels:
+            self.update_session(session)
+        if session.memory:
+            self.update_backlog(session)
+    
+    def handoff(self):
+        ''' stop accepting and drain, returns the listening socket for the next process '''
+        logger.warning("%s handing off listener, draining %d sessions"%(self, self.admission.active))
+        self.input_list.discard(self.inbound)
+        self.draining = True
+        return self.inbound
+    
+    def stop(self):
+        ''' stop accepting, drain sessions and return from main_loop(), may be called from any thread '''
+        self.stopping = True
+        self._wakeup_w.send(b"\0")
+    
+    def on_wakeup(self):
+        self._wakeup_r.recv(64)
+        if self.stopping and not self.draining:
+            logger.warning("%s stopping, draining %d sessions"%(self, self.admission.active))
+            self.input_list.discard(self.inbound)
+            self.draining = True
+    
+    def on_accept(self):
+        ''' drain up to accept_batch pending connections per wakeup '''
+        for _ in range(self.admission.accept_batch):
+            try:
+                sock, addr = self.inbound.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            target = upstream = self.get_target(sock)
+            if isinstance(upstream, Upstream):
+                target = upstream.address
+            else:
+                upstream = None
+            reason = self.admission.admit(addr[0]) if target else self.admission.reject(addr[0], AdmissionControl.REJECT_TARGET)
+            if reason:
+                logger.warning("<Proxy %s> rejected client %s: %s"%(hex(id(self)), repr(addr), reason))
+                sock.close()
+                continue
+            session = self.session_class(self.inbound, target=target)
+            session.accept(sock, addr)
+            self.live[session] = None
+            if Vectors._CA:
+                # an intercept finds the certificate minted by the time the client asks for tls
+                Vectors._CA.prepare(str(target[0]))
+            # the client is read once the upstream is connected, see on_connected()
+            if upstream:
+                self.connector.submit(session, self.pool.connect, session, upstream)
+            else:
+                self.connector.submit(session, session.connect, target)
+    
+    def on_connected(self):
+        for session, exc in self.connector.get_completed():
+            if exc:
+                logger.warning("%s upstream connect failed: %s"%(session, repr(exc)))
+                if session.trace_id:
+                    session.tracer.end(session, error=exc)
+                self.live.pop(session, None)
+                self.admission.release()
+                session.inbound.socket.close()
+                if session.outbound.socket:
+                    session.outbound.socket.close()
+                if not isinstance(exc, socket.error):
+                    raise exc
+                continue
+            for s in session.get_peer_sockets():
+                self.sessions[s]=session
+            self.input_list.update(session.get_peer_sockets())
+    
+    def update_session(self, session):
+        ''' (de)register sockets a session added or closed (ftp data channels) '''
+        for s in session.channels.closed:
+            self.input_list.discard(s)
+            self.output_list.discard(s)
+            self.sessions.pop(s, None)
+        session.channels.closed = []
+        for s in session.get_peer_sockets():
+            self.sessions[s]=session
+        self.input_list.update(session.get_peer_sockets())
+        for s in session.channels.get_connecting_sockets():
+            # writable once connected, see on_writable()
+            self.sessions[s]=session
+            self.output_list.add(s)
+    
+    def update_backlog(self, session):
+        ''' wait for writability only while a peer has a backlog '''
+        backlogged = session.get_backlogged_sockets()
+        for s in (session.inbound, session.outbound):
+            if s in backlogged:
+                self.output_list.add(s)
+            else:
+                self.output_list.discard(s)
+    
+    def on_writable(self, sock):
+        session = self.get_session_by_client_sock(sock)
+        if session.channels and session.channels.notify_write(sock):
+            self.output_list.discard(sock)
+            self.update_session(session)
+            return
+        try:
+            try:
+                session.flush(blocking=False)
+            except socket.error as e:
+                logger.debug("%s peer gone with %d bytes pending: %r"%(session, len(sock.backlog or ()), e))
+                session.close()
+            self.update_backlog(session)
+        except SessionTerminatedException:
+            self.on_terminated(session)
+    
+    def on_terminated(self, session, log=True):
+        if session.trace_id:
+            session.tracer.end(session)
+        if session.channels:
+            self.update_session(session)
+        for s in session.get_peer_sockets():
+            self.input_list.discard(s)
+            self.output_list.discard(s)
+            self.sessions.pop(s, None)
+        if session.memory:
+            session.inbound.drop_backlog()
+            session.outbound.drop_backlog()
+        if session.upstream:
+            self.pool.release(session.upstream)
+        self.scheduler.forget(session)
+        self.live.pop(session, None)
+        session.on_terminated(session)
+        self.admission.release()
+        if log:
+            logger.warning("%s terminated."%session)
+        logger.debug("%s %r"%(session, session.queue))
+    
+    def on_tls_completed(self):
+        for session, exc in self.tls_executor.get_completed():
+            if isinstance(exc, SessionTerminatedException):
+                self.on_terminated(session)
+            elif exc:
+                self.on_terminated(session, log=False)
+                logger.warning("main: %s"%repr(exc))
+                raise exc
+            else:
+                if session.channels:
+                    self.update_session(session)
+                else:
+                    self.input_list.update(session.get_peer_sockets())
+                if session.memory:
+                    self.update_backlog(session)
+
+class AdmissionControl(object):
+    ''' Decides whether an accepted client gets a session.
+        
+        @param rate: new sessions per second per client ip (token bucket), 0 = unlimited
+        @param burst: token bucket size per client ip
+        @param max_sessions: concurrent session cap, 0 = unlimited
+        @param accept_batch: max connections accepted per wakeup
+    '''
+    REJECT_RATE = "rate limit"
+    REJECT_SESSIONS = "session limit"
+    REJECT_TARGET = "no destination"
+    
+    def __init__(self, rate=0, burst=10, max_sessions=0, accept_batch=16):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_sessions = max_sessions
+        self.accept_batch = max(accept_batch, 1)
+        self.active = 0
+        self.buckets = {}   # ip:[tokens, last refill]
+        self.rejected = {}  # ip:{reason:count}
+    
+    def __repr__(self):
+        return "<AdmissionControl rate=%s burst=%d max_sessions=%d active=%d rejected=%d>"%(self.rate, self.burst,
+                                                                                             self.max_sessions, self.active,
+                                                                                             self.get_rejected_count())
+    
+    def admit(self, ip, now=None):
+        ''' returns None if admitted, the reject reason otherwise '''
+        if self.max_sessions and self.active >= self.max_sessions:
+            return self.reject(ip, self.REJECT_SESSIONS)
+        if self.rate and not self.take_token(ip, time.monotonic() if now is None else now):
+            return self.reject(ip, self.REJECT_RATE)
+        self.active += 1
+        return None
+    
+    def release(self):
+        self.active = max(self.active-1, 0)
+    
+    def take_token(self, ip, now):
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            if len(self.buckets) >= 4096:
+                self.prune(now)
+            bucket = self.buckets[ip] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now-bucket[1])*self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+    
+    def prune(self, now):
+        ''' forget buckets that are full again '''
+        for ip, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now-last)*self.rate >= self.burst:
+                del self.buckets[ip]
+    
+    def reject(self, ip, reason):
+        reasons = self.rejected.setdefault(ip, {})
+        reasons[reason] = reasons.get(reason, 0) + 1
+        return reason
+    
+    def get_rejected_count(self):
+        return sum(sum(r.values()) for r in self.rejected.values())
+
+class QueueDelay(object):
+    ''' queueing delay of one session, see FairScheduler '''
+    __slots__ = ('served', 'total', 'max', 'received', 'credit', 'round')
+    
+    def __init__(self):
+        self.served = 0         # times the session was served
+        self.total = 0.0        # seconds waited, summed
+        self.max = 0.0          # longest wait in seconds
+        self.received = 0       # bytes read
+        self.credit = 0         # bytes the session may still read, negative if overdrawn
+        self.round = -1         # last round it got a quantum
+    
+    def __repr__(self):
+        return "<QueueDelay served=%d avg=%.3fms max=%.3fms received=%d>"%(self.served, self.get_average()*1000,
+                                                                          self.max*1000, self.received)
+    
+    def get_average(self):
+        return self.total/self.served if self.served else 0.0
+
+class FairScheduler(object):
+    ''' Orders the sessions that are ready in an event loop round (deficit round robin).
+        
+        @param quantum: bytes a session may read per round, 0 = unlimited
+        
+        every round a ready session is given quantum bytes of credit and reads
+        until it used them, a read overdrawing the credit is paid back in the
+        next round. sessions that became ready go first, then, in round robin
+        order, the sessions that used up their credit in the last round: bulk
+        transfers delay an interactive session by at most one quantum each.
+        data buffered by the tls layer is invisible to select(), sessions left
+        with such data are carried over to the next round.
+        
+        the queueing delay is the time from select() reporting a session (or
+        carrying it over) until it is served, kept per session (QueueDelay)
+        and as a histogram of all sessions.
+    '''
+    BUCKETS = 24    # bucket n counts delays below 2**n microseconds, the last one everything above
+    
+    def __init__(self, quantum=0):
+        self.quantum = quantum
+        self.rounds = 0
+        self.served = 0
+        self.deferred = 0       # sessions that sat out a round to pay back credit
+        self.max = 0.0
+        self.histogram = [0]*self.BUCKETS
+        self.backlogged = collections.OrderedDict()     # sock:(session, since, carried) in round robin order
+    
+    def __repr__(self):
+        return "<FairScheduler quantum=%d rounds=%d served=%d deferred=%d delay p50=%.3fms p99=%.3fms max=%.3fms>"%(
+            self.quantum, self.rounds, self.served, self.deferred, self.percentile(50)*1000, self.percentile(99)*1000,
+            self.max*1000)
+    
+    @property
+    def carried(self):
+        ''' sessions to serve in the next round whether select() reports them or not '''
+        return any(carried for _, _, carried in self.backlogged.values())
+    
+    def schedule(self, ready, now):
+        ''' [(session, sock),..] reported by select() -> [(session, sock, ready since),..] in serving order '''
+        self.rounds += 1
+        backlogged, self.backlogged = self.backlogged, collections.OrderedDict()
+        reported = set()
+        order = []
+        for session, sock in ready:
+            reported.add(sock)
+            if sock not in backlogged:
+                order.append((session, sock, now))
+        for sock, (session, since, carried) in backlogged.items():
+            if carried or sock in reported:
+                order.append((session, sock, since))
+            else:
+                # nothing left to read, idle sessions do not keep credit
+                session.queue.credit = 0
+        return order
+    
+    def serve(self, session, since, now):
+        ''' budget for this round (0 = unlimited) and records the delay, None if the session has no credit '''
+        queue = session.queue
+        if self.quantum:
+            if queue.round != self.rounds:
+                queue.round = self.rounds
+                queue.credit = min(queue.credit, 0) + self.quantum
+            if queue.credit <= 0:
+                return None
+        delay = now - since
+        queue.served += 1
+        queue.total += delay
+        if delay > queue.max:
+            queue.max = delay
+        if delay > self.max:
+            self.max = delay
+        self.served += 1
+        self.histogram[min(int(delay*1000000).bit_length(), self.BUCKETS-1)] += 1
+        return queue.credit if self.quantum else 0
+    
+    def defer(self, session, sock, since):
+        ''' a session without credit sits out this round '''
+        self.deferred += 1
+        self.backlogged[sock] = (session, since, bool(session.inbound.pending() or session.outbound.pending()))
+    
+    def done(self, session, sock, budget, used, buffered, now):
+        ''' account what a session read, queue it for the next round if it has more '''
+        queue = session.queue
+        queue.received += used
+        if not budget:
+            if buffered:
+                self.backlogged[sock] = (session, now, True)
+            return
+        queue.credit -= used
+        if buffered or queue.credit <= 0:
+            self.backlogged[sock] = (session, now, buffered)
+    
+    def forget(self, session):
+        for sock in session.get_peer_sockets():
+            self.backlogged.pop(sock, None)
+    
+    def percentile(self, p):
+        ''' upper bound of the p-th percentile delay in seconds '''
+        count = sum(self.histogram)
+        if not count:
+            return 0.0
+        rank = count*p/100.0
+        seen = 0
+        for n, c in enumerate(self.histogram):
+            seen += c
+            if seen >= rank:
+                return min((1 << n)/1000000.0, self.max)
+        return self.max
+
+class Upstream(object):
+    ''' one upstream of an UpstreamPool '''
+    __slots__ = ('address', 'index', 'active', 'failures', 'down_until', 'last_error')
+    
+    def __init__(self, address, index=0):
+        self.address = address      # (host, port)
+        self.index = index
+        self.active = 0             # sessions connected to it
+        self.failures = 0           # consecutive connect failures
+        self.down_until = 0         # skipped by select() until then (monotonic)
+        self.last_error = None
+    
+    def __repr__(self):
+        return "<Upstream %s:%d active=%d failures=%d%s>"%(self.address[0], self.address[1], self.active, self.failures,
+                                                           " down" if self.down_until > time.monotonic() else "")
+    
+    def available(self, now):
+        return self.down_until <= now
+
+class UpstreamPool(object):
+    ''' Upstream targets of a listener.
+        
+        @param addresses: [(host, port),..]
+        @param balance: ROUNDROBIN or LEASTCONN
+        @param max_fails: consecutive connect failures before an upstream is taken down
+        @param fail_timeout: seconds a failed upstream is skipped
+        @param health_interval: seconds between active checks (tcp connect) in the background, 0 = passive only
+        @param connect_timeout: connect timeout per upstream
+        
+        connects follow happy eyeballs (rfc 8305): the addresses of an
+        upstream are tried alternating families, a new attempt starts every
+        ATTEMPT_DELAY while earlier ones are pending, the first to complete
+        wins. a failed connect takes the next upstream.
+    '''
+    ROUNDROBIN = "roundrobin"
+    LEASTCONN = "leastconn"
+    ATTEMPT_DELAY = 0.25
+    
+    def __init__(self, addresses, balance=ROUNDROBIN, max_fails=3, fail_timeout=30, health_interval=0, connect_timeout=5):
+        self.upstreams = [Upstream(a, i) for i, a in enumerate(addresses)]
+        self.balance = balance
+        self.max_fails = max(max_fails, 1)
+        self.fail_timeout = fail_timeout
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.next = 0               # round robin position
+        self.stopped = threading.Event()
+        self.checker = None
+    
+    def __repr__(self):
+        return "<UpstreamPool %s balance=%s upstreams=%r>"%(hex(id(self)), self.balance, self.upstreams)
+    
+    def select(self, exclude=()):
+        ''' next upstream to connect to, upstreams that are down only if all are.
+            None if everything is excluded
+        '''
+        now = time.monotonic()
+        count = len(self.upstreams)
+        # rotate the start so equal candidates take turns
+        ordered = [self.upstreams[(self.next+i)%count] for i in range(count)]
+        candidates = [u for u in ordered if u not in exclude]
+        if not candidates:
+            return None
+        available = [u for u in candidates if u.available(now)]
+        if not available:
+            # all down, the one that is back first
+            return min(candidates, key=lambda u: u.down_until)
+        if self.balance == self.LEASTCONN:
+            upstream = min(available, key=lambda u: u.active)
+        else:
+            upstream = available[0]
+        self.next = (upstream.index+1)%count
+        return upstream
+    
+    def connect(self, session, upstream):
+        ''' connect the session outbound to upstream, failing over to the others '''
+        tried = []
+        while True:
+            tried.append(upstream)
+            session.outbound.peer = upstream.address
+            logger.info("%s connecting to target %s"%(session, repr(upstream.address)))
+            try:
+                with session.trace("connect", target=str(upstream.address)):
+                    sock = self.happy_eyeballs(upstream.address)
+            except socket.error as e:
+                self.on_failure(upstream, e)
+                upstream = self.select(exclude=tried)
+                if not upstream:
+                    raise
+                continue
+            self.on_success(upstream)
+            session.outbound._init(sock)
+            session.upstream = upstream
+            upstream.active += 1
+            return upstream
+    
+    def release(self, upstream):
+        upstream.active = max(upstream.active-1, 0)
+    
+    def on_failure(self, upstream, error):
+        upstream.failures += 1
+        upstream.last_error = error
+        if upstream.failures >= self.max_fails:
+            if upstream.available(time.monotonic()):
+                logger.warning("%s down for %ss: %s"%(upstream, self.fail_timeout, repr(error)))
+            upstream.down_until = time.monotonic() + self.fail_timeout
+        else:
+            logger.warning("%s connect failed: %s"%(upstream, repr(error)))
+    
+    def on_success(self, upstream):
+        if not upstream.available(time.monotonic()):
+            logger.warning("%s is back up"%upstream)
+        upstream.failures = 0
+        upstream.down_until = 0
+    
+    def happy_eyeballs(self, address):
+        ''' returns a connected blocking socket, raises socket.error if no address connects in time '''
+        infos = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_STREAM)
+        # alternate address families, starting with the preferred one
+        families = []
+        for info in infos:
+            if info[0] not in families:
+                families.append(info[0])
+        by_family = [[i for i in infos if i[0]==f] for f in families]
+        infos = [i for group in zip(*by_family) for i in group] + \
+                [i for group in by_family for i in group[min(len(g) for g in by_family):]]
+        pending = {}    # socket: address
+        error = None
+        now = time.monotonic()
+        deadline = now + self.connect_timeout
+        next_attempt = now
+        try:
+            while infos or pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if infos and (now >= next_attempt or not pending):
+                    family, socktype, proto, _, addr = infos.pop(0)
+                    sock = socket.socket(family, socktype, proto)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(addr)
+                    if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        pending[sock] = addr
+                        next_attempt = now + self.ATTEMPT_DELAY
+                    else:
+                        error = socket.error(err, os.strerror(err))
+                        sock.close()
+                    continue
+                timeout = min(deadline, next_attempt) if infos else deadline
+                _, writable, _ = select.select([], list(pending), [], max(timeout-now, 0))
+                for sock in writable:
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if not err:
+                        del pending[sock]
+                        sock.setblocking(True)
+                        return sock
+                    error = socket.error(err, os.strerror(err))
+                    del pending[sock]
+                    sock.close()
+        finally:
+            for sock in pending:
+                sock.close()
+        raise error or socket.timeout("connect to %s:%d timed out"%address[:2])
+    
+    def start(self):
+        ''' start active health checks '''
+        if self.health_interval > 0 and not self.checker:
+            self.checker = threading.Thread(target=self._check_loop, name="striptls-health")
+            self.checker.daemon = True
+            self.checker.start()
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def _check_loop(self):
+        while not self.stopped.wait(self.health_interval):
+            for upstream in self.upstreams:
+                self.check(upstream)
+    
+    def check(self, upstream):
+        try:
+            self.happy_eyeballs(upstream.address).close()
+        except socket.error as e:
+            self.on_failure(upstream, e)
+        else:
+            self.on_success(upstream)
+
+class AdminChannel(object):
+    ''' Control interface of a running proxy: SIGHUP and a unix admin socket.
+        
+        The admin socket takes one line per connection and answers with one
+        line, e.g. echo reload | socat - UNIX-CONNECT:/run/striptls.sock
+            reload [vectors=A,B.*] [key=server.pem]
+            status
+            queues [n=20]   queueing delay of the n sessions that waited longest
+            handoff     pass the listener to a new process (see takeover()),
+                        then drain and exit
+        SIGHUP runs 'reload'.
+    '''
+    
+    def __init__(self, proxy, path=None):
+        self.proxy = proxy
+        self.path = path
+        self.commands = {'status': self.cmd_status,
+                         'queues': self.cmd_queues,
+                         'handoff': self.cmd_handoff}   # name: f(conn, args) -> str
+        self._sig_r, self._sig_w = socket.socketpair()
+        self._sig_r.setblocking(False)
+        self._sig_w.setblocking(False)
+        signal.set_wakeup_fd(self._sig_w.fileno())
+        signal.signal(signal.SIGHUP, lambda signum, frame: None)
+        self.listener = None
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(path)
+            self.listener.listen(8)
+    
+    def __repr__(self):
+        return "<AdminChannel %s path=%s>"%(hex(id(self)), self.path)
+    
+    def get_sockets(self):
+        return [s for s in (self._sig_r, self.listener) if s]
+    
+    def register(self, name, f):
+        self.commands[name] = f
+    
+    def on_read(self, sock):
+        if sock is self._sig_r:
+            for signum in self._sig_r.recv(64):
+                if signum == signal.SIGHUP:
+                    logger.warning("%s SIGHUP"%self)
+                    self.dispatch(None, "reload")
+            return
+        conn, _ = self.listener.accept()
+        conn.settimeout(2)
+        try:
+            line = conn.makefile('rb').readline().decode("utf-8", "replace").strip()
+            conn.sendall(("%s\n"%self.dispatch(conn, line)).encode("utf-8"))
+        except (socket.error, ValueError) as e:
+            logger.warning("%s %s"%(self, repr(e)))
+        finally:
+            conn.close()
+    
+    def dispatch(self, conn, line):
+        name, _, args = line.partition(" ")
+        f = self.commands.get(name)
+        if not f:
+            return "error: unknown command %r, use one of %s"%(name, ", ".join(sorted(self.commands)))
+        args = dict(a.split("=",1) for a in args.split() if "=" in a)
+        try:
+            return f(conn, args) or "ok"
+        except Exception as e:
+            logger.warning("%s %s failed: %s"%(self, name, repr(e)))
+            return "error: %s"%repr(e)
+    
+    def cmd_status(self, conn, args):
+        return "sessions=%d draining=%s %r %r%s%s"%(self.proxy.admission.active, self.proxy.draining, self.proxy.admission,
+                                                    self.proxy.scheduler,
+                                                    " %r"%self.proxy.pool if self.proxy.pool else "",
+                                                    " %r"%Session.MEMORY if Session.MEMORY else "")
+    
+    def cmd_queues(self, conn, args):
+        sessions = sorted(set(self.proxy.sessions.values()), key=lambda s: s.queue.max, reverse=True)
+        lines = ["%s client=%s %r"%(s, s.inbound.peer, s.queue) for s in sessions[:int(args.get("n", 20))]]
+        return "\n".join(lines) or "no sessions"
+    
+    def cmd_handoff(self, conn, args):
+        if not conn:
+            return "error: handoff needs an admin socket connection"
+        listener = self.proxy.handoff()
+        conn.sendmsg([b"listener"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [listener.fileno()]))])
+        self.close()
+        return "draining"
+    
+    def close(self):
+        ''' give up the admin socket path, e.g. for the process taking over '''
+        if self.listener:
+            self.proxy.input_list.discard(self.listener)
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+    
+    @staticmethod
+    def takeover(path):
+        ''' fetch the listening socket from the process serving admin socket path '''
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        try:
+            conn.sendall(b"handoff\n")
+            fds = array.array("i")
+            _, ancdata, _, _ = conn.recvmsg(64, socket.CMSG_LEN(fds.itemsize))
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(data[:fds.itemsize])
+            if not fds:
+                raise SessionTerminatedException("no listener received from %s: %s"%(path, conn.recv(1024)))
+            conn.recv(1024)     # wait until the old process gave up the admin socket path
+            return socket.socket(fileno=fds[0])
+        finally:
+            conn.close()
+
+class TlsExecutor(object):
+    ''' Runs session processing for tls sessions (handshakes, encrypt/decrypt)
+        on a bounded pool of worker threads. OpenSSL releases the GIL, so
+        handshakes scale with cores. Completed sessions are handed back to
+        the event loop, this object is selectable and becomes readable when
+        completions are waiting.
+    '''
+    NAME = "striptls-tls"
+    
+    def __init__(self, workers=4):
+        import concurrent.futures
+        self.workers = workers
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.NAME)
+        self.completed = collections.deque()    # (session, exception)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+    
+    def __repr__(self):
+        return "<TlsExecutor %s workers=%d>"%(hex(id(self)), self.workers)
+    
+    def fileno(self):
+        return self._wakeup_r.fileno()
+    
+    def submit(self, session, sock):
+        self.pool.submit(self._run, session, sock)
+    
+    def _run(self, session, sock):
+        exc = None
+        try:
+            session.process(sock)
+        except Exception as e:
+            exc = e
+        self.completed.append((session, exc))
+        self._wakeup_w.send(b"\0")
+    
+    def get_completed(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            yield self.completed.popleft()
+    
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+class ConnectExecutor(TlsExecutor):
+    ''' Connects new sessions to their upstream on worker threads (name
+        resolution, happy eyeballs, failover), an unreachable upstream does
+        not hold up the event loop. Sessions are handed back connected or
+        with the connect error, like TlsExecutor completions.
+    '''
+    NAME = "striptls-connect"
+    
+    def __repr__(self):
+        return "<ConnectExecutor %s workers=%d>"%(hex(id(self)), self.workers)
+    
+    def submit(self, session, connect, *args):
+        self.pool.submit(self._run, session, connect, args)
+    
+    def _run(self, session, connect, args):
+        exc = None
+        try:
+            connect(*args)
+        except Exception as e:
+            exc = e
+        self.completed.append((session, exc))
+        self._wakeup_w.send(b"\0")
+
+class Tracer(object):
+    ''' Writes session timelines as Chrome trace events (chrome://tracing,
+        ui.perfetto.dev). Every traced session is one track: a span for the
+        whole session plus spans for connect, mangle calls, tls handshakes
+        and blocking recv()s of vectors.
+        
+        @param path: output file, JSON array format
+        @param sample: trace every Nth session
+        @param client: only trace sessions of this client ip
+    '''
+    
+    class Span(object):
+        __slots__ = ('tracer', 'tid', 'name', 'args', 'started')
+        
+        def __init__(self, tracer, tid, name, args):
+            self.tracer = tracer
+            self.tid = tid
+            self.name = name
+            self.args = args
+        
+        def __enter__(self):
+            self.started = self.tracer.now()
+            return self
+        
+        def __exit__(self, exc_type, exc, tb):
+            if exc_type:
+                self.args['exception'] = repr(exc)
+            self.tracer.complete(self.tid, self.name, self.started, self.args)
+    
+    class NullSpan(object):
+        __slots__ = ()
+        def __enter__(self): return self
+        def __exit__(self, exc_type, exc, tb): pass
+    
+    NULL = NullSpan()
+    
+    def __init__(self, path, sample=1, client=None):
+        self.path = path
+        self.sample = max(sample, 1)
+        self.client = client
+        self.pid = os.getpid()
+        self.seen = 0
+        self.next_id = 1
+        self.sessions = {}      # trace_id: (started, name)
+        self.lock = threading.Lock()
+        self.epoch = time.perf_counter()
+        self.events = 0
+        self.f = open(path, 'w')
+        self.f.write("[")
+    
+    def __repr__(self):
+        return "<Tracer %s path=%s sample=1/%d client=%s traced=%d>"%(hex(id(self)), self.path, self.sample,
+                                                                      self.client, self.next_id-1)
+    
+    def now(self):
+        ''' microseconds since the tracer was created '''
+        return (time.perf_counter()-self.epoch)*1e6
+    
+    def emit(self, event):
+        event['pid'] = self.pid
+        line = json.dumps(event)
+        with self.lock:
+            self.f.write(",\n" if self.events else "\n")
+            self.f.write(line)
+            self.events += 1
+    
+    def complete(self, tid, name, started, args):
+        self.emit({'name': name, 'ph': 'X', 'ts': started, 'dur': self.now()-started, 'tid': tid, 'args': args})
+    
+    def span(self, tid, name, args):
+        return self.Span(self, tid, name, args)
+    
+    def start(self, session):
+        ''' assigns the session a track if it is sampled '''
+        if self.client and session.inbound.peer[0]!=self.client:
+            return
+        name = "%s -> %s"%(session.inbound.peer, session.outbound.peer)
+        # tls workers end sessions while the loop starts new ones
+        with self.lock:
+            self.seen += 1
+            if (self.seen-1)%self.sample:
+                return
+            tid = self.next_id
+            self.next_id += 1
+            self.sessions[tid] = (self.now(), name)
+        session.trace_id = tid
+        session.inbound.trace = session.outbound.trace = session.trace
+        self.emit({'name': 'thread_name', 'ph': 'M', 'tid': tid, 'args': {'name': name}})
+    
+    def end(self, session, error=None):
+        with self.lock:
+            started, name = self.sessions.pop(session.trace_id, (None, None))
+        if started is not None:
+            args = {'session': name}
+            if error:
+                args['error'] = repr(error)
+            self.complete(session.trace_id, "session", started, args)
+        session.trace_id = 0
+        session.inbound.trace = session.outbound.trace = None
+    
+    def close(self):
+        ''' ends sessions still open and terminates the json array '''
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        for tid, (started, name) in sessions.items():
+            self.complete(tid, "session", started, {'session': name, 'open': True})
+        with self.lock:
+            self.f.write("\n]\n")
+            self.f.close()
+
+class CertificateAuthority(object):
+    ''' Mints a leaf certificate per target hostname (or client SNI) signed
+        by the configured CA, so intercepted clients get a certificate that
+        matches the name they asked for.
+
+        server contexts are kept in a LRU cache, private keys are generated
+        ahead of time by a background thread (KeyPool) and certificates for
+        target hosts are minted on the minter thread when the session
+        connects (prepare()), so no key generation happens on the handshake
+        path. an SNI name that is not cached yet is signed in the handshake
+        with a pooled key (or waited for if it is being minted already).
+        requires the 'cryptography' package.
+        @param ca_certfile: CA certificate (PEM), may also hold the key
+        @param ca_keyfile: CA private key (PEM) [default: ca_certfile]
+        @param cache_size: number of minted contexts to keep
+        @param key_type: 'rsa' or 'ec' leaf keys
+        @param pool_size: number of pre-generated keys
+    '''
+    
+    DIR = None      # private directory for certificate files where memfd_create() is missing
+    
+    def __init__(self, ca_certfile, ca_keyfile=None, cache_size=256, key_type="rsa", pool_size=8, keypool=None,
+                 minter=None):
+        import concurrent.futures
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import serialization
+        except ImportError:
+            raise ImportError("certificate minting requires the 'cryptography' package (pip install striptls[ca])")
+        with open(ca_certfile, 'rb') as f:
+            pem = f.read()
+        self.ca_cert = x509.load_pem_x509_certificate(pem)
+        if ca_keyfile and ca_keyfile!=ca_certfile:
+            with open(ca_keyfile, 'rb') as f:
+                pem = f.read()
+        self.ca_key = serialization.load_pem_private_key(pem, password=None)
+        self.ca_cert_pem = self.ca_cert.public_bytes(serialization.Encoding.PEM)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # hostname: SSLContext
+        self.pending = {}                       # hostname: Future, minting in the background
+        self.lock = threading.Lock()
+        # reload: keep the running thread
+        self.minter = minter or concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="striptls-ca")
+        if keypool and keypool.key_type==key_type:
+            # reload: keep the running pool
+            self.keypool = keypool
+        else:
+            self.keypool = KeyPool(key_type=key_type, size=pool_size)
+            self.keypool.start()
+        
+    def __repr__(self):
+        return "<CertificateAuthority %s ca=%r cached=%d>"%(hex(id(self)), self.ca_cert.subject.rfc4514_string(), len(self.cache))
+    
+    def get_server_context(self, hostname):
+        ''' server side SSLContext presenting a certificate for hostname.
+            client SNI takes precedence over hostname.
+        '''
+        ctx = self.get_context(hostname)
+        ctx.sni_callback = self._on_sni
+        return ctx
+    
+    def _on_sni(self, sslsocket, server_name, ctx):
+        if not server_name:
+            return
+        try:
+            sslsocket.context = self.get_context(server_name)
+        except Exception as e:
+            # the target's certificate then
+            logger.warning("%r - minting a certificate for %s failed: %r"%(self, server_name, e))
+    
+    def prepare(self, hostname):
+        ''' mints the certificate for hostname on the minter thread unless it is cached or on its way '''
+        hostname = hostname.lower()
+        with self.lock:
+            if hostname in self.cache or hostname in self.pending:
+                return
+            self.pending[hostname] = self.minter.submit(self._add, hostname)
+    
+    def get_context(self, hostname):
+        hostname = hostname.lower()
+        with self.lock:
+            ctx = self.cache.get(hostname)
+            if ctx is not None:
+                self.cache.move_to_end(hostname)
+                return ctx
+            future = self.pending.get(hostname)
+        if future is not None:
+            return future.result()
+        return self._add(hostname)
     
-class ProxyServer(object):
-    '''Proxy Class'''
+    def _add(self, hostname):
+        try:
+            ctx = self._create_context(*self.mint(hostname))
+        finally:
+            with self.lock:
+                self.pending.pop(hostname, None)
+        with self.lock:
+            self.cache[hostname] = ctx
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ctx
     
-    def __init__(self, listen, target, buffer_size=4096, delay=0.0001):
-        self.input_list = set([])
-        self.sessions = {}  # sock:Session()
-        self.callbacks = {} # name: [f,..]
-        #
-        self.listen = listen
-        self.target = target
-        #
-        self.buffer_size = buffer_size
-        self.delay = delay
-        self.inbound = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.inbound.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.inbound.bind(listen)
-        self.inbound.listen(200)
-        
-    def __str__(self):
-        return "<Proxy %s listen=%s target=%s>"%(hex(id(self)),self.listen, self.target)
-
-    def get_session_by_client_sock(self, sock):
-        return self.sessions.get(sock)
-
-    def set_callback(self, name, f):
-        self.callbacks[name] = f
+    def mint(self, hostname):
+        ''' returns (certificate chain PEM, private key PEM) for hostname '''
+        import datetime
+        import ipaddress
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        key = self.keypool.get()
+        try:
+            san = x509.IPAddress(ipaddress.ip_address(hostname))
+        except ValueError:
+            san = x509.DNSName(hostname)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (x509.CertificateBuilder()
+                .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname[:64])]))
+                .issuer_name(self.ca_cert.subject)
+                .public_key(key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(days=1))
+                .not_valid_after(now + datetime.timedelta(days=365))
+                .add_extension(x509.SubjectAlternativeName([san]), critical=False)
+                .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+                .sign(self.ca_key, hashes.SHA256()))
+        logger.debug("%r - minted certificate for %s"%(self, hostname))
+        return (cert.public_bytes(serialization.Encoding.PEM) + self.ca_cert_pem,
+                key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    
+    @classmethod
+    def _create_context(cls, cert_pem, key_pem):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # load_cert_chain() only takes paths: an anonymous memory file, the key never touches a disk
+        if hasattr(os, "memfd_create"):
+            fd = os.memfd_create("striptls-cert", os.MFD_CLOEXEC)
+            try:
+                cls._write(fd, key_pem + cert_pem)
+                ctx.load_cert_chain(certfile="/proc/self/fd/%d"%fd)
+            finally:
+                os.close(fd)
+            return ctx
+        if cls.DIR is None:
+            # created once, mode 0700
+            cls.DIR = tempfile.mkdtemp(prefix="striptls-ca-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        fd, path = tempfile.mkstemp(suffix=".pem", dir=cls.DIR)
+        try:
+            cls._write(fd, key_pem + cert_pem)
+            os.close(fd)
+            fd = -1
+            ctx.load_cert_chain(certfile=path)
+        finally:
+            if fd >= 0:
+                os.close(fd)
+            os.unlink(path)
+        return ctx
+    
+    @staticmethod
+    def _write(fd, data):
+        data = memoryview(data)
+        while data:
+            data = data[os.write(fd, data):]
 
-    def main_loop(self):
-        self.input_list.add(self.inbound)
+class KeyPool(threading.Thread):
+    ''' keeps up to size pre-generated private keys ready '''
+    
+    def __init__(self, key_type="rsa", size=8):
+        threading.Thread.__init__(self, name="striptls-keypool")
+        self.daemon = True
+        self.key_type = key_type
+        self.keys = queue.Queue(maxsize=size)
+    
+    def generate(self):
+        from cryptography.hazmat.primitives.asymmetric import rsa, ec
+        if self.key_type=="ec":
+            return ec.generate_private_key(ec.SECP256R1())
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    
+    def run(self):
         while True:
-            time.sleep(self.delay)
-            inputready, _, _ =  select.select(self.input_list, [], [])
-            
-            for sock in inputready:
-                session = None
-                try:
-                    if sock == self.inbound:
-                        # on_accept
-                        session = Session(sock, target=self.target)
-                        for k,v in self.callbacks.iteritems():
-                            setattr(session, k, v)
-                        session.notify_read(sock)
-                        for s in session.get_peer_sockets():
-                            self.sessions[s]=session
-                        self.input_list.update(session.get_peer_sockets())
-                    else:
-                        # on_recv
-                        try:
-                            session = self.get_session_by_client_sock(sock)
-                            session.notify_read(sock)
-                        except SessionTerminatedException:
-                            self.input_list.difference_update(session.get_peer_sockets())
-                            logger.warning("%s terminated."%session)
-                except Exception, e:
-                    logger.warning("main: %s"%repr(e))
-                    if session:
-                        self.input_list.difference_update(session.get_peer_sockets())
-                    else:
-                        self.inbound.remove(sock)
-                    raise        
+            self.keys.put(self.generate())      # blocks while the pool is full
+    
+    def get(self):
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            logger.warning("%s - key pool exhausted, generating key inline"%self.name)
+            return self.generate()
 
 class Vectors:
     _TLS_CERTFILE = "server.pem"
     _TLS_KEYFILE = "server.pem"
+    _TLS_CONTEXT = None     # static server context for _TLS_CERTFILE
+    _CA = None              # CertificateAuthority minting per host certificates
+    
+    @staticmethod
+    def get_server_context(session):
+        ''' server side context presented to intercepted clients '''
+        if Vectors._CA:
+            return Vectors._CA.get_server_context(hostname=str(session.outbound.peer[0]))
+        if not Vectors._TLS_CONTEXT:
+            Vectors._TLS_CONTEXT = Vectors.load_server_context(Vectors._TLS_CERTFILE, Vectors._TLS_KEYFILE)
+        return Vectors._TLS_CONTEXT
+    
+    @staticmethod
+    def load_server_context(certfile, keyfile=None):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        return context
+    
     class SMTP:
         _PROTO_ID = 25
+        # server dialogue for scan.py: regexes match the end of a reply or its verdict
+        _SCAN = {'greeting': rb"(?m)^\d{3} [^\n]*\n",
+                 'capabilities': (b"EHLO striptls.local\r\n", rb"(?m)^\d{3} [^\n]*\n"),
+                 'advertised': rb"(?mi)^250[ -]STARTTLS",
+                 'plaintext': [(b"EHLO striptls.local\r\n", rb"(?m)^\d{3} [^\n]*\n"),
+                               (b"MAIL FROM:<striptls@striptls.local>\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^2")],
+                 'required': rb"(?m)^530",
+                 'starttls': (b"STARTTLS\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^220")}
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) raise exception if client tries to negotiated STARTTLS
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(e in session.outbound.sndbuf.lower() for e in ('ehlo','helo')) and "250" in data:
-                    features = [f for f in data.strip().split('\r\n') if not "STARTTLS" in f]
-                    if not features[-1].startswith("250 "):
-                        features[-1] = features[-1].replace("250-","250 ")  # end marker
-                    data = '\r\n'.join(features)+'\r\n' 
+                if session.state.state==ProtocolState.CAPABILITY and b"250" in data:
+                    lines = data.strip().split(b'\r\n')
+                    features = [f for f in lines if not b"STARTTLS" in f]
+                    if lines[-1].startswith(b"250 ") and not features[-1].startswith(b"250 "):
+                        features[-1] = features[-1].replace(b"250-",b"250 ")  # end marker
+                    data = b'\r\n'.join(features)+b'\r\n' 
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -302,16 +3183,16 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if all(kw.lower() in data.lower() for kw in ("IMAP4","* OK ")):
-                    session.inbound.sendall("OK IMAP2 Server Ready\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("OK IMAP2 Server Ready\r\n")))
+                if all(kw.lower() in data.lower() for kw in (b"IMAP4",b"* OK ")):
+                    session.inbound.sendall(b"OK IMAP2 Server Ready\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"OK IMAP2 Server Ready\r\n")))
                     data=None
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -321,20 +3202,21 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(e in session.outbound.sndbuf.lower() for e in ('ehlo','helo')) and "250" in data:
-                    features = list(data.strip().split("\r\n"))
-                    features.insert(-1,"250-STARTTLS")     # add STARTTLS from capabilities
+                if session.state.state==ProtocolState.CAPABILITY and b"\r\n250 " in b"\r\n"+data:
+                    # only the chunk holding the final capability line
+                    features = list(data.strip().split(b"\r\n"))
+                    features.insert(-1,b"250-STARTTLS")     # add STARTTLS from capabilities
                     #if "STARTTLS" in data:
                     #    features = [f for f in features if not "STARTTLS" in f]    # remove STARTTLS from capabilities
-                    data = '\r\n'.join(features)+'\r\n' 
+                    data = b'\r\n'.join(features)+b'\r\n' 
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    session.inbound.sendall("200 STRIPTLS\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("200 STRIPTLS\r\n")))
+                if b"STARTTLS" in data:
+                    session.inbound.sendall(b"200 STRIPTLS\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"200 STRIPTLS\r\n")))
                     data=None
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -346,11 +3228,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    session.inbound.sendall("454 TLS not available due to temporary reason\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("454 TLS not available due to temporary reason\r\n")))
+                if b"STARTTLS" in data:
+                    session.inbound.sendall(b"454 TLS not available due to temporary reason\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"454 TLS not available due to temporary reason\r\n")))
                     data=None
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
     
@@ -362,11 +3244,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    session.inbound.sendall("501 Syntax error\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("501 Syntax error\r\n")))
+                if b"STARTTLS" in data:
+                    session.inbound.sendall(b"501 Syntax error\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"501 Syntax error\r\n")))
                     data=None
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -375,34 +3257,33 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     # do inbound STARTTLS
-                    session.inbound.sendall("220 Go ahead\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("220 Go ahead\r\n")))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    session.inbound.sendall(b"220 Go ahead\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"220 Go ahead\r\n")))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if "220" not in resp_data:
+                    if b"220" not in resp_data:
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -414,11 +3295,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if data.lower().startswith("ehlo "):
-                    session.inbound.sendall("502 Error: command \"EHLO\" not implemented\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("502 Error: command \"EHLO\" not implemented\r\n")))
+                if data.lower().startswith(b"ehlo "):
+                    session.inbound.sendall(b"502 Error: command \"EHLO\" not implemented\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"502 Error: command \"EHLO\" not implemented\r\n")))
                     data=None
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
             
@@ -426,25 +3307,32 @@ class Vectors:
             ''' 1) Append command to STARTTLS\r\n.
                 2) untrusted intercept to check if we get an invalid command response from server
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    data += "INJECTED_INVALID_COMMAND\r\n"
+                if b"STARTTLS" in data:
+                    data += b"INJECTED_INVALID_COMMAND\r\n"
                     #logging.debug("%s [client] => [server][mangled] %s"%(session,repr(data)))
                     try:
-                        Vectors.SMTP.UntrustedIntercept.mangle_client_data(session, data, rewrite)
-                    except ssl.SSLEOFError, se:
+                        data = Vectors.SMTP.UntrustedIntercept.mangle_client_data(session, data, rewrite)
+                    except ssl.SSLEOFError as se:
                         logging.info("%s - Server failed to negotiate SSL with Exception: %s"%(session, repr(se))) 
                         session.close()
-                elif "mail from" in data.lower():
+                elif b"mail from" in data.lower():
                     rewrite.set_result(session, True)
                 return data
     
     class POP3:
         _PROTO_ID = 110
+        _SCAN = {'greeting': rb"\n",
+                 'capabilities': (b"CAPA\r\n", rb"(?m)^(\.|-ERR[^\n]*)\r?\n"),
+                 'advertised': rb"(?mi)^STLS",
+                 'plaintext': [(b"USER striptls\r\n", rb"\n", rb"^\+OK")],
+                 'required': rb"(?mi)^-ERR.*(tls|ssl|secur|encrypt)",
+                 'starttls': (b"STLS\r\n", rb"\n", rb"^\+OK")}
 
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STLS support
@@ -452,15 +3340,15 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if data.lower().startswith('+ok capability'):
-                    features = [f for f in data.strip().split('\r\n') if not "stls" in f.lower()]
-                    data = '\r\n'.join(features)+'\r\n'
+                if data.lower().startswith(b'+ok capability'):
+                    features = [f for f in data.strip().split(b'\r\n') if not b"stls" in f.lower()]
+                    data = b'\r\n'.join(features)+b'\r\n'
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if data.lower().startswith("stls"):
+                if data.lower().startswith(b"stls"):
                     raise ProtocolViolationException("whoop!? client sent STLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif any(c in data.lower() for c in ('list','user ','pass ')):
+                elif any(c in data.lower() for c in (b'list',b'user ',b'pass ')):
                     rewrite.set_result(session, True)
                 return data
 
@@ -472,11 +3360,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "stls" == data.strip().lower():
-                    session.inbound.sendall("-ERR unknown command\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("-ERR unknown command\r\n")))
+                if b"stls" == data.strip().lower():
+                    session.inbound.sendall(b"-ERR unknown command\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"-ERR unknown command\r\n")))
                     data=None
-                elif any(c in data.lower() for c in ('list','user ','pass ')):
+                elif any(c in data.lower() for c in (b'list',b'user ',b'pass ')):
                     rewrite.set_result(session, True)
                 return data
     
@@ -485,54 +3373,60 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "stls"==data.strip().lower():
+                if b"stls"==data.strip().lower():
                     # do inbound STARTTLS
-                    session.inbound.sendall("+OK Begin TLS negotiation\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("+OK Begin TLS negotiation\r\n")))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_CERTFILE)
+                    session.inbound.sendall(b"+OK Begin TLS negotiation\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"+OK Begin TLS negotiation\r\n")))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if "+OK" not in resp_data:
+                    if b"+OK" not in resp_data:
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif any(c in data.lower() for c in ('list','user ','pass ')):
+                elif any(c in data.lower() for c in (b'list',b'user ',b'pass ')):
                     rewrite.set_result(session, True)
                 return data
             
     class IMAP:
         _PROTO_ID = 143
+        _SCAN = {'greeting': rb"\n",
+                 'capabilities': (b"a001 CAPABILITY\r\n", rb"(?m)^a001 [^\n]*\n"),
+                 'advertised': rb"(?i)STARTTLS",
+                 'plaintext': None,
+                 'required': rb"(?i)LOGINDISABLED",
+                 'starttls': (b"a002 STARTTLS\r\n", rb"(?m)^a002 [^\n]*\n", rb"(?m)^a002 OK")}
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) raise exception if client tries to negotiated STARTTLS
             '''
+            _GREETING = True    # acts on the server greeting, see RewriteDispatcher.get_mangle
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if "CAPABILITY " in data:
+                if b"CAPABILITY " in data:
                     # rfc2595
-                    data = data.replace(" STARTTLS","").replace(" LOGINDISABLED","")
+                    data = data.replace(b" STARTTLS",b"").replace(b" LOGINDISABLED",b"")
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if " STARTTLS" in data:
+                if b" STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif " LOGIN " in data:
+                elif b" LOGIN " in data:
                     rewrite.set_result(session, True)
                 return data
             
@@ -544,12 +3438,12 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if data.strip().lower().endswith("starttls"):
-                    id = data.split(' ',1)[0].strip()
-                    session.inbound.sendall("%s BAD unknown command\r\n"%id)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("%s BAD unknown command\r\n"%id)))
+                if data.strip().lower().endswith(b"starttls"):
+                    id = data.split(b' ',1)[0].strip()
+                    session.inbound.sendall(b"%s BAD unknown command\r\n"%id)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"%s BAD unknown command\r\n"%id)))
                     data=None
-                elif " LOGIN " in data:
+                elif b" LOGIN " in data:
                     rewrite.set_result(session, True)
                 return data
     
@@ -558,56 +3452,61 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if data.strip().lower().endswith("starttls"):
-                    id = data.split(' ',1)[0].strip()
+                if data.strip().lower().endswith(b"starttls"):
+                    id = data.split(b' ',1)[0].strip()
                     # do inbound STARTTLS
-                    session.inbound.sendall("%s OK Begin TLS negotation now\r\n"%id)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("%s OK Begin TLS negotation now\r\n"%id)))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_CERTFILE)
+                    session.inbound.sendall(b"%s OK Begin TLS negotation now\r\n"%id)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"%s OK Begin TLS negotation now\r\n"%id)))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if "%s OK"%id not in resp_data:
+                    if b"%s OK"%id not in resp_data:
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif " LOGIN " in data:
+                elif b" LOGIN " in data:
                     rewrite.set_result(session, True)
                 return data
             
     class FTP:
         _PROTO_ID = 21
+        _SCAN = {'greeting': rb"(?m)^\d{3} [^\n]*\n",
+                 'capabilities': (b"FEAT\r\n", rb"(?m)^\d{3} [^\n]*\n"),
+                 'advertised': rb"(?mi)^ ?AUTH [^\n]*TLS",
+                 'plaintext': [(b"USER anonymous\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^(2|331)")],
+                 'required': rb"(?m)^(530|534|550)[ -].*(?i:tls|ssl|secur|encrypt)",
+                 'starttls': (b"AUTH TLS\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^234")}
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce AUTH TLS support
                 2) raise exception if client tries to negotiated AUTH TLS
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if session.outbound.sndbuf.strip().lower()=="feat" \
-                    and "AUTH TLS" in data:
-                    features = (f for f in data.strip().split('\n') if not "AUTH TLS" in f)
-                    data = '\n'.join(features)+"\r\n"
+                if session.state.state==ProtocolState.CAPABILITY \
+                    and b"AUTH TLS" in data:
+                    features = (f for f in data.strip().split(b'\n') if not b"AUTH TLS" in f)
+                    data = b'\n'.join(features)+b"\r\n"
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "AUTH TLS" in data:
+                if b"AUTH TLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif "USER " in data:
+                elif b"USER " in data:
                     rewrite.set_result(session, True)
                 return data
         
@@ -619,11 +3518,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "AUTH TLS" in data:
-                    session.inbound.sendall("500 AUTH TLS not understood\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("500 AUTH TLS not understood\r\n")))
+                if b"AUTH TLS" in data:
+                    session.inbound.sendall(b"500 AUTH TLS not understood\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"500 AUTH TLS not understood\r\n")))
                     data=None
-                elif "USER " in data:
+                elif b"USER " in data:
                     rewrite.set_result(session, True)
                 return data
     
@@ -632,55 +3531,60 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "AUTH TLS" in data:
+                if b"AUTH TLS" in data:
                     # do inbound STARTTLS
-                    session.inbound.sendall("234 OK Begin TLS negotation now\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("234 OK Begin TLS negotation now\r\n")))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    session.inbound.sendall(b"234 OK Begin TLS negotation now\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"234 OK Begin TLS negotation now\r\n")))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if not resp_data.startswith("234"):
+                    if not resp_data.startswith(b"234"):
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif "USER " in data:
+                elif b"USER " in data:
                     rewrite.set_result(session, True)
                 return data
             
     class NNTP:
         _PROTO_ID = 119
+        _SCAN = {'greeting': rb"(?m)^\d{3} [^\n]*\n",
+                 'capabilities': (b"CAPABILITIES\r\n", rb"(?m)^(\.\r?\n|[45]\d\d [^\n]*\n)"),
+                 'advertised': rb"(?mi)^STARTTLS",
+                 'plaintext': [(b"AUTHINFO USER striptls\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^(2|381)")],
+                 'required': rb"(?m)^483",
+                 'starttls': (b"STARTTLS\r\n", rb"(?m)^\d{3} [^\n]*\n", rb"^382")}
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) raise exception if client tries to negotiated STARTTLS
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if session.outbound.sndbuf.strip().lower()=="capabilities" \
-                    and "STARTTLS" in data:
-                    features = (f for f in data.strip().split('\n') if not "STARTTLS" in f)
-                    data = '\n'.join(features)+"\r\n"
+                if session.state.state==ProtocolState.CAPABILITY \
+                    and b"STARTTLS" in data:
+                    features = (f for f in data.strip().split(b'\n') if not b"STARTTLS" in f)
+                    data = b'\n'.join(features)+b"\r\n"
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif "GROUP " in data:
+                elif b"GROUP " in data:
                     rewrite.set_result(session, True)
                 return data
         
@@ -692,11 +3596,11 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    session.inbound.sendall("502 Command unavailable\r\n")  # or 580 Can not initiate TLS negotiation
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("502 Command unavailable\r\n")))
+                if b"STARTTLS" in data:
+                    session.inbound.sendall(b"502 Command unavailable\r\n")  # or 580 Can not initiate TLS negotiation
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"502 Command unavailable\r\n")))
                     data=None
-                elif "GROUP " in data:
+                elif b"GROUP " in data:
                     rewrite.set_result(session, True)
                 return data
     
@@ -705,59 +3609,66 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     # do inbound STARTTLS
-                    session.inbound.sendall("382 Continue with TLS negotiation\r\n")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("382 Continue with TLS negotiation\r\n")))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    session.inbound.sendall(b"382 Continue with TLS negotiation\r\n")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"382 Continue with TLS negotiation\r\n")))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if not resp_data.startswith("382"):
+                    if not resp_data.startswith(b"382"):
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif "GROUP " in data:
+                elif b"GROUP " in data:
                     rewrite.set_result(session, True)
                 return data
     
     class XMPP:
         _PROTO_ID = 5222
+        _SCAN = {'greeting': None,
+                 'capabilities': (b"<?xml version='1.0'?><stream:stream to='%(host)s' xmlns='jabber:client' "
+                                  b"xmlns:stream='http://etherx.jabber.org/streams' version='1.0'>",
+                                  rb"</stream:features>|<stream:features/>|</stream:stream>"),
+                 'advertised': rb"<starttls",
+                 'plaintext': None,
+                 'required': rb"<starttls[^>]*>\s*<required",
+                 'starttls': (b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>", rb"<proceed|<failure", rb"<proceed")}
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) raise exception if client tries to negotiated STARTTLS
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if "<starttls" in data:
-                    start = data.index("<starttls")
-                    end = data.index("</starttls>",start)+len("</starttls>")
+                if b"<starttls" in data:
+                    start = data.index(b"<starttls")
+                    end = data.index(b"</starttls>",start)+len(b"</starttls>")
                     data = data[:start] + data[end:]        # strip starttls from capabilities
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "<starttls" in data:
+                if b"<starttls" in data:
                     # do not respond with <proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>
                     #<failure/> or <proceed/>
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
                     #session.inbound.sendall("<success xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")  # fake respone
                     #data=None
-                elif any(c in data.lower() for c in ("</auth>","<query","<iq","<username")):
+                elif any(c in data.lower() for c in (b"</auth>",b"<query",b"<iq",b"<username")):
                     rewrite.set_result(session, True)
                 return data 
 
@@ -765,19 +3676,20 @@ class Vectors:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) If starttls is required outbound, leave inbound connection plain - outbound starttls
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if "<starttls" in data:
-                    start = data.index("<starttls")
-                    end = data.index("</starttls>",start)+len("</starttls>")
+                if b"<starttls" in data:
+                    start = data.index(b"<starttls")
+                    end = data.index(b"</starttls>",start)+len(b"</starttls>")
                     starttls_args = data[start:end]
                     data = data[:start] + data[end:]        # strip inbound starttls
-                    if "required" in starttls_args:
+                    if b"required" in starttls_args:
                         # do outbound starttls as required by server
-                        session.outbound.sendall("<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
-                        logging.debug("%s [client] => [server][mangled] %s"%(session,repr("<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")))
-                        resp_data = session.outbound.recv()
-                        if not resp_data.startswith("<proceed "):
+                        session.outbound.sendall(b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
+                        logging.debug("%s [client] => [server][mangled] %s"%(session,repr(b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")))
+                        resp_data = session.outbound.recv().tobytes()
+                        if not resp_data.startswith(b"<proceed "):
                             raise ProtocolViolationException("whoop!? server announced STARTTLS *required* but fails to proceed.  proto violation: %s"%repr(resp_data))
 
                         logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
@@ -786,13 +3698,13 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "<starttls" in data:
+                if b"<starttls" in data:
                     # do not respond with <proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>
                     #<failure/> or <proceed/>
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
                     #session.inbound.sendall("<success xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")  # fake respone
                     #data=None
-                elif any(c in data.lower() for c in ("</auth>","<query","<iq","<username")):
+                elif any(c in data.lower() for c in (b"</auth>",b"<query",b"<iq",b"<username")):
                     rewrite.set_result(session, True)
                 return data
 
@@ -801,56 +3713,62 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "<starttls " in data:
+                if b"<starttls " in data:
                     # do inbound STARTTLS
-                    session.inbound.sendall("<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE,
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    session.inbound.sendall(b"<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
 
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if not resp_data.startswith("<proceed "):
+                    if not resp_data.startswith(b"<proceed "):
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
 
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
 
                     data=None
-                elif "</auth>" in data:
+                elif b"</auth>" in data:
                     rewrite.set_result(session, True)
                 return data
 
     class ACAP:
         #rfc2244, rfc2595
         _PROTO_ID = 675
-        _REX_CAP = re.compile(r"\(([^\)]+)\)")
+        _SCAN = {'greeting': rb"\n",
+                 'capabilities': None,
+                 'advertised': rb"(?i)\(STARTTLS\)",
+                 'plaintext': None,
+                 'required': None,
+                 'starttls': (b"a001 STARTTLS\r\n", rb"(?m)^a001 [^\n]*\n", rb"(?m)^a001 OK")}
+        _REX_CAP = re.compile(rb"\(([^\)]+)\)")
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
                 2) raise exception if client tries to negotiated STARTTLS
             '''
+            _GREETING = True    # acts on the server greeting, see RewriteDispatcher.get_mangle
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if all(kw in data for kw in ("ACAP","STARTTLS")):
+                if all(kw in data for kw in (b"ACAP",b"STARTTLS")):
                     features = Vectors.ACAP._REX_CAP.findall(data)  # features w/o parentheses
-                    data = ' '.join("(%s)"%f for f in features if not "STARTTLS" in f)
+                    data = b' '.join(b"(%s)"%f for f in features if not b"STARTTLS" in f)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if " STARTTLS" in data:
+                if b" STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
-                elif " AUTHENTICATE " in data:       
+                elif b" AUTHENTICATE " in data:       
                     rewrite.set_result(session, True)
                 return data
         
@@ -862,12 +3780,12 @@ class Vectors:
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if " STARTTLS" in data:
-                    id = data.split(' ',1)[0].strip()
-                    session.inbound.sendall('%s BAD "command unknown or arguments invalid"'%id)  # or 580 Can not initiate TLS negotiation
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr('%s BAD "command unknown or arguments invalid"'%id)))
+                if b" STARTTLS" in data:
+                    id = data.split(b' ',1)[0].strip()
+                    session.inbound.sendall(b'%s BAD "command unknown or arguments invalid"'%id)  # or 580 Can not initiate TLS negotiation
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b'%s BAD "command unknown or arguments invalid"'%id)))
                     data=None
-                elif " AUTHENTICATE " in data:
+                elif b" AUTHENTICATE " in data:
                     rewrite.set_result(session, True)
                 return data
     
@@ -876,42 +3794,47 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if " STARTTLS" in data:
+                if b" STARTTLS" in data:
                     # do inbound STARTTLS
-                    id = data.split(' ',1)[0].strip()
-                    session.inbound.sendall('%s OK "Begin TLS negotiation now"'%id)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr('%s OK "Begin TLS negotiation now"'%id)))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    id = data.split(b' ',1)[0].strip()
+                    session.inbound.sendall(b'%s OK "Begin TLS negotiation now"'%id)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b'%s OK "Begin TLS negotiation now"'%id)))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if not " OK " in resp_data:
+                    if not b" OK " in resp_data:
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif " AUTHENTICATE " in data:
+                elif b" AUTHENTICATE " in data:
                     rewrite.set_result(session, True)
                 return data
 
     class IRC:
         #rfc2244, rfc2595
         _PROTO_ID = 6667
-        _REX_CAP = re.compile(r"\(([^\)]+)\)")
+        _SCAN = {'greeting': None,
+                 'capabilities': (b"CAP LS\r\n", rb"CAP \S+ LS :[^\n]*\n"),
+                 'advertised': rb"(?i)CAP \S+ LS [^\n]*\btls\b",
+                 'plaintext': None,
+                 'required': None,
+                 'starttls': (b"STARTTLS\r\n", rb"(?m)^:\S+ (670|691) [^\n]*\n", rb" 670 ")}
+        _REX_CAP = re.compile(rb"\(([^\)]+)\)")
         _IDENT_PORT = 113
         class StripFromCapabilities:
             ''' 1) Force Server response to *NOT* announce STARTTLS support
@@ -919,24 +3842,24 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if all(kw.lower() in data.lower() for kw in (" cap "," tls")):
+                if all(kw.lower() in data.lower() for kw in (b" cap ",b" tls")):
                     mangled = []
-                    for line in data.split("\n"):
-                        if all(kw.lower() in line.lower() for kw in (" cap "," tls")):
+                    for line in data.split(b"\n"):
+                        if all(kw.lower() in line.lower() for kw in (b" cap ",b" tls")):
                             # can be CAP LS or CAP ACK/NACK
-                            if " ack " in data.lower():
-                                line = line.replace("ACK","NAK").replace("ack","nak")
+                            if b" ack " in data.lower():
+                                line = line.replace(b"ACK",b"NAK").replace(b"ack",b"nak")
                             else:   #ls
-                                features = line.split(" ")
-                                line = ' '.join(f for f in features if not 'tls' in f.lower())
+                                features = line.split(b" ")
+                                line = b' '.join(f for f in features if not b'tls' in f.lower())
                         mangled.append(line)
-                    data = "\n".join(mangled)
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                    data = b"\n".join(mangled)
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
-                return 
+                return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(data))
                 #elif all(kw.lower() in data.lower() for kw in ("cap req","tls")):
                 #    # mangle CAPABILITY REQUEST
@@ -944,7 +3867,7 @@ class Vectors:
                 #        cmd, caps = data.split(":")
                 #        caps = (c for c in caps.split(" ") if not "tls" in c.lower())
                 #        data="%s:%s"%(cmd,' '.join(caps))
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
         
@@ -953,29 +3876,23 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                if any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    params = {'srv':'this.server.com',
-                              'nickname': '*',
-                              'cmd': 'STARTTLS'
+                if b"STARTTLS" in data:
+                    params = {b'srv':b'this.server.com',
+                              b'nickname': b'*',
+                              b'cmd': b'STARTTLS'
                               }
-                    # if we're lucky we can extract the username from a prev. server line
-                    prev_response = session.outbound.recvbuf.strip()
-                    if prev_response:  
-                        fields = prev_response.split(" ")
-                        try:
-                            params['srv'] = fields[0]
-                            params['nickname'] = fields[2]
-                        except IndexError:
-                            pass
-                    session.inbound.sendall("%(srv)s 691 %(nickname)s :%(cmd)s\r\n"%params)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("%(srv)s 691 %(nickname)s :%(cmd)s\r\n"%params)))
+                    # server name and nickname as seen by the protocol tracker
+                    params[b'srv'] = session.state.server_name or params[b'srv']
+                    params[b'nickname'] = session.state.nickname or params[b'nickname']
+                    session.inbound.sendall(b":%(srv)s 691 %(nickname)s :%(cmd)s\r\n"%params)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b":%(srv)s 691 %(nickname)s :%(cmd)s\r\n"%params)))
                     data=None
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
         
@@ -984,29 +3901,23 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                if any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
-                    params = {'srv':'this.server.com',
-                              'nickname': '*',
-                              'cmd': 'You have not registered'
+                if b"STARTTLS" in data:
+                    params = {b'srv':b'this.server.com',
+                              b'nickname': b'*',
+                              b'cmd': b'You have not registered'
                               }
-                    # if we're lucky we can extract the username from a prev. server line
-                    prev_response = session.outbound.recvbuf.strip()
-                    if prev_response:  
-                        fields = prev_response.split(" ")
-                        try:
-                            params['srv'] = fields[0]
-                            params['nickname'] = fields[2]
-                        except IndexError:
-                            pass
-                    session.inbound.sendall("%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)))
+                    # server name and nickname as seen by the protocol tracker
+                    params[b'srv'] = session.state.server_name or params[b'srv']
+                    params[b'nickname'] = session.state.nickname or params[b'nickname']
+                    session.inbound.sendall(b":%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b":%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)))
                     data=None
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             
@@ -1015,29 +3926,23 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                if any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "CAP LS" in data:
-                    params = {'srv':'this.server.com',
-                              'nickname': '*',
-                              'cmd': 'You have not registered'
+                if b"CAP LS" in data:
+                    params = {b'srv':b'this.server.com',
+                              b'nickname': b'*',
+                              b'cmd': b'You have not registered'
                               }
-                    # if we're lucky we can extract the username from a prev. server line
-                    prev_response = session.outbound.recvbuf.strip()
-                    if prev_response:  
-                        fields = prev_response.split(" ")
-                        try:
-                            params['srv'] = fields[0]
-                            params['nickname'] = fields[2]
-                        except IndexError:
-                            pass
-                    session.inbound.sendall("%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr("%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)))
+                    # server name and nickname as seen by the protocol tracker
+                    params[b'srv'] = session.state.server_name or params[b'srv']
+                    params[b'nickname'] = session.state.nickname or params[b'nickname']
+                    session.inbound.sendall(b":%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b":%(srv)s 451 %(nickname)s :%(cmd)s\r\n"%params)))
                     data=None
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             
@@ -1046,14 +3951,14 @@ class Vectors:
             '''
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                if any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     data=None
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
     
@@ -1062,91 +3967,915 @@ class Vectors:
                 2) intercept client STARTLS, negotiated ssl_context with client and one with server, untrusted.
                    in case client does not check keys
             '''
+            _TLS = True
             @staticmethod
             def mangle_server_data(session, data, rewrite):
-                if " ident " in data.lower():
+                if b" ident " in data.lower():
                     #TODO: proxy ident
                     pass
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
                     rewrite.set_result(session, True)
                 return data
             @staticmethod
             def mangle_client_data(session, data, rewrite):
-                if "STARTTLS" in data:
+                if b"STARTTLS" in data:
                     # do inbound STARTTLS
-                    params = {'srv':'this.server.com',
-                              'nickname': '*',
-                              'cmd': 'STARTTLS'
+                    params = {b'srv':b'this.server.com',
+                              b'nickname': b'*',
+                              b'cmd': b'STARTTLS'
                               }
-                    # if we're lucky we can extract the username from a prev. server line
-                    prev_response = session.outbound.recvbuf.strip()
-                    if prev_response:  
-                        fields = prev_response.split(" ")
-                        try:
-                            params['srv'] = fields[0]
-                            params['nickname'] = fields[2]
-                        except IndexError:
-                            pass
-                    session.inbound.sendall(":%(srv)s 670 %(nickname)s :STARTTLS successful, go ahead with TLS handshake\r\n"%params)
-                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(":%(srv)s 670 %(nickname)s :STARTTLS successful, go ahead with TLS handshake\r\n"%params)))
-                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                    context.load_cert_chain(certfile=Vectors._TLS_CERTFILE, 
-                                            keyfile=Vectors._TLS_KEYFILE)
+                    # server name and nickname as seen by the protocol tracker
+                    params[b'srv'] = session.state.server_name or params[b'srv']
+                    params[b'nickname'] = session.state.nickname or params[b'nickname']
+                    session.inbound.sendall(b":%(srv)s 670 %(nickname)s :STARTTLS successful, go ahead with TLS handshake\r\n"%params)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b":%(srv)s 670 %(nickname)s :STARTTLS successful, go ahead with TLS handshake\r\n"%params)))
+                    context = Vectors.get_server_context(session)
                     session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
                     logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
                     # outbound ssl
                     
                     session.outbound.sendall(data)
                     logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-                    resp_data = session.outbound.recv()
+                    resp_data = session.outbound.recv().tobytes()
                     logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
-                    if not " 670 " in resp_data:
+                    if not b" 670 " in resp_data:
                         raise ProtocolViolationException("whoop!? client sent STARTTLS even though we did not announce it.. proto violation: %s"%repr(resp_data))
                     
                     logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
                     session.outbound.ssl_wrap_socket()
     
                     data=None
-                elif any(kw.lower() in data.lower() for kw in ('authenticate ','privmsg ', 'protoctl ')):
+                elif any(kw.lower() in data.lower() for kw in (b'authenticate ',b'privmsg ', b'protoctl ')):
+                    rewrite.set_result(session, True)
+                return data
+    
+    # binary protocols: _RAW vectors get a bytearray and patch bytes in place,
+    # messages are found with the trackers Framing
+    class LDAP:
+        _PROTO_ID = 389
+        _STRIPPED_OID = b"1.3.6.1.4.1.1466.99999"  # same length as LDAPState.STARTTLS_OID
+        
+        class StripFromCapabilities:
+            ''' 1) Replace the StartTLS OID in the rootDSE supportedExtension values with an unknown one
+                2) raise exception if client tries to negotiate StartTLS
+            '''
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                for message_id, op, start, end in session.state.read_messages(LDAPState.SERVER, data):
+                    if op==LDAPState.SEARCH_RESULT_ENTRY:
+                        pos = data.find(LDAPState.STARTTLS_OID, start, end)
+                        while pos >= 0:
+                            data[pos:pos+len(Vectors.LDAP._STRIPPED_OID)] = Vectors.LDAP._STRIPPED_OID
+                            pos = data.find(LDAPState.STARTTLS_OID, pos, end)
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                for message_id, op, start, end in session.state.read_messages(LDAPState.CLIENT, data):
+                    if LDAPState.is_starttls(data, op, start, end):
+                        raise ProtocolViolationException("whoop!? client sent StartTLS even though we did not announce it.. proto violation: %s"%repr(data))
+                    elif op==LDAPState.BIND_REQUEST:
+                        rewrite.set_result(session, True)
+                return data
+        
+        class StripWithError:
+            ''' 1) force server error (unavailable) on client sending StartTLS
+            '''
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                split = session.state.split_header(LDAPState.CLIENT)
+                for i, (message_id, op, start, end) in enumerate(session.state.read_messages(LDAPState.CLIENT, data)):
+                    if LDAPState.is_starttls(data, op, start, end) and i==0 and split:
+                        # cannot be dropped, ask for an unknown extended operation instead: the server refuses it
+                        pos = data.find(LDAPState.STARTTLS_OID, start, end)
+                        data[pos:pos+len(Vectors.LDAP._STRIPPED_OID)] = Vectors.LDAP._STRIPPED_OID
+                    elif LDAPState.is_starttls(data, op, start, end):
+                        response = LDAPState.extended_response(message_id, 52, b"StartTLS not supported")
+                        session.inbound.sendall(response)
+                        logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(response)))
+                        data=None
+                        break
+                    elif op==LDAPState.BIND_REQUEST:
+                        rewrite.set_result(session, True)
+                return data
+        
+        class UntrustedIntercept:
+            ''' 1) Do not mangle server data
+                2) intercept client StartTLS, negotiated ssl_context with client and one with server, untrusted.
+                   in case client does not check keys
+            '''
+            _TLS = True
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                for message_id, op, start, end in session.state.read_messages(LDAPState.CLIENT, data):
+                    if LDAPState.is_starttls(data, op, start, end):
+                        # the servers response carries the clients message id
+                        session.outbound.sendall(data)
+                        logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
+                        resp_data = session.outbound.recv().tobytes()
+                        while resp_data and not LDAPState.MESSAGE.split(resp_data)[0]:
+                            # response split across reads
+                            chunk = session.outbound.recv().tobytes()
+                            if not chunk:
+                                break
+                            resp_data += chunk
+                        logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
+                        if not any(op==LDAPState.EXTENDED_RESPONSE and LDAPState.result_code(resp_data, start, end)==0
+                                   for _, op, start, end in LDAPState.messages(resp_data)):
+                            raise ProtocolViolationException("whoop!? server refused StartTLS.. proto violation: %s"%repr(resp_data))
+                        # do inbound StartTLS
+                        session.inbound.sendall(resp_data)
+                        context = Vectors.get_server_context(session)
+                        session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
+                        logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
+                        logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
+                        session.outbound.ssl_wrap_socket()
+                        data=None
+                        break
+                    elif op==LDAPState.BIND_REQUEST:
+                        rewrite.set_result(session, True)
+                return data
+    
+    class PGSQL:
+        _PROTO_ID = 5432
+        
+        @staticmethod
+        def _startup_code(session, data):
+            ''' code of the startup packet (SSLRequest, StartupMessage) in data, None after startup '''
+            if session.state.framing[ProtocolState.CLIENT] is not PGSQLState.STARTUP:
+                return None
+            header = PGSQLState.STARTUP.header(data)
+            return header[2] if header else None
+        
+        class StripFromCapabilities:
+            ''' 1) Answer SSLRequest with N (server does not support ssl)
+            '''
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                code = Vectors.PGSQL._startup_code(session, data)
+                if code==PGSQLState.SSL_REQUEST:
+                    session.inbound.sendall(b"N")
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(b"N")))
+                    data=None
+                elif code==PGSQLState.PROTOCOL_3:
+                    rewrite.set_result(session, True)
+                return data
+        
+        class StripWithError:
+            ''' 1) force server error (ErrorResponse) on client sending SSLRequest
+            '''
+            _RAW = True
+            _ERROR = b"SFATAL\0VFATAL\0C08P01\0Munsupported frontend protocol\0\0"
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                code = Vectors.PGSQL._startup_code(session, data)
+                if code==PGSQLState.SSL_REQUEST:
+                    error = b"E" + struct.pack("!I", 4 + len(Vectors.PGSQL.StripWithError._ERROR)) + Vectors.PGSQL.StripWithError._ERROR
+                    session.inbound.sendall(error)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(error)))
+                    data=None
+                elif code==PGSQLState.PROTOCOL_3:
                     rewrite.set_result(session, True)
                 return data
+        
+        class UntrustedIntercept:
+            ''' 1) Do not mangle server data
+                2) intercept client SSLRequest, negotiated ssl_context with client and one with server, untrusted.
+                   in case client does not check keys
+            '''
+            _TLS = True
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                code = Vectors.PGSQL._startup_code(session, data)
+                if code==PGSQLState.SSL_REQUEST:
+                    session.outbound.sendall(data)
+                    logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
+                    resp_data = session.outbound.recv().tobytes()
+                    logging.debug("%s          <= [server]          %s"%(session,repr(resp_data)))
+                    if resp_data!=b"S":
+                        raise ProtocolViolationException("whoop!? server refused SSLRequest.. proto violation: %s"%repr(resp_data))
+                    # do inbound ssl
+                    session.inbound.sendall(b"S")
+                    context = Vectors.get_server_context(session)
+                    session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
+                    logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
+                    logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
+                    session.outbound.ssl_wrap_socket()
+                    data=None
+                elif code==PGSQLState.PROTOCOL_3:
+                    rewrite.set_result(session, True)
+                return data
+    
+    class MYSQL:
+        _PROTO_ID = 3306
+        
+        @staticmethod
+        def _handshake(session, data):
+            ''' payload of the clients SSLRequest/HandshakeResponse in data, None after it.
+                a HandshakeResponse may be cut short by the read size (see UntrustedIntercept),
+                it never has CLIENT_SSL set in plaintext.
+            '''
+            if session.state.authenticated or session.state.pending is not None:
+                return None
+            header = MySQLState.PACKET.header(data)
+            if header is None:
+                return None
+            return memoryview(data)[header[0]:header[0]+header[1]]
+        
+        class StripFromCapabilities:
+            ''' 1) Clear CLIENT_SSL in the server greetings capability flags (in place)
+                2) raise exception if client tries to negotiate ssl
+            '''
+            _RAW = True
+            _GREETING = True    # acts on the server greeting, see RewriteDispatcher.get_mangle
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                if session.state.state==ProtocolState.GREETING:
+                    for pos, hlen, nbytes, seq in MySQLState.PACKET.split(data)[0]:
+                        offset = MySQLState.greeting_flags_offset(memoryview(data)[pos+hlen:pos+hlen+nbytes])
+                        if seq==0 and offset is not None:
+                            # flags are little endian, CLIENT_SSL is in the second byte
+                            data[pos+hlen+offset+1] &= ~(MySQLState.CLIENT_SSL >> 8) & 0xff
+                        break
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                payload = Vectors.MYSQL._handshake(session, data)
+                if payload is None:
+                    return data
+                if MySQLState.is_ssl_request(payload):
+                    raise ProtocolViolationException("whoop!? client requested ssl even though we did not announce it.. proto violation: %s"%repr(data))
+                rewrite.set_result(session, True)
+                return data
+        
+        class StripWithError:
+            ''' 1) force server error (ER_HANDSHAKE_ERROR) on client sending SSLRequest
+            '''
+            _RAW = True
+            _ERROR = b"\xff" + struct.pack("<H", 1043) + b"#08S01Bad handshake"
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                if session.state.state==ProtocolState.STARTTLS and data[:2]==b"\x16\x03":
+                    # tls ClientHello, clients do not wait for an answer to SSLRequest
+                    return None
+                payload = Vectors.MYSQL._handshake(session, data)
+                if payload is None:
+                    return data
+                if MySQLState.is_ssl_request(payload):
+                    error = Vectors.MYSQL.StripWithError._ERROR
+                    error = struct.pack("<I", len(error))[:3] + bytes(((data[3]+1) & 0xff,)) + error
+                    session.inbound.sendall(error)
+                    logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(error)))
+                    session.state.set_state(ProtocolState.STARTTLS)
+                    return None
+                rewrite.set_result(session, True)
+                return data
+        
+        class UntrustedIntercept:
+            ''' 1) Do not mangle server data
+                2) intercept client SSLRequest, negotiated ssl_context with client and one with server, untrusted.
+                   in case client does not check keys
+            '''
+            _TLS = True
+            _RAW = True
+            @staticmethod
+            def mangle_server_data(session, data, rewrite):
+                if session.state.state==ProtocolState.GREETING:
+                    # read no more than an SSLRequest, the ClientHello that follows it belongs to the tls handshake
+                    session.inbound.rsize = 4 + MySQLState.SSL_REQUEST_SIZE
+                return data
+            @staticmethod
+            def mangle_client_data(session, data, rewrite):
+                payload = Vectors.MYSQL._handshake(session, data)
+                if payload is None:
+                    return data
+                if MySQLState.is_ssl_request(payload):
+                    if not session.state.server_flags & MySQLState.CLIENT_SSL:
+                        raise ProtocolViolationException("whoop!? client requested ssl even though the server did not announce it.. proto violation: %s"%repr(data))
+                    # there is no answer, both peers start the handshake right away
+                    context = Vectors.get_server_context(session)
+                    session.inbound.ssl_wrap_socket_with_context(context, server_side=True)
+                    logging.debug("%s [client] <= [server][mangled] waiting for inbound SSL Handshake"%(session))
+                    session.outbound.sendall(data)
+                    logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
+                    logging.debug("%s [client] => [server][mangled] performing outbound SSL handshake"%(session))
+                    session.outbound.ssl_wrap_socket()
+                    return None
+                rewrite.set_result(session, True)
+                return data
+
+
+class Result(object):
+    ''' audit record: vector (mangle) tried against a target by a client and
+        its verdict, shared by all sessions of that client/target/vector
+    '''
+    __slots__ = ('client', 'target', 'mangle', 'result', 'sessions')
+    
+    def __init__(self, client, target, mangle, result=None):
+        self.client = client
+        self.target = target
+        self.mangle = mangle
+        self.result = result
+        self.sessions = 0
+    
+    def __repr__(self):
+        return "<Result client=%s target=%s mangle=%s result=%s sessions=%d>"%(self.client, self.target, self.mangle,
+                                                                               self.result, self.sessions)
+
+class ResultReporter(object):
+    ''' Streams audit records to a collector (python -m striptls collector).
+        
+        @param address: (host, port) or unix socket path of the collector
+        @param node: name of this proxy in the merged report
+        @param spool: file records are kept in while the collector is unreachable
+        
+        submit() only records the latest state of a Result, a background
+        thread sends what changed every interval seconds (or once BATCH
+        records are pending) as JSON lines terminated by an empty line, the
+        collector acknowledges every batch. unacknowledged records stay
+        pending (memory) or are appended to the spool and sent first once
+        the collector is back.
+    '''
+    INTERVAL = 1.0
+    BATCH = 512
+    RETRY = 5.0         # seconds between connects while the collector is down
+    TIMEOUT = 5.0
+    
+    def __init__(self, address, node, spool=None, interval=INTERVAL):
+        self.address = address
+        self.node = node
+        self.spool = spool
+        self.interval = interval
+        self.pending = collections.OrderedDict()    # (client, target, vector): latest record
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.sock = None
+        self.reader = None
+        self.retry_at = 0
+        self.sent = 0
+        self.thread = None
+    
+    def __repr__(self):
+        return "<ResultReporter %s collector=%s node=%s pending=%d sent=%d connected=%s>"%(hex(id(self)), self.address, self.node,
+                                                                                          len(self.pending), self.sent,
+                                                                                          self.sock is not None)
+    
+    @staticmethod
+    def vector_name(mangle):
+        ''' PROTO.Vector '''
+        name = getattr(mangle, '__qualname__', mangle.__name__)
+        return name[len("Vectors."):] if name.startswith("Vectors.") else name
+    
+    def submit(self, result):
+        ''' called on the data path, no i/o '''
+        target = "%s:%d"%result.target[:2] if result.target else None
+        record = {'node': self.node,
+                  'client': result.client,
+                  'target': target,
+                  'vector': self.vector_name(result.mangle),
+                  'result': result.result,
+                  'sessions': result.sessions,
+                  'time': time.time()}
+        with self.lock:
+            self.pending[(result.client, target, record['vector'])] = record
+            if len(self.pending) >= self.BATCH:
+                self.wakeup.set()
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="striptls-reporter")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self, timeout=TIMEOUT):
+        ''' sends what is pending (or spools it) and stops '''
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+    
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+        self.retry_at = 0
+        self.flush()
+        self._close()
+    
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, collections.OrderedDict()
+        spooled = self.spool and os.path.exists(self.spool) and os.path.getsize(self.spool)
+        if not records and not spooled:
+            return
+        lines = [json.dumps(r).encode("utf-8") for r in records.values()]
+        try:
+            if time.time() < self.retry_at:
+                raise socket.error("collector down, retrying in %.0fs"%(self.retry_at-time.time()))
+            if spooled:
+                with open(self.spool, 'rb') as f:
+                    self._send(f.read().splitlines())
+                os.unlink(self.spool)
+            if lines:
+                self._send(lines)
+        except (socket.error, ValueError) as e:
+            if self.sock or not self.retry_at:
+                logger.warning("%r - collector unreachable, buffering records: %r"%(self, e))
+            self._close()
+            if time.time() >= self.retry_at:
+                self.retry_at = time.time() + self.RETRY
+            if self.spool:
+                with open(self.spool, 'ab') as f:
+                    f.write(b"".join(l + b"\n" for l in lines))
+            else:
+                with self.lock:
+                    # newer states submitted meanwhile win
+                    for key, record in records.items():
+                        self.pending.setdefault(key, record)
+    
+    def _send(self, lines):
+        if not lines:
+            return
+        if not self.sock:
+            if isinstance(self.address, str):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.TIMEOUT)
+                try:
+                    sock.connect(self.address)
+                except socket.error:
+                    sock.close()
+                    raise
+            else:
+                sock = socket.create_connection(self.address, timeout=self.TIMEOUT)
+            self.sock, self.reader = sock, sock.makefile('rb')
+            self.retry_at = 0
+            logger.info("%r - connected"%self)
+        self.sock.sendall(b"".join(l + b"\n" for l in lines) + b"\n")
+        ack = self.reader.readline()
+        if not ack.startswith(b"ok"):
+            raise ValueError("collector did not acknowledge the batch: %r"%ack)
+        self.sent += len(lines)
+    
+    def _close(self):
+        if self.sock:
+            self.reader.close()
+            self.sock.close()
+        self.sock = self.reader = None
+
+class StatsSegment(object):
+    ''' Live sessions and per vector result counters in a fixed size memory
+        mapped file, rendered by python -m striptls top.
+        
+        @param directory: the segment is <directory>/striptls-<pid>.stats, on
+                          tmpfs (/dev/shm) it never touches the disk
+        @param proxy: ProxyServer
+        @param rewrite: RewriteDispatcher
+        
+        a background thread rewrites the snapshot every interval seconds.
+        there is one writer and no lock: the sequence counter in the header
+        is odd while a snapshot is written (seqlock), readers retry if it
+        was odd or changed while they copied the segment. readers only map
+        the file, the proxy does not know about them. every proxy process
+        has its own segment, top merges all segments of a directory.
+    '''
+    MAGIC = b"STRIPTLS"
+    VERSION = 1
+    # magic, version, pid, seq, started, updated, listen, target, active sessions, session records,
+    # vector records, rejected, memory used, spilled, served, p99 queueing delay
+    HEADER = struct.Struct("<8sIIQdd64s64sIIIIQQQd")
+    SEQ = struct.Struct("<Q")
+    SEQ_OFFSET = 16
+    # client, target, protocol, vector, state, started, bytes from client, bytes from server, tls client, tls server, verdict
+    SESSION = struct.Struct("<48s48s8s48s16sdQQBBB5x")
+    # name, vulnerable, not vulnerable, no verdict, sessions
+    VECTOR = struct.Struct("<64sIIII")
+    SESSIONS = 1024     # session records, the oldest sessions are listed
+    VECTORS = 256
+    SIZE = HEADER.size + SESSIONS*SESSION.size + VECTORS*VECTOR.size
+    INTERVAL = 1.0
+    VERDICTS = {None: 0, True: 1, False: 2}
+    
+    def __init__(self, directory, proxy, rewrite, interval=INTERVAL):
+        self.path = os.path.join(directory, "striptls-%d.stats"%os.getpid())
+        self.proxy = proxy
+        self.rewrite = rewrite
+        self.interval = interval
+        self.started = time.time()
+        self.seq = 0
+        self.body = bytearray(self.SIZE)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, "w+b")
+        self.file.truncate(self.SIZE)
+        self.map = mmap.mmap(self.file.fileno(), self.SIZE)
+        self.stopped = threading.Event()
+        self.thread = None
+    
+    def __repr__(self):
+        return "<StatsSegment %s seq=%d>"%(self.path, self.seq)
+    
+    @staticmethod
+    def _text(value, size):
+        return str(value).encode("utf-8", "replace")[:size]
+    
+    @staticmethod
+    def _address(address):
+        return "%s:%s"%address[:2] if address else ""
+    
+    def start(self):
+        self.publish()
+        self.thread = threading.Thread(target=self._run, name="striptls-stats")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(self.interval*2)
+        self.map.close()
+        self.file.close()
+        os.unlink(self.path)
+    
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning("%r - %r"%(self, e))
+    
+    def publish(self):
+        ''' snapshot into self.body, then copied to the segment between two counter increments '''
+        proxy, rewrite = self.proxy, self.rewrite
+        # copies run in C, the main loop and tls workers cannot change the dicts meanwhile
+        sessions = list(itertools.islice(proxy.live, self.SESSIONS))
+        results = list(rewrite.results.values())
+        pos = self.HEADER.size
+        for session in sessions:
+            r = rewrite.session_results.get(session)
+            state = session.state
+            self.SESSION.pack_into(self.body, pos,
+                                   self._text(self._address(session.inbound.peer), 48),
+                                   self._text(self._address(session.outbound.peer), 48),
+                                   self._text(type(state).__name__[:-len("State")].upper() if state else
+                                              session.protocol.protocol_id or "", 8),
+                                   self._text(ResultReporter.vector_name(r.mangle) if r else "", 48),
+                                   self._text(ProtocolState.NAMES.get(state.state, state.state) if state else "", 16),
+                                   session.started, session.inbound.received, session.outbound.received,
+                                   session.inbound.socket_ssl is not None, session.outbound.socket_ssl is not None,
+                                   self.VERDICTS.get(r.result, 0) if r else 0)
+            pos += self.SESSION.size
+        vectors = {}    # name: [vulnerable, not vulnerable, no verdict, sessions]
+        for r in results:
+            counters = vectors.setdefault(ResultReporter.vector_name(r.mangle), [0, 0, 0, 0])
+            counters[2 if r.result is None else 0 if r.result else 1] += 1
+            counters[3] += r.sessions
+        names = sorted(vectors)[:self.VECTORS]
+        for name in names:
+            self.VECTOR.pack_into(self.body, pos, self._text(name, 64), *vectors[name])
+            pos += self.VECTOR.size
+        scheduler, memory = proxy.scheduler, Session.MEMORY
+        self.HEADER.pack_into(self.body, 0, self.MAGIC, self.VERSION, os.getpid(), 0, self.started, time.time(),
+                              self._text(self._address(proxy.listen), 64),
+                              self._text(",".join(self._address(u.address) for u in proxy.pool.upstreams) if proxy.pool
+                                         else self._address(proxy.target), 64),
+                              proxy.admission.active, len(sessions), len(names), proxy.admission.get_rejected_count(),
+                              memory.used if memory else 0, memory.spilled if memory else 0,
+                              scheduler.served, scheduler.percentile(99))
+        self.seq += 1
+        self.SEQ.pack_into(self.map, self.SEQ_OFFSET, self.seq)
+        self.map[:self.SEQ_OFFSET] = self.body[:self.SEQ_OFFSET]
+        self.map[self.SEQ_OFFSET+self.SEQ.size:pos] = self.body[self.SEQ_OFFSET+self.SEQ.size:pos]
+        self.seq += 1
+        self.SEQ.pack_into(self.map, self.SEQ_OFFSET, self.seq)
+    
+    @classmethod
+    def read(cls, path, retries=100):
+        ''' consistent snapshot of a segment as a dict, None if it is not a segment '''
+        with open(path, "rb") as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(segment) < cls.HEADER.size or segment[:len(cls.MAGIC)] != cls.MAGIC:
+                return None
+            for _ in range(retries):
+                seq = cls.SEQ.unpack_from(segment, cls.SEQ_OFFSET)[0]
+                if seq & 1:
+                    time.sleep(0.001)
+                    continue
+                data = segment[:]
+                if seq == cls.SEQ.unpack_from(segment, cls.SEQ_OFFSET)[0]:
+                    return cls.parse(data)
+            raise ValueError("%s is rewritten too often, no consistent snapshot"%path)
+        finally:
+            segment.close()
+    
+    @classmethod
+    def parse(cls, data):
+        text = lambda b: b.rstrip(b"\0").decode("utf-8", "replace")
+        (_, version, pid, seq, started, updated, listen, target, active, nsessions, nvectors, rejected,
+         memory, spilled, served, delay) = cls.HEADER.unpack_from(data, 0)
+        if version != cls.VERSION:
+            raise ValueError("segment version %d, expected %d"%(version, cls.VERSION))
+        stats = {'pid': pid, 'seq': seq, 'started': started, 'updated': updated, 'listen': text(listen),
+                 'target': text(target), 'active': active, 'rejected': rejected, 'memory': memory,
+                 'spilled': spilled, 'served': served, 'delay_p99': delay, 'sessions': [], 'vectors': []}
+        verdicts = dict((v, k) for k, v in cls.VERDICTS.items())
+        pos = cls.HEADER.size
+        for _ in range(nsessions):
+            client, target, protocol, vector, state, started, received, sent, tls_client, tls_server, verdict = \
+                cls.SESSION.unpack_from(data, pos)
+            stats['sessions'].append({'client': text(client), 'target': text(target), 'protocol': text(protocol),
+                                      'vector': text(vector), 'state': text(state), 'started': started,
+                                      'client_bytes': received, 'server_bytes': sent,
+                                      'tls': (bool(tls_client), bool(tls_server)), 'result': verdicts.get(verdict)})
+            pos += cls.SESSION.size
+        for _ in range(nvectors):
+            name, vulnerable, safe, undecided, sessions = cls.VECTOR.unpack_from(data, pos)
+            stats['vectors'].append({'vector': text(name), 'vulnerable': vulnerable, 'not_vulnerable': safe,
+                                     'no_verdict': undecided, 'sessions': sessions})
+            pos += cls.VECTOR.size
+        return stats
 
+class ClientFingerprint(object):
+    ''' Client implementation behind a session, told from its behaviour.
+        
+        key: derived from the first client message, so it is known before
+        a vector is selected: command verb, its case and the tag format,
+        SMTP EHLO/HELO argument (host label dropped, digits collapsed), IMAP
+        ID, IRC CAP LS, XMPP stream header attributes (addresses and ids
+        left out).
+        commands (the first distinct commands, tls negotiation and QUIT left
+        out) and hello (JA3 of the tls ClientHello on intercept) are only
+        known later; VerdictCache uses them to tell clients sharing a key
+        apart.
+    '''
+    __slots__ = ('protocol_id', 'key', 'commands', 'hello')
+    COMMANDS = 4
+    _IGNORED = (b"STARTTLS", b"STLS", b"QUIT", b"LOGOUT", b"NOOP", b"?XML", b"STREAM:STREAM")
+    _TAGGED = (ProtocolDetect.PROTO_IMAP, ProtocolDetect.PROTO_ACAP)
+    _REX_TAG = re.compile(rb"<([\w:?]+)")
+    _REX_ATTR = re.compile(rb"""([\w:]+)=['"]([^'"]*)['"]""")
+    _REX_DIGITS = re.compile(rb"\d+")
+    _XMPP_VOLATILE = (b"to", b"from", b"id")
+    
+    def __init__(self, protocol_id):
+        self.protocol_id = protocol_id
+        self.key = None
+        self.commands = []
+        self.hello = None
+    
+    def __repr__(self):
+        return "<ClientFingerprint key=%s commands=%r hello=%s>"%(self.key, self.commands, self.hello)
+    
+    def is_complete(self):
+        return self.key is not None and len(self.commands) >= self.COMMANDS
+    
+    def feed(self, data):
+        ''' client data as received '''
+        if self.protocol_id==ProtocolDetect.PROTO_XMPP:
+            lines = [data] if data.strip() else []
+        else:
+            lines = [l.strip() for l in data.split(b"\n") if l.strip()]
+        for line in lines:
+            if self.key is None:
+                self.key = self._key(line)
+            for verb in self._verbs(line):
+                if verb not in self._IGNORED and verb not in self.commands and len(self.commands) < self.COMMANDS:
+                    self.commands.append(verb)
+    
+    def _verbs(self, line):
+        if self.protocol_id==ProtocolDetect.PROTO_XMPP:
+            return [tag.upper() for tag in self._REX_TAG.findall(line)]
+        parts = line.split(None, 2)
+        if self.protocol_id in self._TAGGED:
+            parts = parts[1:]
+        if not parts:
+            return []
+        verb = parts[0].upper()
+        if verb==b"AUTH" and len(parts) > 1 and parts[1].upper() in (b"TLS", b"SSL", b"TLS-C"):
+            # ftp
+            return [b"STARTTLS"]
+        return [verb]
+    
+    def _key(self, line):
+        if self.protocol_id==ProtocolDetect.PROTO_XMPP:
+            header = line[:line.find(b">", line.find(b"<stream"))+1]
+            features = [header.startswith(b"<?xml"), b"'" in header]
+            features.extend((n, None if n in self._XMPP_VOLATILE else v) for n, v in self._REX_ATTR.findall(header))
+        else:
+            parts = line.split(None, 1)
+            tag = None
+            if self.protocol_id in self._TAGGED and len(parts) > 1:
+                tag = self._REX_DIGITS.sub(b"0", parts[0])
+                parts = parts[1].split(None, 1)
+            verb = parts[0]
+            arg = parts[1] if len(parts) > 1 else b""
+            if verb.upper() in (b"EHLO", b"HELO"):
+                arg = self.host_shape(arg)
+            elif verb.upper() not in (b"ID", b"CAP"):
+                # user names, nicks, passwords
+                arg = None
+            features = [tag, verb, arg]
+        return "%d:%s"%(self.protocol_id, hashlib.sha1(repr(features).encode("utf-8")).hexdigest()[:16])
+    
+    @classmethod
+    def host_shape(cls, host):
+        ''' mx12.corp.example.org -> corp.example.org with digits collapsed, [1.2.3.4] -> [addr] '''
+        host = host.strip().lower()
+        if host.startswith(b"["):
+            return b"[addr]"
+        labels = host.split(b".")
+        if len(labels) > 2:
+            labels = labels[1:]
+        return cls._REX_DIGITS.sub(b"0", b".".join(labels))
+    
+    @staticmethod
+    def ja3(record):
+        ''' JA3 (md5) of a tls ClientHello record, None if it is none '''
+        try:
+            if record[0]!=0x16 or record[5]!=0x01:
+                return None
+            pos = 9
+            version = struct.unpack("!H", record[pos:pos+2])[0]
+            pos += 2 + 32
+            pos += 1 + record[pos]
+            nbytes = struct.unpack("!H", record[pos:pos+2])[0]
+            ciphers = struct.unpack("!%dH"%(nbytes//2), record[pos+2:pos+2+nbytes])
+            pos += 2 + nbytes
+            pos += 1 + record[pos]
+            end = pos + 2 + struct.unpack("!H", record[pos:pos+2])[0]
+            pos += 2
+            extensions, groups, formats = [], (), b""
+            while pos + 4 <= end:
+                ext, nbytes = struct.unpack("!HH", record[pos:pos+4])
+                body = record[pos+4:pos+4+nbytes]
+                extensions.append(ext)
+                if ext==10:
+                    groups = struct.unpack("!%dH"%(len(body[2:])//2), body[2:])
+                elif ext==11:
+                    formats = body[1:]
+                pos += 4 + nbytes
+        except (IndexError, struct.error):
+            return None
+        def join(values):
+            # GREASE values (rfc 8701) are random per connection
+            return "-".join(str(v) for v in values if (v & 0x0f0f)!=0x0a0a)
+        ja3 = "%d,%s,%s,%s,%s"%(version, join(ciphers), join(extensions), join(groups), "-".join(str(f) for f in formats))
+        return hashlib.md5(ja3.encode("ascii")).hexdigest()
+
+class VerdictCache(object):
+    ''' Vector verdicts per client type (ClientFingerprint.key), shared by
+        all client ips. A key whose sessions disagree on the commands that
+        follow the first one (neither is a prefix of the other) or on the
+        tls ClientHello is ambiguous: it no longer skips vectors.
+    '''
+    
+    def __init__(self, size=4096):
+        self.size = size
+        self.types = collections.OrderedDict()  # key: {commands, hello, ambiguous, verdicts: {mangle: result}}
+        self.hits = 0
+        self.lock = threading.Lock()
+    
+    def __repr__(self):
+        return "<VerdictCache types=%d ambiguous=%d hits=%d>"%(len(self.types),
+                                                               sum(1 for t in self.types.values() if t['ambiguous']),
+                                                               self.hits)
+    
+    def lookup(self, fingerprint, mangle):
+        with self.lock:
+            entry = self.types.get(fingerprint.key)
+            if not entry or entry['ambiguous']:
+                return None
+            result = entry['verdicts'].get(mangle)
+            if result is not None:
+                self.hits += 1
+            return result
+    
+    def learn(self, fingerprint, mangle=None, result=None):
+        with self.lock:
+            entry = self.types.get(fingerprint.key)
+            if entry is None:
+                entry = self.types[fingerprint.key] = {'commands': [], 'hello': None, 'ambiguous': False, 'verdicts': {}}
+                while len(self.types) > self.size:
+                    self.types.popitem(last=False)
+            else:
+                self.types.move_to_end(fingerprint.key)
+            short, long = sorted((entry['commands'], fingerprint.commands), key=len)
+            if long[:len(short)]!=short:
+                entry['ambiguous'] = True
+            entry['commands'] = long
+            if fingerprint.hello:
+                if entry['hello'] and entry['hello']!=fingerprint.hello:
+                    entry['ambiguous'] = True
+                entry['hello'] = fingerprint.hello
+            if mangle and result is not None and not entry['verdicts'].get(mangle):
+                # one vulnerable client of a type makes the type vulnerable
+                entry['verdicts'][mangle] = result
 
 class RewriteDispatcher(object):
     def __init__(self):
         self.vectors = {}   # proto:[vectors]
-        self.results = []   # [ {session,client_ip,mangle,result}, }
-        self.session_to_mangle = {}  # session:mangle
+        self.results = {}   # (client_ip, target, mangle):Result
+        self.session_results = {}   # live session:Result
+        self.client_results = {}    # client_ip:last Result
+        self.lock = threading.RLock()   # vectors may run on tls worker threads
+        self.reporter = None        # ResultReporter, see --collector
+        self.verdicts = None        # VerdictCache, see --fingerprint
         
     def __repr__(self):
         return "<RewriteDispatcher vectors=%s>"%repr(self.vectors)
     
     def get_results(self):
-        return self.results
+        return list(self.results.values())
     
     def get_results_by_clients(self):
         results = {}    #client:{mangle:result}
         for r in self.get_results():
-            client = r['client']
-            results.setdefault(client,[])
-            mangle = r['mangle']
-            result = r['result']
-            results[client].append((mangle,result))
+            results.setdefault(r.client,[])
+            results[r.client].append((r.mangle,r.result,r.target))
         return results
     
     def get_result(self, session):
-        for r in self.get_results():
-            if r['session']==session:
-                return r
-        return None
+        return self.session_results.get(session)
     
     def set_result(self, session, value):
-        r = self.get_result(session)
-        r['result'] = value
+        with self.lock:
+            r = self.get_result(session)
+            r.result = value
+            if self.reporter:
+                self.reporter.submit(r)
+            if self.verdicts and session.fingerprint and session.fingerprint.key:
+                self.verdicts.learn(session.fingerprint, r.mangle, value)
+    
+    def release(self, session):
+        ''' session terminated, its verdict stays in results. the vector
+            changed the traffic and the client did not fall for it: not vulnerable.
+        '''
+        with self.lock:
+            r = self.session_results.pop(session, None)
+            if r and r.result is None and session.tampered:
+                r.result = False
+                if self.reporter:
+                    self.reporter.submit(r)
+            else:
+                r = None
+        fingerprint = session.fingerprint
+        if self.verdicts and fingerprint and fingerprint.key:
+            fingerprint.hello = session.inbound.hello
+            if r:
+                self.verdicts.learn(fingerprint, r.mangle, False)
+            else:
+                self.verdicts.learn(fingerprint)
+    
+    def on_tls_error(self, session, e):
+        ''' a tls handshake of the vector failed: ends the session, not the proxy.
+            a client that refused the intercepted handshake is not vulnerable (see release())
+        '''
+        if session.inbound.tls_error is not None:
+            session.tampered = True
+        logger.warning("%s tls handshake failed: %r"%(session, e))
+        session.close()
+    
+    def fingerprint(self, session, data):
+        ''' feeds client data to the sessions ClientFingerprint until it is complete '''
+        fingerprint = session.fingerprint
+        if fingerprint is None:
+            if not session.protocol.protocol_id or isinstance(session.state, FramedProtocolState):
+                return
+            fingerprint = session.fingerprint = ClientFingerprint(session.protocol.protocol_id)
+        if not fingerprint.is_complete():
+            fingerprint.feed(data.tobytes() if isinstance(data, memoryview) else data)
           
     def add(self, proto, attack):
         self.vectors.setdefault(proto,set([]))
         self.vectors[proto].add(attack)
+    
+    def set_vectors(self, vectors):
+        ''' replace the vector set, running sessions keep their mangle '''
+        with self.lock:
+            self.vectors = vectors
         
     def get_mangle(self, session):
         ''' smart select mangle
@@ -1155,57 +4884,241 @@ class RewriteDispatcher(object):
             try to use all mangles for same client-ip
         '''
         # 1) session already has a mangle associated to it
-        mangle = self.session_to_mangle.get(session)
+        r = self.session_results.get(session)
+        if r:
+            return r.mangle
+        if self.verdicts is not None:
+            if session in self.session_results:
+                # every vector has a verdict for this client type
+                return None
+            if not (session.fingerprint and session.fingerprint.key) \
+                    and not any(getattr(m, '_GREETING', False) or getattr(m, '_RAW', False)
+                                for m in self.get_mangles(session.protocol.protocol_id)):
+                # select once the client has identified itself (first client message),
+                # binary protocols are not fingerprinted
+                return None
+        with self.lock:
+            mangle = self._select_mangle(session)
         if mangle:
-            return mangle
+            session.tls_vector = getattr(mangle, '_TLS', False)
+        return mangle
+    
+    def _select_mangle(self, session):
         # 2) pick new mangle (round-robin) per client
         #    
         client_ip = session.inbound.peer[0]
-        client_mangle_history = [r for r in self.get_results() if r['client']==client_ip]
+        previous_result = self.client_results.get(client_ip)
         
         all_mangles = list(self.get_mangles(session.protocol.protocol_id))
         if not all_mangles:
             return None
+        cached = self._get_cached_verdicts(session, all_mangles)
+        if len(cached)==len(all_mangles):
+            self.session_results[session] = None
+            return None
         new_index = 0
-        if client_mangle_history:
-            previous_result = client_mangle_history[-1]
-            new_index = (all_mangles.index(previous_result['mangle'])+1) % len(all_mangles)
+        if previous_result and previous_result.mangle in all_mangles:
+            # previous mangle may be gone after a reload
+            new_index = (all_mangles.index(previous_result.mangle)+1) % len(all_mangles)
+        while all_mangles[new_index] in cached:
+            new_index = (new_index+1) % len(all_mangles)
         mangle = all_mangles[new_index]
-            
-        self.results.append({'client':client_ip,
-                             'session':session,
-                             'mangle':mangle,
-                             'result':None}) 
+        
+        key = (client_ip, session.outbound.peer, mangle)
+        r = self.results.get(key)
+        if not r:
+            r = self.results[key] = Result(client_ip, session.outbound.peer, mangle)
+        r.sessions += 1
+        self.session_results[session] = r
+        self.client_results[client_ip] = r
+        if self.reporter:
+            self.reporter.submit(r)
  
         #mangle = iter(self.get_mangles(session.protocol.protocol_id)).next()
-        logger.debug("<RewriteDispatcher  - changed mangle: %s new: %s>"%(mangle,"False" if len(client_mangle_history)>len(all_mangles) else "True"))
-        self.session_to_mangle[session] = mangle
+        logger.debug("<RewriteDispatcher  - changed mangle: %s new: %s>"%(mangle,"False" if previous_result else "True"))
         return mangle
         
+    def _get_cached_verdicts(self, session, mangles):
+        ''' {mangle: verdict} known for the sessions client type, recorded as results of this client '''
+        fingerprint = session.fingerprint
+        if not (self.verdicts and fingerprint and fingerprint.key):
+            return {}
+        cached = {}
+        for mangle in mangles:
+            result = self.verdicts.lookup(fingerprint, mangle)
+            if result is None:
+                continue
+            cached[mangle] = result
+            key = (session.inbound.peer[0], session.outbound.peer, mangle)
+            if key not in self.results:
+                r = self.results[key] = Result(key[0], key[1], mangle, result)
+                if self.reporter:
+                    self.reporter.submit(r)
+        if cached:
+            logger.info("%s - client type %s has verdicts for %s, skipped"%(session, fingerprint.key,
+                                                                             ", ".join(m.__name__ for m in cached)))
+        return cached
+    
     def get_mangles(self, proto):
         return self.vectors.get(proto,[])
         
     def mangle_server_data(self, session, data):
-        data_orig = data
-        logging.debug("%s [client] <= [server]          %s"%(session,repr(data)))
-        if self.get_mangle(session):
-            data = self.get_mangle(session).mangle_server_data(session, data, self)
+        ''' data is a memoryview of the sessions recv buffer; it is passed on
+            as-is (no copy) unless a vector needs to look at it.
+        '''
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("%s [client] <= [server]          %r", session, data.tobytes())
+        mangle = self.get_mangle(session)
+        if not mangle:
+            return data
+        data_orig = data = data.tobytes()
+        if getattr(mangle, '_RAW', False):
+            data = bytearray(data_orig)
+        try:
+            data = mangle.mangle_server_data(session, data, self)
+        except ssl.SSLError as e:
+            self.on_tls_error(session, e)
         if data!=data_orig:
-            logging.debug("%s [client] <= [server][mangled] %s"%(session,repr(data)))
+            session.tampered = True
+            if debug:
+                logger.debug("%s [client] <= [server][mangled] %r", session, data)
         return data
 
     def mangle_client_data(self, session, data):
-        data_orig = data
-        logging.debug("%s [client] => [server]          %s"%(session,repr(data)))
-        if self.get_mangle(session):
-            #TODO: just use the first one for now
-            data = self.get_mangle(session).mangle_client_data(session, data, self)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("%s [client] => [server]          %r", session, data.tobytes())
+        if self.verdicts is not None:
+            self.fingerprint(session, data)
+        mangle = self.get_mangle(session)
+        if not mangle:
+            return data
+        #TODO: just use the first one for now
+        data_orig = data = data.tobytes()
+        if getattr(mangle, '_RAW', False):
+            data = bytearray(data_orig)
+        try:
+            data = mangle.mangle_client_data(session, data, self)
+        except ssl.SSLError as e:
+            self.on_tls_error(session, e)
         if data!=data_orig:
-            logging.debug("%s [client] => [server][mangled] %s"%(session,repr(data)))
+            session.tampered = True
+            if debug:
+                logger.debug("%s [client] => [server][mangled] %r", session, data)
         return data
     
+class VectorRegistry(object):
+    ''' Resolves 'PROTO.Vector' names to vector classes.
+
+        Protocols come from the builtin Vectors class, from package entry points
+        (group 'striptls.vectors', entry point name = protocol name) and from
+        plugin directories (<PROTO>.py defining class <PROTO>). External protocols
+        are only imported when one of their vectors is selected; resolved
+        protocols and vectors are cached.
+    '''
+    ENTRY_POINT_GROUP = "striptls.vectors"
+    
+    def __init__(self, builtin=None, plugin_dirs=(), entry_points=True):
+        self.providers = {}     # proto_name: loader() -> proto class
+        self.protocols = {}     # proto_name: proto class (loaded)
+        self.resolved = {}      # 'PROTO.Vector': (proto class, vector class)
+        if builtin:
+            for proto in (v for v in dir(builtin) if not v.startswith("_")):
+                self.protocols[proto] = getattr(builtin, proto)
+        if entry_points:
+            self.discover_entry_points()
+        for path in plugin_dirs:
+            self.discover_directory(path)
+    
+    def __repr__(self):
+        return "<VectorRegistry protocols=%s loaded=%s>"%(sorted(self.get_protocol_names()), sorted(self.protocols))
+    
+    def discover_entry_points(self):
+        try:
+            from importlib import metadata
+        except ImportError:
+            return
+        eps = metadata.entry_points()
+        if hasattr(eps, "select"):
+            eps = eps.select(group=self.ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(self.ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            self.add_provider(ep.name, ep.load)
+    
+    def discover_directory(self, path):
+        for fname in sorted(os.listdir(path)):
+            proto, ext = os.path.splitext(fname)
+            if ext != ".py" or proto.startswith("_"):
+                continue
+            self.add_provider(proto, self._file_loader(proto, os.path.join(path, fname)))
+    
+    @staticmethod
+    def _file_loader(proto, fpath):
+        def load():
+            import importlib.util
+            spec = importlib.util.spec_from_file_location("striptls_plugin_%s"%proto, fpath)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return getattr(module, proto)
+        return load
+    
+    def add_provider(self, proto, loader):
+        if proto in self.protocols or proto in self.providers:
+            logger.warning("%s - ignoring duplicate vector provider for %s"%(self, proto))
+            return
+        self.providers[proto] = loader
+    
+    def get_protocol_names(self):
+        return set(self.protocols).union(self.providers)
+    
+    def get_protocol(self, proto):
+        cls_proto = self.protocols.get(proto)
+        if cls_proto is None:
+            loader = self.providers.pop(proto, None)
+            if loader is None:
+                raise KeyError("unknown vector protocol: %s"%proto)
+            cls_proto = self.protocols[proto] = loader()
+            logger.debug("%s - loaded protocol %s: %r"%(self, proto, cls_proto))
+        return cls_proto
+    
+    def get_vector_names(self, proto):
+        cls_proto = self.get_protocol(proto)
+        return ["%s.%s"%(proto,test) for test in dir(cls_proto) if not test.startswith("_")]
+    
+    def get_names(self, load=False):
+        ''' all loaded vector names, PROTO.* for protocols not imported yet (unless load) '''
+        names = []
+        for proto in sorted(self.get_protocol_names()):
+            if proto in self.protocols or load:
+                names.extend(self.get_vector_names(proto))
+            else:
+                names.append("%s.*"%proto)
+        return names
+    
+    def resolve(self, name):
+        ''' 'PROTO.Vector' -> (proto class, vector class) '''
+        entry = self.resolved.get(name)
+        if entry is None:
+            proto, vector = name.split('.',1)
+            cls_proto = self.get_protocol(proto)
+            entry = self.resolved[name] = (cls_proto, getattr(cls_proto, vector))
+        return entry
+    
+    def expand(self, names):
+        ''' expand 'ALL', 'PROTO' and 'PROTO.*' selectors to vector names '''
+        expanded = []
+        for name in names:
+            if name == "ALL":
+                expanded.extend(self.get_names(load=True))
+            elif name.endswith(".*") or "." not in name:
+                expanded.extend(self.get_vector_names(name.split(".",1)[0]))
+            else:
+                expanded.append(name)
+        return expanded
+    
 def main():
-    import os
     from optparse import OptionParser
     ret = 0
     usage = """usage: %prog [options]
@@ -1217,67 +5130,216 @@ def main():
                   action="store_true", dest="verbose", default=True,
                   help="make lots of noise [default]")
     parser.add_option("-l", "--listen", dest="listen", help="listen ip:port [default: 0.0.0.0:<remote_port>]")
-    parser.add_option("-r", "--remote", dest="remote", help="remote target ip:port to forward sessions to")
+    parser.add_option("-r", "--remote", dest="remote", help="remote target ip:port to forward sessions to, comma separated for a pool of upstreams")
+    parser.add_option("--balance", dest="balance", default=UpstreamPool.ROUNDROBIN, choices=(UpstreamPool.ROUNDROBIN, UpstreamPool.LEASTCONN),
+                  help="upstream selection: roundrobin or leastconn [default: %default]")
+    parser.add_option("--health-interval", dest="health_interval", default=10, type="float",
+                  help="seconds between upstream health checks (tcp connect) of a pool of upstreams, 0 disables them [default: %default]")
+    parser.add_option("--max-fails", dest="max_fails", default=3, type="int",
+                  help="consecutive connect failures before an upstream is taken down [default: %default]")
+    parser.add_option("--fail-timeout", dest="fail_timeout", default=30, type="float",
+                  help="seconds an upstream stays down before it is tried again [default: %default]")
+    parser.add_option("--connect-timeout", dest="connect_timeout", default=5, type="float",
+                  help="upstream connect timeout in seconds [default: %default]")
+    parser.add_option("--connect-workers", dest="connect_workers", default=8, type="int",
+                  help="threads connecting new sessions to their upstream, bounds the connects in progress [default: %default]")
     parser.add_option("-k", "--key", dest="key", default="server.pem", help="SSL Certificate and Private key file to use, PEM format assumed [default: %default]")
+    parser.add_option("-c", "--ca", dest="ca", help="mint per host/SNI certificates signed by this CA (PEM certificate and key, requires cryptography) instead of presenting --key")
+    parser.add_option("--ca-key", dest="ca_key", help="CA private key if not contained in --ca")
+    parser.add_option("--ca-key-type", dest="ca_key_type", default="rsa", choices=("rsa","ec"), help="minted certificate key type: rsa, ec [default: %default]")
+    parser.add_option("--ca-cache", dest="ca_cache", default=256, type="int", help="number of minted certificates to cache [default: %default]")
+    parser.add_option("--tls-workers", dest="tls_workers", default=0, type="int", help="process tls sessions (handshakes, encryption) on N worker threads, 0 handles them in the main loop [default: %default]")
+    parser.add_option("--ktls", dest="ktls", action="store_true", default=False, help="hand tls of intercepted sessions to the kernel after the handshake (linux tls module, python 3.12+), falls back to user space tls")
+    parser.add_option("--memory-budget", dest="memory_budget", default=0, type="int", help="bytes all sessions may keep in memory for slow peers, beyond that data is spilled to disk, 0 = unlimited (enables non blocking writes if set) [default: %default]")
+    parser.add_option("--session-memory", dest="session_memory", default=0, type="int", help="bytes one session may keep in memory for a slow peer before spilling to disk, 0 = unlimited (enables non blocking writes if set) [default: %default]")
+    parser.add_option("--spill-dir", dest="spill_dir", help="directory for spill files [default: system temp directory]")
+    parser.add_option("--quantum", dest="quantum", default=0, type="int", help="bytes a session may read per event loop round, sessions with more data wait for the next round (fair scheduling), 0 = unlimited [default: %default]")
+    parser.add_option("--backlog", dest="backlog", default=200, type="int", help="listen backlog [default: %default]")
+    parser.add_option("--accept-batch", dest="accept_batch", default=16, type="int", help="max connections accepted per wakeup [default: %default]")
+    parser.add_option("--rate", dest="rate", default=0, type="float", help="max new sessions per second per client ip, 0 = unlimited [default: %default]")
+    parser.add_option("--burst", dest="burst", default=10, type="int", help="sessions a client ip may open at once before --rate applies [default: %default]")
+    parser.add_option("--max-sessions", dest="max_sessions", default=0, type="int", help="max concurrent sessions, 0 = unlimited [default: %default]")
+    parser.add_option("-t", "--transparent", dest="transparent", choices=(ProxyServer.REDIRECT, ProxyServer.TPROXY),
+                  help="transparent proxy: forward each connection to its original destination (iptables REDIRECT or TPROXY), --remote is optional and only used for connections not redirected")
+    parser.add_option("--stats", dest="stats", help="publish live sessions and vector results to a shared memory segment in this directory (e.g. /dev/shm/striptls) for python -m striptls top")
+    parser.add_option("--admin", dest="admin", help="unix admin socket path (reload, status, queues, handoff), SIGHUP reloads vectors and key")
+    parser.add_option("--takeover", dest="takeover", help="take over the listening socket from the process serving this admin socket, which then drains and exits")
+    parser.add_option("--fingerprint", dest="fingerprint", action="store_true", default=False, help="fingerprint clients (first command, EHLO, IMAP ID, XMPP stream, IRC CAP LS, tls ClientHello) and skip vectors that already have a verdict for that client type, whatever the client ip")
+    parser.add_option("--verdict-cache", dest="verdict_cache", default=4096, type="int", help="client types kept by --fingerprint [default: %default]")
+    parser.add_option("--collector", dest="collector", help="stream audit results to a collector (python -m striptls collector) at host:port or unix socket path")
+    parser.add_option("--collector-spool", dest="collector_spool", help="append results to this file while the collector is unreachable [default: keep them in memory]")
+    parser.add_option("--node", dest="node", help="name of this proxy in the collectors report [default: hostname:listen port]")
+    parser.add_option("--trace", dest="trace", help="write session timelines (connect, mangle, tls handshakes, blocking reads) to this file in Chrome trace format")
+    parser.add_option("--trace-sample", dest="trace_sample", default=1, type="int", help="trace every Nth session [default: %default]")
+    parser.add_option("--trace-client", dest="trace_client", help="only trace sessions of this client ip")
+    parser.add_option("-p", "--plugin-dir", dest="plugin_dirs", action="append", default=[],
+                  help="load additional vector protocols from <PROTO>.py files in this directory (may be repeated)")
     
-    all_vectors = []
-    for proto in (v for v in dir(Vectors) if not v.startswith("_")):
-        for test in (v for v in dir(getattr(Vectors,proto)) if not v.startswith("_")):
-            all_vectors.append("%s.%s"%(proto,test))
+    # plugin dirs must be known before the vector list can be rendered
+    plugin_dirs = []
+    argv = sys.argv[1:]
+    for i, arg in enumerate(argv):
+        if arg in ("-p", "--plugin-dir") and i+1 < len(argv):
+            plugin_dirs.append(argv[i+1])
+        elif arg.startswith("--plugin-dir="):
+            plugin_dirs.append(arg.split("=",1)[1])
+    registry = VectorRegistry(builtin=Vectors, plugin_dirs=plugin_dirs)
     parser.add_option("-x", "--vectors",
                   default="ALL",
-                  help="Comma separated list of vectors. Use 'ALL' (default) to select all vectors. Available vectors: "+", ".join(all_vectors)+""
+                  help="Comma separated list of vectors. Use 'ALL' (default) to select all vectors, 'PROTO.*' to select all vectors of a protocol. Available vectors: "+", ".join(registry.get_names())+""
                   " [default: %default]")
     # parse args
     (options, args) = parser.parse_args()
     # normalize args
     if options.verbose:
         logger.setLevel(logging.DEBUG)
-    if not options.remote:
+    def parse_address(address):
+        ''' host:port, [ipv6]:port '''
+        host, port = address.strip().rsplit(":",1)
+        return host.strip("[]"), int(port)
+    pool = None
+    if options.remote:
+        pool = UpstreamPool([parse_address(a) for a in options.remote.split(",")], balance=options.balance,
+                            max_fails=options.max_fails, fail_timeout=options.fail_timeout,
+                            health_interval=options.health_interval if "," in options.remote else 0,
+                            connect_timeout=options.connect_timeout)
+        options.remote = pool.upstreams[0].address
+    elif not options.transparent:
         parser.error("mandatory option: remote")
-    else:
-        options.remote = options.remote.strip().split(":")
-        options.remote = (options.remote[0], int(options.remote[1]))
-    if not options.listen:
+    if options.listen:
+        options.listen = parse_address(options.listen)
+    elif options.remote:
         logger.warning("no listen port specified - falling back to 0.0.0.0:%d"%options.remote[1])
         options.listen = ("0.0.0.0",options.remote[1])
     else:
-        options.listen = options.listen.strip().split(":")
-        options.listen = (options.listen[0], int(options.listen[1]))
-    options.vectors = [o.strip() for o in options.vectors.strip().split(",")]
-    if "ALL" in options.vectors:
-        options.vectors = all_vectors
+        parser.error("mandatory option: listen (transparent mode without remote)")
+    options.vectors = options.vectors.strip()
     Vectors._TLS_CERTFILE = Vectors._TLS_KEYFILE = options.key
+    if options.ca:
+        Vectors._CA = CertificateAuthority(options.ca, ca_keyfile=options.ca_key,
+                                           cache_size=options.ca_cache, key_type=options.ca_key_type)
+        logger.info("%r ready."%Vectors._CA)
+    if options.ktls:
+        reason = TcpSockBuff.ktls_unavailable()
+        if reason:
+            logger.warning("kernel tls disabled, using user space tls: %s"%reason)
+        else:
+            TcpSockBuff.KTLS = True
+            logger.info("kernel tls enabled.")
+    if options.memory_budget or options.session_memory:
+        Session.MEMORY = MemoryBudget(options.memory_budget)
+        Session.SESSION_MEMORY = options.session_memory
+        SpillBuffer.DIR = options.spill_dir
+        logger.info("%r ready, %d bytes per session."%(Session.MEMORY, options.session_memory))
+    if options.trace:
+        Session.tracer = Tracer(options.trace, sample=options.trace_sample, client=options.trace_client)
+        logger.info("%r ready."%Session.tracer)
           
+    def load_vectors(registry, selection):
+        vectors = {}    # proto:set(vectors), see RewriteDispatcher.add()
+        for classname in registry.expand(o.strip() for o in selection.split(",")):
+            cls_proto, cls_vector = registry.resolve(classname)
+            proto = classname.split('.',1)[0]
+            ProtocolDetect.PORTMAP.setdefault(cls_proto._PROTO_ID, cls_proto._PROTO_ID)
+            vectors.setdefault(cls_proto._PROTO_ID, set([])).add(cls_vector)
+            logger.debug("* added test (port:%-5d, proto:%8s): %s"%(cls_proto._PROTO_ID, proto, repr(cls_vector)))
+        return vectors
+    
+    def reload(conn, args):
+        ''' reload vectors (rescanning plugin dirs) and tls material, everything
+            is loaded before anything is swapped so a failing reload changes nothing
+        '''
+        selection = args.get("vectors", options.vectors)
+        key = args.get("key", options.key)
+        vectors = load_vectors(VectorRegistry(builtin=Vectors, plugin_dirs=options.plugin_dirs), selection)
+        # like at startup the key is only needed by tls vectors, otherwise keep it lazy
+        tls = any(getattr(v, '_TLS', False) for cls_vectors in vectors.values() for v in cls_vectors)
+        context = None
+        if not options.ca and (tls or "key" in args):
+            context = Vectors.load_server_context(key, key)
+        ca = None
+        if options.ca:
+            ca = CertificateAuthority(options.ca, ca_keyfile=options.ca_key, cache_size=options.ca_cache,
+                                      key_type=options.ca_key_type, keypool=Vectors._CA.keypool,
+                                      minter=Vectors._CA.minter)
+        rewrite.set_vectors(vectors)
+        Vectors._TLS_CERTFILE = Vectors._TLS_KEYFILE = options.key = key
+        Vectors._TLS_CONTEXT = context
+        Vectors._CA = ca
+        options.vectors = selection
+        logger.warning("reloaded: %r"%rewrite)
+        return "reloaded %d vectors"%sum(len(v) for v in vectors.values())
+    
     # ---- start up engines ----
-    prx = ProxyServer(listen=options.listen, target=options.remote, buffer_size=4096, delay=0.00001)
+    listen_sock = None
+    if options.takeover:
+        listen_sock = AdminChannel.takeover(options.takeover)
+        logger.info("took over listener %s from %s"%(listen_sock.getsockname(), options.takeover))
+    prx = ProxyServer(listen=options.listen, target=pool, buffer_size=4096, delay=0.00001,
+                      tls_workers=options.tls_workers, backlog=options.backlog,
+                      admission=AdmissionControl(rate=options.rate, burst=options.burst,
+                                                 max_sessions=options.max_sessions,
+                                                 accept_batch=options.accept_batch),
+                      listen_sock=listen_sock, transparent=options.transparent,
+                      scheduler=FairScheduler(quantum=options.quantum), connect_workers=options.connect_workers)
     logger.info("%s ready."%prx)
     rewrite = RewriteDispatcher()
-    
-    for classname in options.vectors:
-        try:
-            proto, vector = classname.split('.',1)
-            cls_proto = getattr(globals().get("Vectors"),proto)
-            cls_vector = getattr(cls_proto, vector)
-            rewrite.add(cls_proto._PROTO_ID, cls_vector)
-            logger.debug("* added test (port:%-5d, proto:%8s): %s"%(cls_proto._PROTO_ID, proto, repr(cls_vector)))
-        except Exception, e:
-            raise e
+    rewrite.set_vectors(load_vectors(registry, options.vectors))
 
     logging.info( repr(rewrite))
     prx.set_callback("mangle_server_data", rewrite.mangle_server_data)
     prx.set_callback("mangle_client_data", rewrite.mangle_client_data)
+    prx.set_callback("on_terminated", rewrite.release)
+    prx.control = AdminChannel(prx, path=options.admin)
+    prx.control.register("reload", reload)
+    if options.fingerprint:
+        rewrite.verdicts = VerdictCache(size=options.verdict_cache)
+        TcpSockBuff.CLIENTHELLO = True
+    if options.collector:
+        address = options.collector if "/" in options.collector else parse_address(options.collector)
+        rewrite.reporter = ResultReporter(address, options.node or "%s:%d"%(socket.gethostname(), options.listen[1]),
+                                          spool=options.collector_spool)
+        rewrite.reporter.start()
+        logger.info("%r ready."%rewrite.reporter)
+    stats = None
+    if options.stats:
+        stats = StatsSegment(options.stats, prx, rewrite)
+        stats.start()
+        logger.info("%r ready."%stats)
+    if pool:
+        pool.start()
     try:
         prx.main_loop()
     except KeyboardInterrupt:
         logger.warning( "Ctrl C - Stopping server")
         ret+=1
+    prx.control.close()
+    if pool:
+        pool.stop()
+    if rewrite.reporter:
+        rewrite.reporter.stop()
+        logger.info("%r stopped."%rewrite.reporter)
+    if stats:
+        stats.stop()
+    if rewrite.verdicts:
+        logger.info("%r"%rewrite.verdicts)
+    if Session.MEMORY:
+        logger.info("%r"%Session.MEMORY)
+    logger.info("%r"%prx.scheduler)
+    if Session.tracer:
+        Session.tracer.close()
+        logger.info("%r written."%Session.tracer)
         
     logger.info(" -- audit results --")
-    for client,resultlist in rewrite.get_results_by_clients().iteritems():
+    results = rewrite.get_results_by_clients()
+    rejected = prx.admission.rejected
+    for client in sorted(set(results).union(rejected)):
         logger.info("[*] client: %s"%client)
-        for mangle, result in resultlist:
-            logger.info("    [%-11s] %s"%("Vulnerable!" if result else " ",repr(mangle)))
+        for mangle, result, target in results.get(client,[]):
+            logger.info("    [%-11s] %s%s"%("Vulnerable!" if result else " ",repr(mangle),
+                                             " target: %s:%d"%target[:2] if options.transparent or len(pool.upstreams)>1 else ""))
+        for reason, count in rejected.get(client,{}).items():
+            logger.info("    [%-11s] %s: %d connections"%("Rejected", reason, count))
         
     sys.exit(ret)
     
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : tintinweb@oststrom.com <github.com/tintinweb>
+'''
+Live view of the proxies publishing to a stats directory (--stats).
+
+Every proxy process writes a snapshot of its sessions and vector results
+to <directory>/striptls-<pid>.stats once a second (StatsSegment). top
+only reads these segments, the proxies do not notice it. Segments of
+processes that are gone are skipped, so a proxy and the process taking
+over its listener show up side by side:
+
+    #> python -m striptls --listen 0.0.0.0:25 --remote mail.server.tld:25 --stats /dev/shm/striptls
+    #> python -m striptls top -d /dev/shm/striptls
+'''
+import os
+import sys
+import glob
+import time
+import json
+
+try:
+    from . import striptls
+except ImportError:
+    # python striptls (source folder)
+    import striptls
+
+CLEAR = "\x1b[H\x1b[2J"
+SORT = {'age': lambda s: s['started'],
+        'bytes': lambda s: -(s['client_bytes'] + s['server_bytes']),
+        'client': lambda s: s['client'],
+        'vector': lambda s: s['vector']}
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def load(directory):
+    ''' snapshots of the live proxies publishing to directory '''
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory, "striptls-*.stats"))):
+        try:
+            stats = striptls.StatsSegment.read(path)
+        except (OSError, ValueError) as e:
+            sys.stderr.write("%s: %s\n"%(path, e))
+            continue
+        if stats and alive(stats['pid']):
+            snapshots.append(stats)
+    return snapshots
+
+
+def size(nbytes):
+    for unit in ("B", "K", "M", "G"):
+        if nbytes < 1024:
+            return "%d%s"%(nbytes, unit)
+        nbytes /= 1024.0
+    return "%dT"%nbytes
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return "%d:%02d"%(seconds//60, seconds%60)
+    return "%dh%02d"%(seconds//3600, seconds%3600//60)
+
+
+def render(snapshots, now, sort='age', limit=0):
+    ''' lines of the top view '''
+    lines = []
+    for stats in snapshots:
+        lines.append("pid %d  %s -> %s  up %s  sessions %d  rejected %d  memory %s spilled %s  delay p99 %.1fms%s"%(
+            stats['pid'], stats['listen'], stats['target'], duration(now-stats['started']), stats['active'],
+            stats['rejected'], size(stats['memory']), size(stats['spilled']), stats['delay_p99']*1000,
+            "  (snapshot %.0fs old)"%(now-stats['updated']) if now-stats['updated'] > 3*striptls.StatsSegment.INTERVAL else ""))
+    sessions = [dict(s, pid=stats['pid']) for stats in snapshots for s in stats['sessions']]
+    sessions.sort(key=SORT[sort])
+    lines.append("")
+    lines.append("%-7s %-22s %-22s %-6s %-40s %-13s %6s %8s %8s %-5s"%("PID", "CLIENT", "TARGET", "PROTO", "VECTOR", "STATE",
+                                                                    "AGE", "C->S", "S->C", "TLS"))
+    for s in sessions[:limit or None]:
+        vector = s['vector'] + (" !" if s['result'] else "")
+        lines.append("%-7d %-22s %-22s %-6s %-40s %-13s %6s %8s %8s %-5s"%(s['pid'], s['client'], s['target'], s['protocol'],
+                                                                        vector, s['state'], duration(now-s['started']),
+                                                                        size(s['client_bytes']), size(s['server_bytes']),
+                                                                        "/".join("tls" if t else "-" for t in s['tls'])))
+    if limit and len(sessions) > limit:
+        lines.append("... %d more"%(len(sessions)-limit))
+    vectors = {}
+    for stats in snapshots:
+        for v in stats['vectors']:
+            merged = vectors.get(v['vector'])
+            if merged is None:
+                vectors[v['vector']] = dict(v)
+                continue
+            for key in ('vulnerable', 'not_vulnerable', 'no_verdict', 'sessions'):
+                merged[key] += v[key]
+    lines.append("")
+    lines.append("%-40s %10s %14s %10s %8s"%("VECTOR", "VULNERABLE", "NOT VULNERABLE", "NO VERDICT", "SESSIONS"))
+    for name in sorted(vectors):
+        v = vectors[name]
+        lines.append("%-40s %10d %14d %10d %8d"%(name, v['vulnerable'], v['not_vulnerable'], v['no_verdict'], v['sessions']))
+    return lines
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    usage = """usage: %prog top [options]
+
+       example: %prog --listen 0.0.0.0:25 --remote mail.server.tld:25 --stats /dev/shm/striptls
+                %prog top -d /dev/shm/striptls
+                %prog top -d /dev/shm/striptls -n 1 --json
+    """
+    parser = OptionParser(usage=usage, prog="striptls")
+    parser.add_option("-d", "--directory", dest="directory", default="/dev/shm/striptls",
+                  help="stats directory the proxies publish to (--stats) [default: %default]")
+    parser.add_option("-i", "--interval", dest="interval", default=1, type="float",
+                  help="seconds between refreshes [default: %default]")
+    parser.add_option("-n", "--iterations", dest="iterations", default=0, type="int",
+                  help="exit after n refreshes, 0 = until interrupted [default: %default]")
+    parser.add_option("-s", "--sort", dest="sort", default="age", choices=sorted(SORT),
+                  help="session order: %s [default: %%default]"%", ".join(sorted(SORT)))
+    parser.add_option("--limit", dest="limit", default=0, type="int",
+                  help="sessions shown, 0 = as many as the terminal has lines [default: %default]")
+    parser.add_option("--json", action="store_true", dest="json", default=False,
+                  help="print the snapshots as JSON instead")
+    (options, args) = parser.parse_args(argv)
+    if not os.path.isdir(options.directory):
+        parser.error("no stats directory %s, start the proxy with --stats %s"%(options.directory, options.directory))
+    tty = sys.stdout.isatty()
+    count = 0
+    try:
+        while True:
+            snapshots = load(options.directory)
+            if options.json:
+                print(json.dumps(snapshots))
+            else:
+                limit = options.limit
+                if not limit and tty:
+                    # headers of every process and the vector table stay visible
+                    vectors = max([len(stats['vectors']) for stats in snapshots] or [0])
+                    limit = max(os.get_terminal_size().lines - len(snapshots) - vectors - 8, 5)
+                lines = render(snapshots, time.time(), sort=options.sort, limit=limit)
+                if not snapshots:
+                    lines.insert(0, "no proxy publishing to %s"%options.directory)
+                sys.stdout.write((CLEAR if tty else "") + "\n".join(lines) + "\n")
+                sys.stdout.flush()
+            count += 1
+            if options.iterations and count >= options.iterations:
+                break
+            time.sleep(options.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())